@@ -0,0 +1,263 @@
+'''
+Persistent index of parsed job configurations.
+
+The catalog is stored as JSON in the run directory, and job files are only
+parsed again when their inode, mtime or size changes.  The whole catalog is
+thrown away when the validation code changes, since it holds validation
+results.
+
+The run directory is writable by the job user, while the catalog is also read
+by root when generating the crontab.  So the catalog only holds plain data,
+and cached job configurations are validated again as they're loaded.
+'''
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import yaml
+
+from . import config
+from . import job_spec
+from . import schedule
+
+
+CATALOG_FILENAME = "job-catalog.json"
+
+# Bump this when the stored structure changes.  Changes to validation are
+# picked up by validator_hash() instead.
+CATALOG_VERSION = 3
+
+# Modules whose code decides whether a job file is valid.
+VALIDATOR_MODULES = (config, schedule)
+
+# Cached result of validator_hash().
+_validator_hash = None
+
+
+def load_catalog():
+    """Return a catalog which is up to date with the job directory."""
+    catalog = JobCatalog()
+    catalog.refresh()
+    return catalog
+
+
+def catalog_path():
+    global_config = config.get_global_config()
+    if not global_config.has("run_directory"):
+        return None
+    return "{run_dir}/{name}".format(
+        run_dir=global_config.get("run_directory"),
+        name=CATALOG_FILENAME)
+
+
+def validator_hash():
+    """Return a digest of the job validation code, so that upgrades which
+    change validation don't keep stale results."""
+    global _validator_hash
+    if _validator_hash is None:
+        digest = hashlib.sha1()
+        for module in VALIDATOR_MODULES:
+            with open(module.__file__, "rb") as f:
+                digest.update(f.read())
+        _validator_hash = digest.hexdigest()
+    return _validator_hash
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class CatalogEntry(object):
+    """Parsed configuration for a single job file.
+
+    Invalid job configurations are remembered as well, with the validation
+    message in `error`.
+    """
+
+    def __init__(self, path, stamp, global_config=None):
+        self.path = path
+        self.stamp = stamp
+        self.slug = os.path.basename(path).replace(".yaml", "")
+        self.job_config = None
+        self.error = None
+
+        if global_config is None:
+            # Filled in by from_storage().
+            return
+
+        try:
+            self.job_config = config.JobConfiguration(global_config, path)
+        except (AssertionError, yaml.YAMLError, OSError, TypeError, ValueError) as ex:
+            self.error = str(ex)
+        except SystemExit:
+            # JobConfiguration has already printed why.
+            self.error = "Can't read or parse {path}".format(path=path)
+
+    def to_storage(self):
+        """Return the entry as JSON-compatible data, or None if the job's
+        values wouldn't come back unchanged, such as YAML dates or numeric
+        mapping keys.  Such jobs are parsed again next time."""
+        values = None
+        if self.job_config is not None:
+            values = self.job_config.values
+            try:
+                if json.loads(json.dumps(values)) != values:
+                    return None
+            except (TypeError, ValueError):
+                return None
+        return {
+            "path": self.path,
+            "stamp": list(self.stamp),
+            "values": values,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_storage(cls, stored):
+        """Rebuild an entry written by to_storage().  Raises AssertionError
+        if the stored values don't validate."""
+        entry = cls(stored["path"], tuple(stored["stamp"]))
+        entry.error = stored["error"]
+        if stored["values"] is not None:
+            entry.job_config = config.JobConfiguration.from_values(stored["values"])
+        return entry
+
+    @property
+    def tags(self):
+        if self.job_config is None or not self.job_config.has("tag"):
+            return []
+        return self.job_config.get_as_list("tag")
+
+
+class JobCatalog(object):
+
+    def __init__(self, path=None):
+        self.global_config = config.get_global_config()
+        if path is None:
+            path = catalog_path()
+        self.path = path
+        self.defaults = None
+        self.entries = {}
+        self.dirty = False
+
+    def refresh(self):
+        """Re-parse any job files which changed since the catalog was
+        written, and save the catalog if anything was updated."""
+        self.read()
+
+        if self.global_config.has("default_job_config"):
+            defaults = self.global_config.get("default_job_config")
+        else:
+            defaults = {}
+        if defaults != self.defaults:
+            # Every job inherits the defaults, so start over.
+            self.defaults = defaults
+            self.entries = {}
+            self.dirty = True
+
+        job_directory = self.global_config.get("job_directory")
+        paths = sorted(glob.glob(job_directory + "/*.yaml"))
+
+        entries = {}
+        for path in paths:
+            try:
+                stamp = file_stamp(path)
+            except FileNotFoundError:  # noqa: F821
+                # Deleted since the glob.
+                continue
+            entry = self.entries.get(path)
+            if entry is None or entry.stamp != stamp:
+                entry = CatalogEntry(path, stamp, self.global_config)
+                self.dirty = True
+            entries[path] = entry
+
+        if set(entries) != set(self.entries):
+            self.dirty = True
+        self.entries = entries
+
+        if self.dirty:
+            self.write()
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as f:
+                storage = json.load(f)
+            if storage.get("version") != CATALOG_VERSION or storage.get("validator") != validator_hash():
+                return
+            entries = {}
+            for stored in storage["entries"]:
+                entry = CatalogEntry.from_storage(stored)
+                entries[entry.path] = entry
+        except (OSError, ValueError, TypeError, KeyError, AttributeError, AssertionError) as ex:
+            config.log.warning("Ignoring unreadable job catalog {path}: {error}".format(path=self.path, error=ex))
+            return
+
+        self.defaults = storage["defaults"]
+        self.entries = entries
+
+    def write(self):
+        if self.path is None:
+            return
+
+        stored_entries = []
+        for path in sorted(self.entries):
+            stored = self.entries[path].to_storage()
+            if stored is not None:
+                stored_entries.append(stored)
+        storage = {
+            "version": CATALOG_VERSION,
+            "validator": validator_hash(),
+            "defaults": self.defaults,
+            "entries": stored_entries,
+        }
+
+        # Write to a temporary file and rename, so that readers never see a
+        # partial catalog.  mkstemp creates a new file with an unpredictable
+        # name, since other users may write to the run directory.
+        temp_path = None
+        try:
+            json_text = json.dumps(storage)
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)),
+                prefix=CATALOG_FILENAME + ".", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(json_text)
+                # Readable by whoever runs jobs, whoever wrote it.
+                os.fchmod(f.fileno(), 0o644)
+            os.replace(temp_path, self.path)
+        except (OSError, TypeError, ValueError) as ex:
+            config.log.warning("Cannot write job catalog {path}: {error}".format(path=self.path, error=ex))
+            if temp_path is not None and os.path.exists(temp_path):
+                os.unlink(temp_path)
+            return
+
+        self.dirty = False
+
+    def slugs(self):
+        """Return a sorted list of all job names."""
+        return sorted(entry.slug for entry in self.entries.values())
+
+    def get(self, slug):
+        return self.entries.get(job_spec.job_path_for_slug(slug))
+
+    def with_tag(self, tag):
+        """Return the names of all valid jobs having this tag."""
+        return sorted(entry.slug for entry in self.entries.values() if tag in entry.tags)
+
+    def job(self, slug):
+        """Build a Job from the cached configuration.
+
+        Raises AssertionError if the job configuration is invalid, just like
+        job_spec.load().
+        """
+        entry = self.get(slug)
+        if entry is None:
+            return job_spec.load(slug)
+
+        assert entry.error is None, entry.error
+        return job_spec.Job(slug=slug, job_config=entry.job_config)
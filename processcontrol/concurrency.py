@@ -0,0 +1,133 @@
+'''
+Limits on how many jobs run at once, globally and per tag.
+
+Each pool is a set of slot files in the run directory, and a job holds a
+slot by keeping an flock on one of them.  The kernel releases the slot when
+the holder exits, so crashed jobs never leak slots.
+
+A job takes a slot in every pool which applies to it, or none at all: while
+it waits for a full pool, it gives back the slots it took in the others.
+'''
+import fcntl
+import os
+import time
+
+from . import config
+
+
+# Seconds between attempts to grab a slot, with the queue policy.
+POLL_INTERVAL = 0.5
+
+
+class Pool(object):
+
+    def __init__(self, name, limit, policy="queue", max_wait=0):
+        assert policy in ("queue", "skip"), "Concurrency policy for '{name}' must be 'queue' or 'skip'".format(name=name)
+        # The name goes into the slot filenames.
+        assert "/" not in name, "Concurrency pool name '{name}' may not contain '/'".format(name=name)
+        self.name = name
+        self.limit = int(limit)
+        self.policy = policy
+        self.max_wait = float(max_wait)
+
+    def slot_path(self, index):
+        run_dir = config.get_global_config().get("run_directory")
+        return "{run_dir}/pool-{name}-{index}.slot".format(run_dir=run_dir, name=self.name, index=index)
+
+    def try_acquire(self):
+        """Grab any free slot, returning its file descriptor, or None if the
+        pool is full."""
+        for index in range(self.limit):
+            fd = os.open(self.slot_path(index), os.O_RDWR | os.O_CREAT, 0o664)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+
+            # Note the holder, for debugging.
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode("ascii"))
+            return fd
+        return None
+
+    def busy_error(self):
+        return PoolBusy("All {limit} slots in concurrency pool '{name}' are busy.".format(limit=self.limit, name=self.name))
+
+
+def pools_for_job(job):
+    """Return the pools which apply to a job, in the order they must be
+    acquired: the narrower tag pools first, then the global pool."""
+    global_config = config.get_global_config()
+    if not global_config.has("concurrency"):
+        return []
+
+    settings = global_config.get("concurrency")
+    pools = []
+
+    tag_settings = settings.get("tags", {})
+    # Always take tag pools in the same order, so that two queued jobs can't
+    # each hold a slot the other one is waiting for.
+    for tag in sorted(set(job.tags)):
+        if tag in tag_settings:
+            pool_config = tag_settings[tag]
+            pools.append(Pool(
+                "tag-" + str(tag),
+                pool_config["limit"],
+                policy=pool_config.get("policy", "queue"),
+                max_wait=pool_config.get("max_wait", 0)))
+
+    if "max_concurrent_jobs" in settings:
+        pools.append(Pool(
+            "global",
+            settings["max_concurrent_jobs"],
+            policy=settings.get("policy", "queue"),
+            max_wait=settings.get("max_wait", 0)))
+    return pools
+
+
+class Slots(object):
+    """Slots held by a job run."""
+
+    def __init__(self, job):
+        self.pools = pools_for_job(job)
+        self.fds = []
+        self.wait_time = 0
+
+    def acquire(self, abort=None):
+        """Take a slot in every pool, waiting according to the policy of
+        whichever pool is full.  Raises PoolBusy."""
+        start = time.monotonic()
+        try:
+            while True:
+                busy = self.try_acquire_all()
+                if busy is None:
+                    return
+                if busy.policy == "skip" or time.monotonic() >= start + busy.max_wait:
+                    raise busy.busy_error()
+                if abort is not None and abort():
+                    raise busy.busy_error()
+                time.sleep(POLL_INTERVAL)
+        finally:
+            self.wait_time = time.monotonic() - start
+
+    def try_acquire_all(self):
+        """Take a slot in every pool, or in none of them, so that a job
+        waiting for one pool doesn't keep others from using the rest.
+        Returns the first full pool, or None."""
+        for pool in self.pools:
+            fd = pool.try_acquire()
+            if fd is None:
+                self.release()
+                return pool
+            self.fds.append(fd)
+        return None
+
+    def release(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+class PoolBusy(RuntimeError):
+    pass
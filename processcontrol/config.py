@@ -5,12 +5,17 @@ import os
 import sys
 import yaml
 
+from . import schedule
 
 CONFIG_PATH = "/etc/process-control.yaml"
 
 # FIXME: Offload responsibility for logging.
 log = None
 
+# Cached global configuration, see get_global_config().
+_global_config = None
+_global_config_stamp = None
+
 
 def setup_logging(global_config=None):
     global log
@@ -20,7 +25,7 @@ def setup_logging(global_config=None):
         return
 
     if global_config is None:
-        global_config = GlobalConfiguration()
+        global_config = get_global_config()
 
     if global_config.has("logging"):
         # Configure from global config.
@@ -37,9 +42,48 @@ def setup_logging(global_config=None):
         log.addHandler(logging.StreamHandler(sys.stdout))
 
 
+def get_global_config():
+    """Return the process-wide global configuration.
+
+    The global config file is parsed once and then reused until its inode,
+    mtime or size changes.
+    """
+    global _global_config, _global_config_stamp
+
+    stamp = global_config_stamp()
+    if _global_config is None or stamp != _global_config_stamp:
+        _global_config = GlobalConfiguration()
+        _global_config_stamp = stamp
+    return _global_config
+
+
+def reset_global_config():
+    """Forget the cached global configuration, forcing a reload."""
+    global _global_config, _global_config_stamp
+    _global_config = None
+    _global_config_stamp = None
+
+
+def global_config_stamp():
+    """Identify the current version of the global config file."""
+    try:
+        stat = os.stat(CONFIG_PATH)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def is_number(value):
+    """Whether a config value is a plain number, rather than a string, bool or
+    anything else YAML can produce."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
 class Configuration():
 
-    def __init__(self, defaults={}):
+    def __init__(self, defaults=None):
+        if defaults is None:
+            defaults = {}
         self.values = defaults
 
     def get(self, path):
@@ -140,11 +184,81 @@ class JobConfiguration(Configuration):
         else:
             self.validate_job_config()
 
+    @classmethod
+    def from_values(cls, values):
+        """Rebuild a job configuration from values already merged with the
+        defaults, such as those cached in the job catalog.  The values are
+        validated again, since they didn't come straight from the job file.
+        """
+        job_config = cls.__new__(cls)
+        Configuration.__init__(job_config, values)
+        job_config.validate_job_config()
+        return job_config
+
     def validate_job_config(self):
         assert "name" in self.values, "Job config invalid: missing required 'name'"
 
-        assert "command" in self.values, "Job config invalid: missing required 'command'"
-        assert "\n" not in self.values["command"], "Job config invalid: 'command' may not contain newlines"
+        assert "command" in self.values or "steps" in self.values, "Job config invalid: missing required 'command'"
+        assert "command" not in self.values or "steps" not in self.values, "Job config invalid: give either 'command' or 'steps', not both"
+        if "command" in self.values:
+            assert "\n" not in self.values["command"], "Job config invalid: 'command' may not contain newlines"
+        else:
+            self.validate_steps()
+
+        if "adaptive_timeout" in self.values:
+            adaptive = self.values["adaptive_timeout"]
+            assert isinstance(adaptive, dict), "Job config invalid: 'adaptive_timeout' must be a mapping of 'factor' and 'min_runs'"
+            assert set(adaptive) <= {"factor", "min_runs"}, "Job config invalid: 'adaptive_timeout' may only contain 'factor' and 'min_runs'"
+            factor = adaptive.get("factor", 1)
+            assert is_number(factor) and factor > 0, "Job config invalid: 'adaptive_timeout/factor' must be a positive number"
+            min_runs = adaptive.get("min_runs", 1)
+            assert isinstance(min_runs, int) and not isinstance(min_runs, bool) and min_runs >= 1, \
+                "Job config invalid: 'adaptive_timeout/min_runs' must be a whole number, at least 1"
+        if "slow_run_factor" in self.values:
+            slow_run_factor = self.values["slow_run_factor"]
+            assert is_number(slow_run_factor) and slow_run_factor > 1, "Job config invalid: 'slow_run_factor' must be a number more than 1"
+
+        if "kill_grace" in self.values:
+            assert is_number(self.values["kill_grace"]) and self.values["kill_grace"] >= 0, \
+                "Job config invalid: 'kill_grace' must be a number of seconds, not negative"
+        if "idle_timeout" in self.values:
+            assert is_number(self.values["idle_timeout"]) and self.values["idle_timeout"] >= 0, \
+                "Job config invalid: 'idle_timeout' must be a number of seconds, not negative"
+
+        if "lock_wait" in self.values:
+            lock_wait = self.values["lock_wait"]
+            assert isinstance(lock_wait, dict), "Job config invalid: 'lock_wait' must be a mapping of 'max_wait', 'strategy' and 'max_queue'"
+            assert set(lock_wait) <= {"max_wait", "strategy", "max_queue"}, "Job config invalid: 'lock_wait' may only contain 'max_wait', 'strategy' and 'max_queue'"
+            assert lock_wait.get("strategy", "poll") in ("poll", "notify"), "Job config invalid: 'lock_wait/strategy' must be 'poll' or 'notify'"
+            assert is_number(lock_wait.get("max_wait", 0)), "Job config invalid: 'lock_wait/max_wait' must be a number of seconds"
+            max_queue = lock_wait.get("max_queue", 1)
+            assert isinstance(max_queue, int) and not isinstance(max_queue, bool) and max_queue >= 1, \
+                "Job config invalid: 'lock_wait/max_queue' must be a whole number, at least 1"
+
+        if "output_mode" in self.values:
+            assert self.values["output_mode"] in ("timestamped", "raw"), "Job config invalid: 'output_mode' must be 'timestamped' or 'raw'"
+            if self.values["output_mode"] == "raw":
+                assert not self.values.get("output_max_bytes"), "Job config invalid: 'output_max_bytes' can't be used with raw output"
+                assert not self.values.get("idle_timeout"), "Job config invalid: 'idle_timeout' can't be used with raw output"
+        for key in ("output_max_line_length", "output_max_bytes"):
+            if key in self.values:
+                value = self.values[key]
+                assert isinstance(value, int) and value > 0, "Job config invalid: '{key}' must be a positive whole number".format(key=key)
+        if "failmail" in self.values and "tail_lines" in self.values["failmail"]:
+            tail_lines = self.values["failmail"]["tail_lines"]
+            assert isinstance(tail_lines, int) and tail_lines >= 0, "Job config invalid: 'failmail/tail_lines' must be a whole number"
+        if "output_long_lines" in self.values:
+            assert self.values["output_long_lines"] in ("split", "truncate"), "Job config invalid: 'output_long_lines' must be 'split' or 'truncate'"
+        if "output_limit_action" in self.values:
+            assert self.values["output_limit_action"] in ("stop_logging", "kill"), "Job config invalid: 'output_limit_action' must be 'stop_logging' or 'kill'"
+
+        if "tag" in self.values:
+            for tag in self.get_as_list("tag"):
+                # Tags name concurrency pool slot files.
+                assert "/" not in str(tag), "Job config invalid: tag '{tag}' may not contain '/'".format(tag=tag)
+
+        if "failure_mode" in self.values:
+            assert self.values["failure_mode"] in ("fail_fast", "wait_all"), "Job config invalid: 'failure_mode' must be 'fail_fast' or 'wait_all'"
 
         if "schedule" in self.values:
             # No tricky assignments.
@@ -157,3 +271,39 @@ class JobConfiguration(Configuration):
             # Be sure the schedule is valid.
             terms = self.values["schedule"].split()
             assert len(terms) == 5, "Job config invalid: 'schedule' must contain 5 values separated by whitespace"
+            try:
+                schedule.CronSchedule(self.values["schedule"])
+            except ValueError as ex:
+                raise AssertionError("Job config invalid: {error}".format(error=ex))
+
+    def validate_steps(self):
+        steps = self.values["steps"]
+        assert isinstance(steps, dict) and steps, "Job config invalid: 'steps' must map step names to steps"
+
+        for name, step in steps.items():
+            assert isinstance(step, dict) and "command" in step, "Job config invalid: step '{name}' is missing 'command'".format(name=name)
+            for dependency in self.step_dependencies(name):
+                assert dependency in steps, "Job config invalid: step '{name}' depends on unknown step '{dependency}'".format(name=name, dependency=dependency)
+
+        # Check for cycles with a depth-first search.
+        finished = set()
+
+        def visit(name, path):
+            assert name not in path, "Job config invalid: steps have a dependency cycle: {cycle}".format(cycle=" -> ".join(path + [name]))
+            if name in finished:
+                return
+            for dependency in self.step_dependencies(name):
+                visit(dependency, path + [name])
+            finished.add(name)
+
+        for name in steps:
+            visit(name, [])
+
+    def step_dependencies(self, name):
+        step = self.values["steps"][name]
+        if "depends_on" not in step:
+            return []
+        depends_on = step["depends_on"]
+        if hasattr(depends_on, "encode"):
+            return [depends_on]
+        return depends_on
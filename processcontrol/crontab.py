@@ -1,31 +1,110 @@
+import difflib
+import hashlib
+import os
+import sys
+import tempfile
+
+from . import catalog
 from . import config
-from . import job_spec
 
 
-def make_cron():
+def make_cron(show_diff=False):
     '''
     Read all files from the dir and output a crontab.
-    '''
 
-    jobs = job_spec.list()
-    cron_text = ""
-
-    for job_name in jobs:
-        # FIXME just use the configuration classes, no need for job
-        job = job_spec.load(job_name)
-        tab = JobCrontab(job)
+    The crontab is only rewritten when its contents change.  With show_diff,
+    print the changes instead of writing them.
 
-        cron_text += str(tab)
+    Returns True if the crontab differs from what was previously written.
+    '''
+    cron_text = render_cron()
 
-    global_config = config.GlobalConfiguration()
+    global_config = config.get_global_config()
     output_file = global_config.get("output_crontab")
-    config.log.info("Writing crontab to {out}".format(out=output_file))
 
     if output_file == 'console':
         print(cron_text)
-    else:
-        with open(output_file, "w") as out:
-            out.write(cron_text)
+        return True
+
+    current_text = read_crontab(output_file)
+    changed = current_text is None or content_hash(current_text) != content_hash(cron_text)
+
+    if show_diff:
+        if current_text is None:
+            current_text = ""
+        diff = difflib.unified_diff(
+            current_text.splitlines(True),
+            cron_text.splitlines(True),
+            fromfile=output_file,
+            tofile="(generated)"
+        )
+        sys.stdout.writelines(diff)
+        return changed
+
+    if not changed:
+        config.log.info("Crontab {out} is up to date.".format(out=output_file))
+        return False
+
+    config.log.info("Writing crontab to {out}".format(out=output_file))
+    write_atomic(output_file, cron_text)
+    return True
+
+
+def render_cron():
+    '''
+    Build crontab text for all jobs.  Jobs come from the catalog, so only
+    files which changed since the last run are parsed.
+    '''
+    jobs_catalog = catalog.load_catalog()
+    entries = []
+    errors = []
+
+    for job_name in jobs_catalog.slugs():
+        # FIXME just use the configuration classes, no need for job
+        try:
+            job = jobs_catalog.job(job_name)
+        except AssertionError as ex:
+            errors.append("{name}: {error}".format(name=job_name, error=ex))
+            continue
+        entries.append(str(JobCrontab(job)))
+
+    # Refuse to write a crontab which would silently drop jobs.
+    assert not errors, "Invalid jobs, not writing crontab:\n" + "\n".join(errors)
+
+    return "".join(entries)
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def read_crontab(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except FileNotFoundError:  # noqa: F821
+        return None
+
+
+def write_atomic(path, text):
+    '''
+    Write to a temporary file in the same directory and rename it into place,
+    so cron never sees a partial crontab.  The temporary name contains a dot,
+    which cron ignores in /etc/cron.d.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".cron-generate-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as out:
+            out.write(text)
+            out.flush()
+            os.fsync(out.fileno())
+        # cron refuses crontabs which are group or world writable.
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
 
 
 class JobCrontab(object):
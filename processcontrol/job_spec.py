@@ -2,6 +2,15 @@ import glob
 import os
 
 from . import config
+from . import log_retention
+from . import output_streamer
+from . import resource_limits
+from . import run_stats
+from . import schedule
+
+
+DEFAULT_KILL_GRACE = 10
+DEFAULT_ADAPTIVE_FACTOR = 3
 
 
 # TODO: uh has no raison d'etre now other than to demonstrate factoryness.
@@ -11,7 +20,7 @@ def load(job_name):
 
 def list():
     """Return a tuple of all available job names."""
-    job_directory = config.GlobalConfiguration().get("job_directory")
+    job_directory = config.get_global_config().get("job_directory")
     paths = sorted(glob.glob(job_directory + "/*.yaml"))
     file_names = [os.path.basename(p) for p in paths]
     job_names = [f.replace(".yaml", "") for f in file_names]
@@ -19,15 +28,15 @@ def list():
 
 
 def job_path_for_slug(slug):
-    global_config = config.GlobalConfiguration()
+    global_config = config.get_global_config()
     job_directory = global_config.get("job_directory")
     path = "{root_dir}/{slug}.yaml".format(root_dir=job_directory, slug=slug)
     return path
 
 
 class Job(object):
-    def __init__(self, slug=None):
-        self.global_config = config.GlobalConfiguration()
+    def __init__(self, slug=None, job_config=None):
+        self.global_config = config.get_global_config()
         self.config_path = job_path_for_slug(slug)
 
         # Validate that we're not allowing directory traversal.
@@ -35,7 +44,9 @@ class Job(object):
         assert os.path.dirname(os.path.realpath(self.config_path)) == job_directory, \
             "You may only run jobs with configuration files in '{path}'".format(path=job_directory)
 
-        self.config = config.JobConfiguration(self.global_config, self.config_path)
+        if job_config is None:
+            job_config = config.JobConfiguration(self.global_config, self.config_path)
+        self.config = job_config
 
         self.name = self.config.get("name")
         self.slug = slug
@@ -43,13 +54,37 @@ class Job(object):
             self.timeout = self.config.get("timeout")
         else:
             self.timeout = 0
+        # With adaptive_timeout, the timeout follows how long the job usually
+        # takes, and `timeout` becomes the least it may be.
+        self.adaptive_timeout = None
+        if self.config.has("adaptive_timeout"):
+            self.adaptive_timeout = {"factor": DEFAULT_ADAPTIVE_FACTOR, "min_runs": run_stats.DEFAULT_MIN_RUNS}
+            self.adaptive_timeout.update(self.config.get("adaptive_timeout"))
+        # Warn about runs taking this many times longer than usual.
+        if self.config.has("slow_run_factor"):
+            self.slow_run_factor = self.config.get("slow_run_factor")
+        else:
+            self.slow_run_factor = 0
+        # Seconds a command may take to exit after SIGTERM, before SIGKILL.
+        if self.config.has("kill_grace"):
+            self.kill_grace = self.config.get("kill_grace")
+        else:
+            self.kill_grace = DEFAULT_KILL_GRACE
+        # Seconds a command may go without output before it's killed.
+        if self.config.has("idle_timeout"):
+            self.idle_timeout = self.config.get("idle_timeout")
+        else:
+            self.idle_timeout = 0
 
         if self.config.has("disabled") and self.config.get("disabled") is True:
             self.enabled = False
         else:
             self.enabled = True
 
-        if not self.config.has("schedule"):
+        if self.config.has("schedule"):
+            self.schedule = schedule.CronSchedule(self.config.get("schedule"))
+        else:
+            self.schedule = None
             self.enabled = False
 
         self.environment = os.environ.copy()
@@ -58,7 +93,25 @@ class Job(object):
             str_env = {k: str(v) for k, v in self.config.get("environment").items()}
             self.environment.update(str_env)
 
-        self.commands = self.config.get_as_list("command")
+        if self.config.has("steps"):
+            self.commands = []
+            self.steps = [
+                Step(name, step_config, self.config.step_dependencies(name))
+                for name, step_config in self.config.get("steps").items()
+            ]
+        else:
+            self.commands = self.config.get_as_list("command")
+            self.steps = None
+
+        if self.config.has("parallelism"):
+            self.parallelism = self.config.get("parallelism")
+        else:
+            self.parallelism = 0
+
+        if self.config.has("failure_mode"):
+            self.failure_mode = self.config.get("failure_mode")
+        else:
+            self.failure_mode = "fail_fast"
 
         if self.config.has("slow_start_command"):
             self.slow_start_command = self.config.get_as_list("slow_start_command")
@@ -80,7 +133,61 @@ class Job(object):
         else:
             self.allow_overtime = False
 
+        self.log_retention = log_retention.policy_for_job(self.config)
+        log_retention.validate_policy(self.log_retention)
+
+        self.resources = resource_limits.settings_for_job(self.config)
+        resource_limits.validate_settings(self.resources)
+
+        self.lock_wait = {"max_wait": 0, "strategy": "poll", "max_queue": 1}
+        if self.config.has("lock_wait"):
+            self.lock_wait.update(self.config.get("lock_wait"))
+
+        if self.config.has("output_mode"):
+            self.output_mode = self.config.get("output_mode")
+        else:
+            self.output_mode = "timestamped"
+
+        if self.config.has("output_max_line_length"):
+            self.output_max_line_length = self.config.get("output_max_line_length")
+        else:
+            self.output_max_line_length = output_streamer.DEFAULT_MAX_LINE_LENGTH
+
+        if self.config.has("output_long_lines"):
+            self.output_long_lines = self.config.get("output_long_lines")
+        else:
+            self.output_long_lines = "split"
+
+        if self.config.has("output_max_bytes"):
+            self.output_max_bytes = self.config.get("output_max_bytes")
+        else:
+            self.output_max_bytes = 0
+
+        if self.config.has("output_limit_action"):
+            self.output_limit_action = self.config.get("output_limit_action")
+        else:
+            self.output_limit_action = "stop_logging"
+
+        if self.config.has("failmail/tail_lines"):
+            self.failmail_tail_lines = self.config.get("failmail/tail_lines")
+        else:
+            self.failmail_tail_lines = output_streamer.DEFAULT_TAIL_LINES
+
         if self.config.has("failure_threshold_for_mail"):
             self.failure_threshold_for_mail = self.config.get("failure_threshold_for_mail")
         else:
             self.failure_threshold_for_mail = 1
+
+
+class Step(object):
+    """A named part of a job, which can run alongside other steps once the
+    steps it depends on have succeeded."""
+
+    def __init__(self, name, step_config, depends_on):
+        self.name = name
+        command = step_config["command"]
+        if hasattr(command, "encode"):
+            self.commands = [command]
+        else:
+            self.commands = command
+        self.depends_on = depends_on
@@ -1,8 +1,29 @@
 import datetime
+import fcntl
+import glob
+import json
+import os
+import sqlite3
 import yaml
 
 
 from . import config
+from . import run_stats
+
+
+# Number of runs kept per job unless `state_retention` is configured.
+DEFAULT_RETENTION = 20
+
+# Journal size in bytes which triggers compaction, unless
+# `state_journal_max_bytes` is configured.
+DEFAULT_JOURNAL_MAX_BYTES = 64 * 1024
+
+# Run statuses which end a job run.
+TERMINAL_STATUSES = ("completed", "failed", "skipped")
+
+# Cached backend, see get_backend().
+_backend = None
+_backend_key = None
 
 
 def load_state(slug):
@@ -12,85 +33,489 @@ def load_state(slug):
 
 
 def statefile_path(slug):
-    global_config = config.GlobalConfiguration()
+    global_config = config.get_global_config()
     path = "{root}/{job}.yaml".format(
         root=global_config.get("state_directory"),
         job=slug)
     return path
 
 
+def database_path():
+    global_config = config.get_global_config()
+    if global_config.has("state_database"):
+        return global_config.get("state_database")
+    return "{root}/state.sqlite".format(root=global_config.get("state_directory"))
+
+
+def journal_path(slug):
+    global_config = config.get_global_config()
+    return "{root}/{job}.journal".format(
+        root=global_config.get("state_directory"),
+        job=slug)
+
+
+def snapshot_path(slug):
+    global_config = config.get_global_config()
+    return "{root}/{job}.snapshot".format(
+        root=global_config.get("state_directory"),
+        job=slug)
+
+
+def retention():
+    """Number of runs to keep for each job, or 0 to keep everything."""
+    global_config = config.get_global_config()
+    if global_config.has("state_retention"):
+        return int(global_config.get("state_retention"))
+    return DEFAULT_RETENTION
+
+
+def get_backend():
+    """Return the storage backend configured by `state_backend`."""
+    global _backend, _backend_key
+
+    global_config = config.get_global_config()
+    if global_config.has("state_backend"):
+        name = global_config.get("state_backend")
+    else:
+        name = "yaml"
+    assert name in BACKENDS, "Unknown state_backend '{name}'".format(name=name)
+
+    key = (id(global_config), name, database_path())
+    if _backend is None or _backend_key != key:
+        _backend = BACKENDS[name]()
+        _backend_key = key
+    return _backend
+
+
 class JobState(object):
-    """Manage a statefile for each job, with information about recent run
+    """Manage stored state for each job, with information about recent run
     history."""
 
-    def __init__(self, slug):
+    def __init__(self, slug, backend=None):
         self.slug = slug
         self.path = statefile_path(slug)
+        if backend is None:
+            backend = get_backend()
+        self.backend = backend
         self.history = []
         self.last_completion_status = "unknown"
         self.consecutive_failures = 0
+        # Durations of recent successful runs, see run_stats.
+        self.recent_durations = []
 
     def load(self):
+        self.backend.load(self)
+
+    def write(self):
+        # TODO: Ensure that we've called load() first, so we aren't overwriting
+        # history.
+        self.backend.write(self)
+
+    def record(self, job_run):
+        apply_run(self, job_run)
+        self.history.append(job_run)
+        self.backend.record(self, job_run)
+
+    def last_run(self):
+        """Return the most recent finished run, or None."""
+        for job_run in reversed(self.history):
+            if job_run["status"] in TERMINAL_STATUSES:
+                return job_run
+        return None
+
+    def record_started(self, start_time):
+        self.record({
+            "status": "started",
+            "time": start_time.isoformat(" "),
+        })
+
+    def record_success(self, details=None):
+        self.record_finished("completed", details)
+
+    def record_failure(self, details=None):
+        self.record_finished("failed", details)
+
+    def record_skipped(self, details=None):
+        self.record_finished("skipped", details)
+
+    def record_finished(self, status, details=None):
+        """Record the end of a run, along with optional details such as
+        duration and resource usage."""
+        job_run = {
+            "status": status,
+            "time": datetime.datetime.utcnow().isoformat(" "),
+        }
+        if details is not None:
+            job_run.update(details)
+        self.record(job_run)
+
+
+class YamlStateBackend(object):
+    """Keep each job's state in a YAML file under `state_directory`, which is
+    rewritten on every change."""
+
+    def load(self, state):
         try:
-            with open(self.path, "r") as f:
+            with open(state.path, "r") as f:
                 storage = yaml.safe_load(f)
         except IOError:
             # TODO: Might want to remove the file and stuff.
             return
 
-        self.history = storage["history"]
-        self.last_completion_status = storage["last_completion_status"]
-        self.consecutive_failures = 0
-        for job_run in self.history:
+        state.history = storage["history"]
+        state.last_completion_status = storage["last_completion_status"]
+        state.consecutive_failures = 0
+        state.recent_durations = []
+        for job_run in state.history:
             if job_run["status"] == "failed":
-                self.consecutive_failures += 1
+                state.consecutive_failures += 1
             elif job_run["status"] == "completed":
-                self.consecutive_failures = 0
+                state.consecutive_failures = 0
+                duration = run_stats.run_duration(job_run)
+                if duration is not None:
+                    run_stats.add_duration(state.recent_durations, duration)
+        # Kept separately since the history is trimmed, but older statefiles
+        # only have history.
+        if "recent_durations" in storage:
+            state.recent_durations = storage["recent_durations"]
 
-    def write(self):
-        # TODO: Ensure that we've called load() first, so we aren't overwriting
-        # history.
-        if len(self.history) > 20:
-            self.history = self.history[-20:]
+    def write(self, state):
+        keep = retention()
+        if keep > 0 and len(state.history) > keep:
+            state.history = state.history[-keep:]
 
         contents = {
-            "history": self.history,
+            "history": state.history,
         }
 
-        contents["last_completion_status"] = self.last_completion_status
+        contents["last_completion_status"] = state.last_completion_status
+        contents["recent_durations"] = state.recent_durations
 
-        with open(self.path, "w") as f:
+        with open(state.path, "w") as f:
             yaml.dump(contents, stream=f)
 
-    def record_started(self, start_time):
-        self.history.append({
-            "status": "started",
-            "time": start_time.isoformat(" "),
-        })
-        self.write()
+    def record(self, state, job_run):
+        self.write(state)
 
-    # TODO: We want job duration, etc.
-    def record_success(self):
-        self.history.append({
-            "status": "completed",
-            "time": datetime.datetime.utcnow().isoformat(" "),
-        })
-        self.last_completion_status = "success"
-        self.write()
 
-    def record_failure(self):
-        self.history.append({
-            "status": "failed",
-            "time": datetime.datetime.utcnow().isoformat(" "),
-        })
-        self.last_completion_status = "failure"
-        self.consecutive_failures += 1
-        self.write()
+class SqliteStateBackend(object):
+    """Keep the state of all jobs in a single SQLite database.
 
-    def record_skipped(self):
-        self.history.append({
-            "status": "skipped",
-            "time": datetime.datetime.utcnow().isoformat(" "),
-        })
-        self.last_completion_status = "skipped"
-        self.write()
+    Each state transition is a single-row insert, and a summary row per job
+    saves replaying history on load.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            slug TEXT NOT NULL,
+            status TEXT NOT NULL,
+            time TEXT NOT NULL,
+            details TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS runs_slug ON runs (slug, id)",
+        "CREATE INDEX IF NOT EXISTS runs_status_time ON runs (status, time)",
+        """CREATE TABLE IF NOT EXISTS jobs (
+            slug TEXT PRIMARY KEY,
+            last_completion_status TEXT NOT NULL,
+            consecutive_failures INTEGER NOT NULL,
+            recent_durations TEXT
+        )""",
+    )
+
+    def __init__(self, path=None):
+        if path is None:
+            path = database_path()
+        self.path = path
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # Connections must not be shared with forked children.
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+            self.upgrade_schema(self.connection)
+            self.pid = os.getpid()
+        return self.connection
+
+    def upgrade_schema(self, db):
+        """Add columns missing from databases created by older versions."""
+        columns = [row["name"] for row in db.execute("PRAGMA table_info(jobs)")]
+        if "recent_durations" not in columns:
+            db.execute("ALTER TABLE jobs ADD COLUMN recent_durations TEXT")
+
+    def load(self, state):
+        db = self.connect()
+        row = db.execute(
+            "SELECT last_completion_status, consecutive_failures, recent_durations FROM jobs WHERE slug = ?",
+            (state.slug, )).fetchone()
+        if row is None:
+            return
+
+        state.last_completion_status = row["last_completion_status"]
+        state.consecutive_failures = row["consecutive_failures"]
+        if row["recent_durations"] is not None:
+            state.recent_durations = json.loads(row["recent_durations"])
+        state.history = self.runs(slug=state.slug, limit=DEFAULT_RETENTION)
+
+    def write(self, state):
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self.write_summary(db, state)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def record(self, state, job_run):
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self.insert_run(db, state.slug, job_run)
+            self.write_summary(db, state)
+            if job_run["status"] != "started":
+                self.prune(db, state.slug)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def insert_run(self, db, slug, job_run):
+        details = {k: v for k, v in job_run.items() if k not in ("status", "time")}
+        db.execute(
+            "INSERT INTO runs (slug, status, time, details) VALUES (?, ?, ?, ?)",
+            (slug, job_run["status"], job_run["time"], json.dumps(details) if details else None))
+
+    def write_summary(self, db, state):
+        db.execute(
+            "INSERT OR REPLACE INTO jobs (slug, last_completion_status, consecutive_failures, recent_durations) VALUES (?, ?, ?, ?)",
+            (state.slug, state.last_completion_status, state.consecutive_failures, json.dumps(state.recent_durations)))
+
+    def prune(self, db, slug):
+        keep = retention()
+        if keep <= 0:
+            return
+        db.execute(
+            """DELETE FROM runs WHERE slug = ? AND id <= (
+                SELECT id FROM runs WHERE slug = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+            )""",
+            (slug, slug, keep))
+
+    def runs(self, slug=None, status=None, since=None, limit=None):
+        """Query run history across jobs, oldest first.
+
+        since -- only include runs at or after this datetime
+        limit -- only include this many of the most recent runs
+        """
+        clauses = []
+        params = []
+        if slug is not None:
+            clauses.append("slug = ?")
+            params.append(slug)
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        if since is not None:
+            clauses.append("time >= ?")
+            params.append(since.isoformat(" "))
+
+        query = "SELECT slug, status, time, details FROM runs"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        history = []
+        for row in self.connect().execute(query, params):
+            job_run = {
+                "status": row["status"],
+                "time": row["time"],
+            }
+            if row["details"] is not None:
+                job_run.update(json.loads(row["details"]))
+            if slug is None:
+                job_run["slug"] = row["slug"]
+            history.append(job_run)
+
+        history.reverse()
+        return history
+
+    def import_state(self, state):
+        """Copy a loaded JobState into the database, unless this job already
+        has stored state.  Returns True if anything was imported."""
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            exists = db.execute("SELECT 1 FROM jobs WHERE slug = ?", (state.slug, )).fetchone()
+            if exists is not None:
+                db.execute("ROLLBACK")
+                return False
+            for job_run in state.history:
+                self.insert_run(db, state.slug, job_run)
+            self.write_summary(db, state)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return True
+
+
+class JournalStateBackend(object):
+    """Append one line per state transition to a journal file, and
+    periodically fold the journal into a snapshot.
+
+    The snapshot carries the summary fields, so loading only has to replay
+    the journal written since the last compaction.
+    """
+
+    def __init__(self):
+        global_config = config.get_global_config()
+        if global_config.has("state_journal_max_bytes"):
+            self.max_bytes = int(global_config.get("state_journal_max_bytes"))
+        else:
+            self.max_bytes = DEFAULT_JOURNAL_MAX_BYTES
+
+    def load(self, state):
+        try:
+            journal = open(journal_path(state.slug), "r")
+        except FileNotFoundError:  # noqa: F821
+            self.read_snapshot(state)
+            return
+        with journal:
+            # Compaction replaces the snapshot before it empties the journal,
+            # so hold off until it's done, or we'd replay the journal on top
+            # of a snapshot which already includes it.
+            fcntl.flock(journal.fileno(), fcntl.LOCK_SH)
+            self.read(state, journal)
+
+    def read(self, state, journal):
+        self.read_snapshot(state)
+        for line in journal:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job_run = json.loads(line)
+            except ValueError:
+                # Most likely a torn write after a crash.
+                config.log.warning("Skipping corrupt journal entry for {slug}".format(slug=state.slug))
+                continue
+            apply_run(state, job_run)
+            state.history.append(job_run)
+
+        keep = retention()
+        if keep > 0 and len(state.history) > keep:
+            state.history = state.history[-keep:]
+
+    def read_snapshot(self, state):
+        try:
+            with open(snapshot_path(state.slug), "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:  # noqa: F821
+            return
+
+        state.history = snapshot["history"]
+        state.last_completion_status = snapshot["last_completion_status"]
+        state.consecutive_failures = snapshot["consecutive_failures"]
+        state.recent_durations = snapshot.get("recent_durations", [])
+
+    def write(self, state):
+        self.compact(state.slug)
+
+    def record(self, state, job_run):
+        line = json.dumps(job_run, separators=(",", ":")) + "\n"
+
+        fd = os.open(journal_path(state.slug), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line.encode("utf-8"))
+            if job_run["status"] in TERMINAL_STATUSES:
+                os.fsync(fd)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+        if size > self.max_bytes:
+            self.compact(state.slug)
+
+    def compact(self, slug):
+        """Fold the journal into the snapshot, then empty the journal."""
+        fd = os.open(journal_path(slug), os.O_RDWR | os.O_CREAT, 0o664)
+        try:
+            # Block appends while we compact.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            state = JobState(slug, backend=self)
+            with open(fd, "r", closefd=False) as journal:
+                self.read(state, journal)
+
+            snapshot = {
+                "history": state.history,
+                "last_completion_status": state.last_completion_status,
+                "consecutive_failures": state.consecutive_failures,
+                "recent_durations": state.recent_durations,
+            }
+            path = snapshot_path(slug)
+            temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+            with open(temp_path, "w") as f:
+                json.dump(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+
+            os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+
+def apply_run(state, job_run):
+    """Update summary fields of the state as if this run was just recorded."""
+    if job_run["status"] == "completed":
+        state.last_completion_status = "success"
+        state.consecutive_failures = 0
+        duration = run_stats.run_duration(job_run)
+        if duration is not None:
+            run_stats.add_duration(state.recent_durations, duration)
+    elif job_run["status"] == "failed":
+        state.last_completion_status = "failure"
+        state.consecutive_failures += 1
+    elif job_run["status"] == "skipped":
+        state.last_completion_status = "skipped"
+
+
+BACKENDS = {
+    "journal": JournalStateBackend,
+    "sqlite": SqliteStateBackend,
+    "yaml": YamlStateBackend,
+}
+
+
+def import_yaml_statefiles(backend=None):
+    """Import all YAML statefiles from `state_directory` into the SQLite
+    database.  Returns the names of imported jobs."""
+    if backend is None:
+        backend = SqliteStateBackend()
+
+    global_config = config.get_global_config()
+    paths = sorted(glob.glob(global_config.get("state_directory") + "/*.yaml"))
+
+    imported = []
+    for path in paths:
+        slug = os.path.basename(path).replace(".yaml", "")
+        state = JobState(slug, backend=YamlStateBackend())
+        try:
+            state.load()
+        except (KeyError, TypeError, yaml.YAMLError):
+            config.log.warning("Skipping unreadable statefile {path}".format(path=path))
+            continue
+        if backend.import_state(state):
+            imported.append(slug)
+    return imported
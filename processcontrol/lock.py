@@ -1,23 +1,135 @@
 '''
-Lockfile using a temporary file and the process id.
+Per-job lockfile, holding the process id of the running job.
 
-Self-corrects stale locks.
+Two backends are available, chosen by the global `lock_backend` setting:
+
+* "pidfile" (the default) creates the lockfile exclusively, and treats an
+  existing lockfile as stale when its process is gone.  Self-corrects stale
+  locks.
+* "flock" holds a kernel lock on the lockfile for as long as the job runs.
+  The kernel drops the lock when the holder dies, so there are no stale locks
+  to detect, and a reused process id can't keep a job locked.
+
+Both write the holder's process id into the lockfile, for status and
+--kill-job.
+
+A job may wait for the lock instead of giving up at once.  Waiters queue by
+taking a ticket, a file in the job's queue directory which they hold an flock
+on, so the tickets of dead waiters are easy to spot.  Only the oldest live
+ticket may take the lock, which serves waiters in the order they came.
+
+With the flock backend, the holder also puts up a wait file, locked for as
+long as it holds the job lock.  The first waiter blocks on it, and status
+checks probe it to see whether the job is locked.  Only attempts to take the
+lock touch the lockfile itself, so a waiter, --status or --kill-job can't
+make the job look locked to a run which doesn't wait.
 '''
+import fcntl
 import os
+import signal
+import threading
+import time
 
 from processcontrol import config
 
 
 lockfile = None
+# Descriptor holding the kernel lock, with the flock backend.
+lock_fd = None
+# Wait file put up while we hold the lock, and its descriptor.
+wait_file = None
+wait_fd = None
+
+# Seconds between attempts to take the lock, when polling.
+POLL_INTERVAL = 0.5
+# Longest we block at once waiting to be notified, so that we notice when the
+# run is aborted.
+NOTIFY_CHECK_INTERVAL = 5
+# Seconds to wait for a new flock holder to write its process id.
+PID_WRITE_WAIT = 0.1
 
 
 def path_for_job(job_name):
-    run_dir = config.GlobalConfiguration().get("run_directory")
+    run_dir = config.get_global_config().get("run_directory")
     filename = "{run_dir}/{name}.lock".format(run_dir=run_dir, name=job_name)
     return filename
 
 
-def begin(slug=None):
+def wait_path(job_name):
+    run_dir = config.get_global_config().get("run_directory")
+    return "{run_dir}/{name}.lock.wait".format(run_dir=run_dir, name=job_name)
+
+
+def backend():
+    global_config = config.get_global_config()
+    if global_config.has("lock_backend"):
+        name = global_config.get("lock_backend")
+        assert name in ("pidfile", "flock"), "Global config invalid: 'lock_backend' must be 'pidfile' or 'flock'"
+        return name
+    return "pidfile"
+
+
+def begin(slug=None, max_wait=0, strategy="poll", max_queue=1, abort=None):
+    """Take the lock for a job, waiting up to max_wait seconds for it behind
+    at most max_queue - 1 other waiters.  The "poll" strategy retries every
+    POLL_INTERVAL, and "notify" sleeps until whoever is ahead lets go.
+
+    Returns the number of seconds spent waiting, or raises LockError."""
+    if max_wait <= 0:
+        take(slug)
+        return 0
+    if not live_tickets(queue_directory(slug)):
+        try:
+            take(slug)
+            return 0
+        except LockError as ex:
+            if ex.code != LockError.LOCK_EXISTS:
+                raise
+    # Otherwise, don't jump the queue.
+
+    start = time.monotonic()
+    with Ticket(slug) as ticket:
+        if ticket.position() >= max_queue:
+            raise LockError(
+                "Skipping this job run. {count} runs are already waiting for the lock.".format(count=max_queue),
+                LockError.LOCK_EXISTS
+            )
+        config.log.info("Waiting up to {wait} seconds for the previous run to finish.".format(wait=max_wait))
+
+        while True:
+            ahead = ticket.ahead()
+            held_by = holder(slug)
+            if not ahead and (held_by is None or not held_by[1]):
+                try:
+                    take(slug)
+                    return time.monotonic() - start
+                except LockError as ex:
+                    if ex.code != LockError.LOCK_EXISTS:
+                        raise
+
+            remaining = start + max_wait - time.monotonic()
+            if remaining <= 0 or (abort is not None and abort()):
+                raise LockError(
+                    "Skipping this job run. Gave up waiting for the previous run after {wait:.0f} seconds.".format(
+                        wait=time.monotonic() - start),
+                    LockError.LOCK_EXISTS
+                )
+
+            if strategy == "notify" and (ahead or backend() == "flock"):
+                # Sleep until the waiter ahead of us, or the holder, lets go.
+                wait_for_unlock(ahead[-1] if ahead else wait_path(slug), min(remaining, NOTIFY_CHECK_INTERVAL))
+            else:
+                time.sleep(min(remaining, POLL_INTERVAL))
+
+
+def take(slug):
+    if backend() == "flock":
+        begin_flock(slug)
+    else:
+        begin_pidfile(slug)
+
+
+def begin_pidfile(slug):
     filename = path_for_job(slug)
 
     if os.path.exists(filename):
@@ -61,9 +173,239 @@ def begin(slug=None):
     lockfile = filename
 
 
+def begin_flock(slug):
+    global lockfile, lock_fd, wait_file, wait_fd
+    filename = path_for_job(slug)
+
+    while True:
+        fd = open_lockfile(filename)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise LockError(
+                "Skipping this job run. The previous job ({pid}) is still running.".format(pid=read_pid(filename)),
+                LockError.LOCK_EXISTS
+            )
+
+        # The previous holder unlinks the lockfile after unlocking it, so
+        # make sure we didn't lock a file which is already gone.
+        try:
+            if os.stat(filename).st_ino == os.fstat(fd).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    lockfile = filename
+    lock_fd = fd
+    # Show that the job is locked as soon as we can.
+    wait_file = wait_path(slug)
+    wait_fd = publish_wait_file(wait_file)
+
+    config.log.debug("Writing lockfile.")
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode("ascii"))
+
+
+def publish_wait_file(path):
+    """Put up a locked file for waiters to block on, returning its
+    descriptor.  Each holder makes a new one, locked before it appears under
+    its real name, so nobody else ever competes for its lock."""
+    temp_path = os.path.join(os.path.dirname(path), ".{name}.{pid}".format(name=os.path.basename(path), pid=os.getpid()))
+    fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o664)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    os.rename(temp_path, path)
+    return fd
+
+
+def open_lockfile(filename):
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o664)
+    # Give user and group write access, whatever our umask.
+    try:
+        os.fchmod(fd, 0o664)
+    except PermissionError:
+        # Created by another user in the group.
+        pass
+    return fd
+
+
+def is_held(filename):
+    """Test whether a process holds the kernel lock on a file.  Only use this
+    on files nobody else tries to lock, such as wait files and tickets: the
+    probe itself briefly holds a lock."""
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def wait_for_unlock(filename, timeout):
+    """Block until nobody holds an flock on the file, or the timeout passes."""
+    if threading.current_thread() is not threading.main_thread():
+        # Only the main thread gets signals, so we can't time out.
+        time.sleep(min(timeout, POLL_INTERVAL))
+        return
+
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+
+    def timed_out(signum, frame):
+        raise WaitTimeout()
+
+    previous_handler = signal.signal(signal.SIGALRM, timed_out)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+    except WaitTimeout:
+        pass
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        os.close(fd)
+
+
+def queue_directory(slug):
+    run_dir = config.get_global_config().get("run_directory")
+    return "{run_dir}/{name}.queue".format(run_dir=run_dir, name=slug)
+
+
+def live_tickets(directory, keep=None):
+    """Return the paths of tickets held by live waiters, oldest first.
+    Tickets of dead waiters are removed."""
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+
+    tickets = []
+    for name in names:
+        if name.startswith("."):
+            continue
+        path = os.path.join(directory, name)
+        if path == keep or is_held(path):
+            tickets.append(path)
+        else:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    return tickets
+
+
+class Ticket(object):
+    """A place in the queue of runs waiting for a job's lock."""
+
+    def __init__(self, slug):
+        self.directory = queue_directory(slug)
+        self.path = None
+        self.fd = None
+
+    def __enter__(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{time:020d}-{pid}".format(time=time.time_ns(), pid=os.getpid())
+        # Lock the ticket before it appears under its real name, so nobody
+        # takes it for the ticket of a dead waiter.
+        temp_path = os.path.join(self.directory, "." + name)
+        self.fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o664)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.path = os.path.join(self.directory, name)
+        os.rename(temp_path, self.path)
+        return self
+
+    def __exit__(self, *args):
+        # Unlink first, so the next waiter doesn't see our ticket once it's
+        # woken by the unlock.
+        os.unlink(self.path)
+        os.close(self.fd)
+
+    def ahead(self):
+        """Return the tickets ahead of ours, oldest first."""
+        tickets = live_tickets(self.directory, keep=self.path)
+        return tickets[:tickets.index(self.path)]
+
+    def position(self):
+        return len(self.ahead())
+
+
+def read_pid(filename):
+    """Return the process id recorded in a lockfile, or None."""
+    try:
+        with open(filename, "r") as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def holder(slug):
+    """Describe who holds a job's lock, as a tuple of the process id and
+    whether it is still running.  Returns None if the job isn't locked.  The
+    process id may be None if an flock holder is slow to write it."""
+    filename = path_for_job(slug)
+    if backend() == "flock":
+        return flock_holder(filename, wait_path(slug))
+
+    pid = read_pid(filename)
+    if pid is None:
+        return None
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return (pid, False)
+    return (pid, True)
+
+
+def flock_holder(filename, wait_file):
+    # A new holder puts up its wait file just after taking the lock, and
+    # writes its pid after that.  Give it a moment if we find its lockfile
+    # first.
+    deadline = time.monotonic() + PID_WRITE_WAIT
+    while not is_held(wait_file):
+        if not os.path.exists(filename):
+            return None
+        if time.monotonic() >= deadline:
+            # Left behind by a holder which died.
+            pid = read_pid(filename)
+            if pid is None:
+                return None
+            return (pid, False)
+        time.sleep(0.005)
+
+    pid = read_pid(filename)
+    while pid is None and time.monotonic() < deadline:
+        time.sleep(0.005)
+        pid = read_pid(filename)
+    return (pid, True)
+
+
 def end():
-    global lockfile
-    if lockfile:
+    global lockfile, lock_fd, wait_file, wait_fd
+    if lock_fd is not None:
+        config.log.debug("Clearing lockfile.")
+        # Unlink first, so that nobody reads our pid once we've let go.
+        if lockfile and os.path.exists(lockfile):
+            os.unlink(lockfile)
+        # Nobody else can put up a wait file until we let go of the lock.
+        if wait_file and os.path.exists(wait_file):
+            os.unlink(wait_file)
+        os.close(lock_fd)
+        lock_fd = None
+        # Wake the waiters once the lock is free.
+        if wait_fd is not None:
+            os.close(wait_fd)
+        wait_file = None
+        wait_fd = None
+    elif lockfile:
         if os.path.exists(lockfile):
             config.log.debug("Clearing lockfile.")
             os.unlink(lockfile)
@@ -73,6 +415,10 @@ def end():
     lockfile = None
 
 
+class WaitTimeout(Exception):
+    pass
+
+
 class LockError(RuntimeError):
     LOCK_EXISTS = 1
     ALREADY_UNLOCKED = 2
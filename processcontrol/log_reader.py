@@ -0,0 +1,242 @@
+'''
+Read job output logs by time range, for `run-job --logs`.
+
+Each log has a sidecar index mapping times to byte offsets (see
+output_streamer.LogIndex), so we can seek close to the start of a time range
+instead of reading the whole log.  Compressed logs are read through gzip,
+which still has to decompress up to the offset but skips parsing lines.
+'''
+import calendar
+import collections
+import gzip
+import os
+import time
+
+from . import log_retention
+from . import output_streamer
+
+
+# Length of the "2017-04-01 23:59:59,123" timestamp at the start of a line.
+TIMESTAMP_LENGTH = 23
+
+# Bytes read at a time when searching backwards for the last lines of a log.
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Seconds between checks for new output, when following a log.
+FOLLOW_INTERVAL = 0.5
+
+
+def parse_time(text):
+    """Parse a time given on the command line, as local time.  A bare time of
+    day means today."""
+    for time_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, time_format))
+        except ValueError:
+            pass
+    for time_format in ("%H:%M:%S", "%H:%M"):
+        try:
+            parsed = time.strptime(text, time_format)
+        except ValueError:
+            continue
+        today = time.localtime()
+        return time.mktime((today.tm_year, today.tm_mon, today.tm_mday,
+                            parsed.tm_hour, parsed.tm_min, parsed.tm_sec, 0, 0, -1))
+    raise ValueError("Can't understand the time '{text}'".format(text=text))
+
+
+def line_time(line):
+    """Return the time a log line was written, or None if it has no
+    timestamp, like the output of raw mode jobs."""
+    try:
+        stamp = line[:TIMESTAMP_LENGTH].decode("ascii")
+        seconds = time.mktime(time.strptime(stamp[:19], "%Y-%m-%d %H:%M:%S"))
+        return seconds + int(stamp[20:]) / 1000
+    except ValueError:
+        return None
+
+
+def log_start_time(path):
+    """Return the time a log was started, from its name."""
+    stamp = os.path.basename(path).split(".", 1)[0][-len("20170401-235959"):]
+    # Log names use UTC.
+    return calendar.timegm(time.strptime(stamp, "%Y%m%d-%H%M%S"))
+
+
+def read_index(path):
+    """Return a log's index entries as (time, offset) tuples in file order."""
+    entries = []
+    try:
+        with open(output_streamer.index_path(path), "r") as f:
+            for line in f:
+                try:
+                    entry_time, offset = line.split("\t")
+                    entries.append((float(entry_time), int(offset)))
+                except ValueError:
+                    # Partly written entry.
+                    continue
+    except FileNotFoundError:
+        pass
+    return sorted(entries, key=lambda entry: entry[1])
+
+
+def seek_offset(entries, since):
+    """Find where to start reading for output written at or after `since`."""
+    offset = 0
+    for entry_time, entry_offset in entries:
+        if entry_time >= since:
+            break
+        offset = entry_offset
+    return offset
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def select_logs(slug, since=None, until=None):
+    """Return the job's logs which may have output in the time range, oldest
+    first."""
+    logs = []
+    for path in reversed(log_retention.list_logs(slug)):
+        try:
+            if since is not None and os.path.getmtime(path) < since:
+                continue
+        except FileNotFoundError:
+            continue
+        if until is not None and log_start_time(path) > until:
+            continue
+        logs.append(path)
+    return logs
+
+
+def read_range(path, since=None, until=None, end=None):
+    """Generate the lines of one log written in the time range.  Stop at byte
+    offset `end` if given."""
+    with open_log(path) as f:
+        if since is not None:
+            f.seek(seek_offset(read_index(path), since))
+        position = f.tell()
+        current_time = None
+        for line in f:
+            position += len(line)
+            if end is not None and position > end:
+                return
+            stamp = line_time(line)
+            if stamp is not None:
+                current_time = stamp
+            if current_time is not None:
+                if since is not None and current_time < since:
+                    continue
+                if until is not None and current_time > until:
+                    return
+            yield line
+
+
+def tail_file(path, count, end=None):
+    """Return the last `count` lines of a log, before byte offset `end`."""
+    if path.endswith(".gz"):
+        # No way to read backwards, so decompress it all.
+        with open_log(path) as f:
+            return list(collections.deque(f, maxlen=count))
+
+    with open(path, "rb") as f:
+        if end is None:
+            end = f.seek(0, os.SEEK_END)
+        data = b""
+        position = end
+        # One more newline than lines wanted, unless we reach the start.
+        while position > 0 and data.count(b"\n") <= count:
+            block_start = max(position - TAIL_BLOCK_SIZE, 0)
+            f.seek(block_start)
+            data = f.read(position - block_start) + data
+            position = block_start
+
+    lines = data.splitlines(keepends=True)
+    return lines[-count:] if count else []
+
+
+def read_lines(slug, since=None, until=None, tail=None, ends=None):
+    """Generate lines from a job's logs, oldest first.  `ends` limits how far
+    given logs are read, by path."""
+    if ends is None:
+        ends = {}
+    logs = select_logs(slug, since, until)
+
+    if tail is not None and since is None and until is None:
+        # Read only as many of the newest logs as needed.
+        lines = []
+        for path in reversed(logs):
+            lines = tail_file(path, tail - len(lines), end=ends.get(path)) + lines
+            if len(lines) >= tail:
+                break
+        yield from lines
+        return
+
+    selected = (line for path in logs for line in read_range(path, since, until, end=ends.get(path)))
+    if tail is not None:
+        selected = collections.deque(selected, maxlen=tail)
+    yield from selected
+
+
+def show(slug, out, since=None, until=None, tail=None, follow=False):
+    """Write a job's logs to a binary stream, and optionally keep writing
+    new output as it arrives."""
+    logs = log_retention.list_logs(slug)
+    ends = {}
+    if follow and logs:
+        # Where following will pick up, so no line is written twice.
+        ends[logs[0]] = whole_lines_end(logs[0])
+
+    for line in read_lines(slug, since=since, until=until, tail=tail, ends=ends):
+        out.write(line)
+    out.flush()
+
+    if follow:
+        follow_logs(slug, out, logs[0] if logs else None, ends.get(logs[0]) if logs else 0)
+
+
+def whole_lines_end(path):
+    """Return the offset just after the last complete line of a log."""
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        position = size
+        while position > 0:
+            block_start = max(position - TAIL_BLOCK_SIZE, 0)
+            f.seek(block_start)
+            newline = f.read(position - block_start).rfind(b"\n")
+            if newline != -1:
+                return block_start + newline + 1
+            position = block_start
+    return 0
+
+
+def follow_logs(slug, out, path, position):
+    """Write output as it is added to the newest log, moving on to newer logs
+    as they are started.  Runs until interrupted."""
+    while True:
+        caught_up = True
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    f.seek(position)
+                    data = f.read()
+            except FileNotFoundError:
+                data = b""
+            # Only write whole lines.
+            end = data.rfind(b"\n") + 1
+            if end:
+                out.write(data[:end])
+                out.flush()
+                position += end
+            caught_up = end == len(data)
+
+        logs = log_retention.list_logs(slug)
+        if logs and logs[0] != path and caught_up:
+            path = logs[0]
+            position = 0
+            continue
+
+        time.sleep(FOLLOW_INTERVAL)
@@ -0,0 +1,144 @@
+'''
+Compression and pruning of job output logs.
+
+The policy comes from the global `log_retention` section, and a job can
+override any of its keys in its own `log_retention`.  Logs are compressed and
+pruned after each run, once the job lock is released, and for all jobs at once
+by `run-job --prune-logs`.
+
+The newest log of each job is never touched, since it may still be read, or
+appended to by a run which started in the same second.
+'''
+import gzip
+import os
+import shutil
+import time
+
+from . import config
+from . import output_streamer
+
+
+# Policy keys, and their values when not configured.  Zero means no limit.
+DEFAULT_POLICY = {
+    "compress": False,
+    "max_count": 0,
+    "max_age_days": 0,
+    "max_bytes": 0,
+}
+
+
+def policy_for_job(job_config=None):
+    """Merge the global retention policy with a job's overrides."""
+    policy = dict(DEFAULT_POLICY)
+    global_config = config.get_global_config()
+    if global_config.has("log_retention"):
+        policy.update(global_config.get("log_retention"))
+    if job_config is not None and job_config.has("log_retention"):
+        policy.update(job_config.get("log_retention"))
+    return policy
+
+
+def validate_policy(policy):
+    for key in policy:
+        assert key in DEFAULT_POLICY, "Invalid log_retention setting '{key}'".format(key=key)
+    for key in ("max_count", "max_age_days", "max_bytes"):
+        if key in policy:
+            assert policy[key] >= 0, "log_retention '{key}' may not be negative".format(key=key)
+
+
+def job_log_directory(slug):
+    return "{root}/{slug}".format(root=config.get_global_config().get("output_directory"), slug=slug)
+
+
+def list_logs(slug):
+    """Return the paths of a job's logs, newest first."""
+    log_directory = job_log_directory(slug)
+    try:
+        names = os.listdir(log_directory)
+    except FileNotFoundError:
+        return []
+
+    prefix = slug + "-"
+    # The timestamp in the name sorts in run order.
+    logs = [
+        name for name in names
+        if name.startswith(prefix) and (name.endswith(".log") or name.endswith(".log.gz"))
+    ]
+    logs.sort(key=lambda name: name[len(prefix):].split(".", 1)[0], reverse=True)
+    return [os.path.join(log_directory, name) for name in logs]
+
+
+def tidy_job_logs(slug, policy):
+    """Apply a retention policy to one job's logs.  Returns the number of
+    logs removed and compressed."""
+    now = time.time()
+    removed = 0
+    compressed = 0
+    total_bytes = 0
+
+    for index, path in enumerate(list_logs(slug)):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        if index > 0:
+            expired = (policy["max_count"] and index >= policy["max_count"]) \
+                or (policy["max_age_days"] and now - stat.st_mtime > policy["max_age_days"] * 86400) \
+                or (policy["max_bytes"] and total_bytes + stat.st_size > policy["max_bytes"])
+            if expired:
+                os.unlink(path)
+                try:
+                    os.unlink(output_streamer.index_path(path))
+                except FileNotFoundError:
+                    pass
+                removed += 1
+                continue
+
+            if policy["compress"] and path.endswith(".log"):
+                path = compress(path, stat)
+                stat = os.stat(path)
+                compressed += 1
+
+        total_bytes += stat.st_size
+
+    return removed, compressed
+
+
+def compress(path, stat):
+    """Gzip a logfile, keeping its modification time.  Returns the new path.
+
+    The sidecar index stays valid, since it holds offsets into the
+    uncompressed log."""
+    compressed_path = path + ".gz"
+    temp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(compressed_path))
+    with open(path, "rb") as source, gzip.open(temp_path, "wb") as destination:
+        shutil.copyfileobj(source, destination)
+    os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temp_path, compressed_path)
+    os.unlink(path)
+    return compressed_path
+
+
+def prune_all(jobs_catalog):
+    """Apply retention policies to the logs of every job, including job
+    directories left behind by jobs which no longer exist."""
+    output_directory = config.get_global_config().get("output_directory")
+    slugs = set(jobs_catalog.slugs())
+    try:
+        for name in os.listdir(output_directory):
+            if os.path.isdir(os.path.join(output_directory, name)) and not name.startswith("."):
+                slugs.add(name)
+    except FileNotFoundError:
+        pass
+
+    totals = {}
+    for slug in sorted(slugs):
+        entry = jobs_catalog.get(slug)
+        if entry is not None and entry.error is None:
+            policy = policy_for_job(entry.job_config)
+        else:
+            policy = policy_for_job()
+        validate_policy(policy)
+        totals[slug] = tidy_job_logs(slug, policy)
+    return totals
@@ -0,0 +1,106 @@
+'''
+Failmail digests.
+
+With `digest_window` set in the `failmail_spool` settings, failing jobs spool
+a failure record rather than a message.  Once the oldest waiting record is
+`digest_window` seconds old, the flusher folds all waiting records into one
+summary message per recipient, grouped by job and reason, with counts and
+first and last seen times.
+
+A job failing again for the same reason within `repeat_interval` seconds of
+being mailed about is left out of the digest, and only counted as a repeat.
+'''
+import email.mime.text
+import re
+import socket
+import time
+
+
+DEFAULT_REPEAT_INTERVAL = 3600
+
+
+def reason_key(reason):
+    """Group reasons which differ only in numbers, like pids and exit codes
+    from the same cause."""
+    return re.sub(r"[0-9]+", "#", reason)
+
+
+def format_time(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+def build(records, state, now, repeat_interval):
+    """Summarize failure records, returning (from, to, message) tuples and
+    the updated record of when each job and reason was last mailed about."""
+    state = {key: mailed for key, mailed in state.items() if mailed + repeat_interval > now}
+
+    # (from, to) -> (job slug, reason key) -> group
+    digests = {}
+    for entry in records:
+        groups = digests.setdefault((entry["from"], entry["to"]), {})
+        group = groups.setdefault((entry["job"], reason_key(entry["reason"])), {
+            "name": entry["name"],
+            "reason": entry["reason"],
+            "count": 0,
+            "first_seen": entry["time"],
+            "last_seen": entry["time"],
+            "logfile": None,
+            "summary": None,
+            "tail": None,
+        })
+        group["count"] += 1
+        group["first_seen"] = min(group["first_seen"], entry["time"])
+        if entry["time"] >= group["last_seen"]:
+            group["last_seen"] = entry["time"]
+            group["reason"] = entry["reason"]
+            group["logfile"] = entry.get("logfile")
+            group["summary"] = entry.get("summary")
+            group["tail"] = entry.get("tail")
+
+    messages = []
+    for (from_address, to_address), groups in sorted(digests.items()):
+        mailed = {}
+        repeats = {}
+        for (slug, key), group in sorted(groups.items()):
+            state_key = "{job}\t{reason}".format(job=slug, reason=key)
+            if state_key in state:
+                repeats[slug] = repeats.get(slug, 0) + group["count"]
+            else:
+                mailed[slug, key] = group
+                state[state_key] = now
+        if mailed:
+            messages.append((from_address, to_address, digest_message(from_address, to_address, mailed, repeats)))
+
+    return messages, state
+
+
+def digest_message(from_address, to_address, groups, repeats):
+    """Format a digest of failures grouped by (job, reason)."""
+    jobs = sorted({slug for slug, _ in groups})
+    failure_count = sum(group["count"] for group in groups.values())
+
+    lines = []
+    for (slug, _), group in sorted(groups.items(), key=lambda item: item[1]["first_seen"]):
+        lines.append("{name} ({job}): {reason}".format(name=group["name"], job=slug, reason=group["reason"]))
+        lines.append("    {count} failure(s), first {first}, last {last}".format(
+            count=group["count"], first=format_time(group["first_seen"]), last=format_time(group["last_seen"])))
+        if group["summary"] is not None:
+            lines.append("    Latest run: {summary}".format(summary=group["summary"]))
+        if group["logfile"] is not None:
+            lines.append("    Latest log: {logfile}".format(logfile=group["logfile"]))
+        if group["tail"]:
+            lines.append("    Last lines of output:")
+            lines.extend("        " + line for line in group["tail"])
+        lines.append("")
+    if repeats:
+        lines.append("Also failing again for reasons already reported: {jobs}".format(
+            jobs=", ".join("{job} ({count})".format(job=slug, count=count) for slug, count in sorted(repeats.items()))))
+
+    msg = email.mime.text.MIMEText("\n".join(lines))
+    msg["Subject"] = "Fail Mail ({host}) run-job: {count} failure(s) of {jobs}".format(
+        host=socket.gethostname(),
+        count=failure_count,
+        jobs=", ".join(jobs))
+    msg["From"] = from_address
+    msg["To"] = to_address
+    return msg.as_string()
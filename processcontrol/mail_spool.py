@@ -0,0 +1,218 @@
+'''
+Spool directory for failmail.
+
+When `failmail_spool` is configured, the runner only writes each failmail to
+a file in the spool directory, and a flusher sends everything waiting over a
+single SMTP connection.  The flusher runs from `run-job --flush-mail`, or
+every minute under `run-job --daemon`.  Messages which can't be sent are
+retried with exponential backoff, and set aside in the `failed`
+subdirectory after too many attempts.
+
+With `digest_window` set, failures are spooled as records instead, and
+summarized by mail_digest when the flusher runs.
+'''
+import fcntl
+import json
+import os
+import smtplib
+import time
+import uuid
+
+from . import config
+from . import mail_digest
+
+
+DEFAULT_MAX_ATTEMPTS = 10
+# Seconds before the first retry, doubled after each failed attempt.
+DEFAULT_RETRY_INTERVAL = 60
+# Seconds to wait on the mail server before giving up on this pass.
+SMTP_TIMEOUT = 30
+
+# File in the spool directory remembering when each job and reason was last
+# included in a digest.
+DIGEST_STATE_FILE = ".digest-state.json"
+
+
+def spool_settings():
+    """Return the spool configuration, or None if failmail isn't spooled."""
+    global_config = config.get_global_config()
+    if not global_config.has("failmail_spool"):
+        return None
+    settings = global_config.get("failmail_spool")
+    assert "directory" in settings, "Global config invalid: 'failmail_spool' needs a 'directory'"
+    return settings
+
+
+def spool(from_address, to_address, message):
+    """Queue a message for the flusher.  Only writes a file."""
+    write_entry(new_entry_path(), {
+        "from": from_address,
+        "to": to_address,
+        "message": message,
+        "attempts": 0,
+        "next_attempt": 0,
+    })
+
+
+def spool_failure(from_address, to_address, slug, name, reason, logfile=None, summary=None, tail=None):
+    """Queue a job failure for the next digest."""
+    write_entry(new_entry_path(), {
+        "kind": "failure",
+        "from": from_address,
+        "to": to_address,
+        "job": slug,
+        "name": name,
+        "reason": reason,
+        "logfile": logfile,
+        "summary": summary,
+        "tail": tail,
+        "time": time.time(),
+    })
+
+
+def new_entry_path():
+    """Return a unique spool file path, which sorts in the order written."""
+    return os.path.join(spool_settings()["directory"], "{time:.6f}-{id}.json".format(time=time.time(), id=uuid.uuid4().hex))
+
+
+def write_entry(path, entry):
+    """Write a spool file atomically, so the flusher never sees half of it."""
+    temp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    with open(temp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(temp_path, path)
+
+
+def pending(directory):
+    """Return the paths of spooled messages, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names) if name.endswith(".json") and not name.startswith(".")]
+
+
+def flush():
+    """Send every message which is due.  Returns the number sent, or None if
+    another flusher is already running."""
+    settings = spool_settings()
+    if settings is None:
+        return 0
+    directory = settings["directory"]
+
+    lock_fd = os.open(os.path.join(directory, ".flush.lock"), os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        if settings.get("digest_window"):
+            collect_digests(settings)
+        return Flusher(settings).flush(pending(directory))
+    finally:
+        os.close(lock_fd)
+
+
+def collect_digests(settings, now=None):
+    """Replace waiting failure records with digest messages, once the oldest
+    has waited for the digest window."""
+    if now is None:
+        now = time.time()
+    directory = settings["directory"]
+
+    records = {}
+    for path in pending(directory):
+        with open(path, "r") as f:
+            entry = json.load(f)
+        if entry.get("kind") == "failure":
+            records[path] = entry
+    if not records or min(entry["time"] for entry in records.values()) + settings["digest_window"] > now:
+        return
+
+    state_path = os.path.join(directory, DIGEST_STATE_FILE)
+    try:
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+
+    messages, state = mail_digest.build(
+        records.values(), state, now, settings.get("repeat_interval", mail_digest.DEFAULT_REPEAT_INTERVAL))
+    for from_address, to_address, message in messages:
+        spool(from_address, to_address, message)
+    write_entry(state_path, state)
+    for path in records:
+        os.unlink(path)
+
+
+class Flusher(object):
+
+    def __init__(self, settings):
+        self.directory = settings["directory"]
+        self.max_attempts = settings.get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+        self.retry_interval = settings.get("retry_interval", DEFAULT_RETRY_INTERVAL)
+        self.connection = None
+
+    def flush(self, paths):
+        sent = 0
+        now = time.time()
+        try:
+            for path in paths:
+                with open(path, "r") as f:
+                    entry = json.load(f)
+                if entry.get("kind") == "failure" or entry["next_attempt"] > now:
+                    # Waiting for a digest, or a retry.
+                    continue
+
+                try:
+                    self.send(entry)
+                except OSError as ex:
+                    self.defer(path, entry, ex, now)
+                    if self.connection is None:
+                        # The server is unreachable, so don't hammer it.
+                        break
+                    continue
+
+                os.unlink(path)
+                sent += 1
+        finally:
+            self.close()
+        return sent
+
+    def send(self, entry):
+        if self.connection is None:
+            self.connection = smtplib.SMTP("localhost", timeout=SMTP_TIMEOUT)
+        try:
+            self.connection.sendmail(entry["from"], entry["to"], entry["message"])
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # Only this message was refused.
+            raise
+        except OSError:
+            # Includes other SMTP errors.  Start over with a new connection
+            # next time.
+            self.close()
+            raise
+
+    def defer(self, path, entry, error, now):
+        entry["attempts"] += 1
+        entry["last_error"] = str(error)
+        if entry["attempts"] >= self.max_attempts:
+            config.log.error("Giving up on failmail {path} after {attempts} attempts: {error}".format(
+                path=path, attempts=entry["attempts"], error=error))
+            failed_directory = os.path.join(self.directory, "failed")
+            os.makedirs(failed_directory, exist_ok=True)
+            write_entry(os.path.join(failed_directory, os.path.basename(path)), entry)
+            os.unlink(path)
+            return
+
+        entry["next_attempt"] = now + self.retry_interval * 2 ** (entry["attempts"] - 1)
+        config.log.warning("Could not send failmail {path}, will retry: {error}".format(path=path, error=error))
+        write_entry(path, entry)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
@@ -2,6 +2,8 @@ from email.mime.text import MIMEText
 import smtplib
 import socket
 
+from . import mail_spool
+
 
 class Mailer(object):
     def __init__(self, job):
@@ -13,14 +15,22 @@ class Mailer(object):
         # the mail before exiting.
         self.sent_fail_mail = False
 
-    def fail_mail(self, subject, logfile=None):
-        if logfile is not None:
-            body = "See the logs for more information: {logfile}".format(logfile=logfile)
-        else:
-            body = "No details available."
+    def fail_mail(self, subject, logfile=None, details=None, tail=None):
+        """Mail about a failed run.  `details` are the run details stored in
+        the job history, and `tail` the last lines of output."""
         if self.sent_fail_mail:
             return
 
+        settings = mail_spool.spool_settings()
+        if settings is not None and settings.get("digest_window"):
+            # The flusher will mail a digest of all failures.
+            mail_spool.spool_failure(
+                self.from_address, self.to_address, self.job.slug, self.job.name, subject,
+                logfile=logfile, summary=run_summary(details), tail=tail)
+            self.sent_fail_mail = True
+            return
+
+        body = failure_body(logfile, details, tail)
         msg = MIMEText(body)
 
         msg["Subject"] = "Fail Mail ({host}) run-job: {subject}".format(
@@ -30,12 +40,48 @@ class Mailer(object):
         msg["From"] = self.from_address
         msg["To"] = self.to_address
 
-        mailer = smtplib.SMTP("localhost")
-        mailer.sendmail(
-            self.from_address,
-            self.to_address,
-            msg.as_string()
-        )
-        mailer.quit()
+        if settings is not None:
+            # Leave the sending to the flusher, so a slow mail server can't
+            # hold up the job.
+            mail_spool.spool(self.from_address, self.to_address, msg.as_string())
+        else:
+            mailer = smtplib.SMTP("localhost")
+            mailer.sendmail(
+                self.from_address,
+                self.to_address,
+                msg.as_string()
+            )
+            mailer.quit()
         # only send one failmail per instance
         self.sent_fail_mail = True
+
+
+def run_summary(details):
+    """Describe how a run ended, from its run details."""
+    if details is None:
+        return None
+    parts = []
+    if "signal" in details:
+        parts.append("Killed by {signal}".format(signal=details["signal"]))
+    elif "exit_code" in details:
+        parts.append("Exit code {code}".format(code=details["exit_code"]))
+    if "duration" in details:
+        parts.append("after {duration:.1f} seconds".format(duration=details["duration"]))
+    return " ".join(parts) or None
+
+
+def failure_body(logfile, details, tail):
+    lines = []
+    summary = run_summary(details)
+    if summary is not None:
+        lines.append(summary + ".")
+        lines.append("")
+    if tail:
+        lines.append("Last lines of output:")
+        lines.extend("    " + line for line in tail)
+        lines.append("")
+    if logfile is not None:
+        lines.append("See the logs for more information: {logfile}".format(logfile=logfile))
+    if not lines:
+        lines.append("No details available.")
+    return "\n".join(lines)
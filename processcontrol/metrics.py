@@ -0,0 +1,129 @@
+'''
+Job metrics for the node_exporter textfile collector.
+
+Each job has its own .prom file in `metrics_directory`, which is rewritten
+atomically at the end of every run.  Counters are carried over from the
+previous version of the same file, so no other job state is read.  Runs of
+the same job can finish together, so the update is made holding an flock on
+a `.lock` file next to the textfile.
+'''
+import fcntl
+import os
+import time
+
+from . import config
+
+
+# Metric name, type and help text, in output order.
+METRICS = (
+    ("process_control_job_last_run_timestamp_seconds", "gauge", "Time the last run of the job finished."),
+    ("process_control_job_last_success_timestamp_seconds", "gauge", "Time the last successful run of the job finished."),
+    ("process_control_job_last_duration_seconds", "gauge", "Wall-clock duration of the last run."),
+    ("process_control_job_last_output_bytes", "gauge", "Bytes of output from the last run."),
+    ("process_control_job_consecutive_failures", "gauge", "Number of failed runs since the last success."),
+    ("process_control_job_runs_total", "counter", "Finished runs, by status."),
+    ("process_control_job_output_bytes_total", "counter", "Bytes of output from all runs."),
+    ("process_control_job_lock_contention_total", "counter", "Runs which found the previous run still holding the lock."),
+)
+
+
+def metrics_path(slug):
+    """Return the textfile path for a job, or None if metrics are disabled."""
+    global_config = config.get_global_config()
+    if not global_config.has("metrics_directory"):
+        return None
+    return "{root}/process_control_{job}.prom".format(
+        root=global_config.get("metrics_directory"),
+        job=slug)
+
+
+def record_run(slug, job_run, consecutive_failures, output_bytes=0, lock_contention=False):
+    """Update the job's metrics with a finished run from its history."""
+    path = metrics_path(slug)
+    if path is None:
+        return
+
+    lock_fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT, 0o664)
+    try:
+        # Don't lose another run's increments between reading and replacing
+        # the textfile.
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        update_samples(path, slug, job_run, consecutive_failures, output_bytes, lock_contention)
+    finally:
+        os.close(lock_fd)
+
+
+def update_samples(path, slug, job_run, consecutive_failures, output_bytes, lock_contention):
+    samples = read_samples(path)
+    now = time.time()
+
+    samples[("process_control_job_last_run_timestamp_seconds", None)] = now
+    if job_run["status"] == "completed":
+        samples[("process_control_job_last_success_timestamp_seconds", None)] = now
+    if "duration" in job_run:
+        samples[("process_control_job_last_duration_seconds", None)] = job_run["duration"]
+    samples[("process_control_job_last_output_bytes", None)] = output_bytes
+    samples[("process_control_job_consecutive_failures", None)] = consecutive_failures
+
+    increment(samples, "process_control_job_runs_total", job_run["status"])
+    increment(samples, "process_control_job_output_bytes_total", amount=output_bytes)
+    if lock_contention:
+        increment(samples, "process_control_job_lock_contention_total")
+
+    write_samples(path, slug, samples)
+
+
+def increment(samples, name, status=None, amount=1):
+    key = (name, status)
+    samples[key] = samples.get(key, 0) + amount
+
+
+def read_samples(path):
+    """Parse our own previous textfile into a dict keyed by metric name and
+    status label."""
+    samples = {}
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()
+    except FileNotFoundError:  # noqa: F821
+        return samples
+
+    for line in lines:
+        if line.startswith("#") or not line.strip():
+            continue
+        metric, value = line.rsplit(" ", 1)
+        name = metric.split("{", 1)[0]
+        status = None
+        if 'status="' in metric:
+            status = metric.split('status="', 1)[1].split('"', 1)[0]
+        samples[(name, status)] = float(value)
+    return samples
+
+
+def write_samples(path, slug, samples):
+    lines = []
+    for name, metric_type, help_text in METRICS:
+        keys = sorted((key for key in samples if key[0] == name), key=lambda key: key[1] or "")
+        if not keys:
+            continue
+        lines.append("# HELP {name} {help}\n".format(name=name, help=help_text))
+        lines.append("# TYPE {name} {type}\n".format(name=name, type=metric_type))
+        for key in keys:
+            labels = 'job="{job}"'.format(job=slug)
+            if key[1] is not None:
+                labels += ',status="{status}"'.format(status=key[1])
+            lines.append("{name}{{{labels}}} {value}\n".format(
+                name=name, labels=labels, value=format_value(samples[key])))
+
+    # The collector only reads *.prom files, so the temporary file is ignored
+    # until it's renamed into place.
+    temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    with open(temp_path, "w") as f:
+        f.writelines(lines)
+    os.replace(temp_path, path)
+
+
+def format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -1,17 +1,39 @@
-import logging
-import logging.config
+import collections
 import os
+import selectors
 import sys
 import threading
+import time
 
 from . import config
 
 
+# Bytes to read from a pipe at a time.
+CHUNK_SIZE = 64 * 1024
+
+# Longest line we buffer, unless the job sets `output_max_line_length`.
+DEFAULT_MAX_LINE_LENGTH = 64 * 1024
+
+# A sidecar index entry is written at least this often, in seconds or lines
+# of output, see LogIndex.
+INDEX_INTERVAL = 1.0
+INDEX_LINES = 1000
+
+# Lines of output kept for failmail, unless the job sets
+# `failmail/tail_lines`, and the longest line kept.
+DEFAULT_TAIL_LINES = 20
+TAIL_LINE_LENGTH = 1000
+
+# Appended to the pieces of a line which was split or truncated.
+SPLIT_MARKER = b" [line split]"
+TRUNCATE_MARKER = b" [line truncated]"
+
+
 def make_logfile_path(slug, start_time):
     """
     Makes the output file path and creates parent directory if needed
     """
-    output_directory = config.GlobalConfiguration().get("output_directory")
+    output_directory = config.get_global_config().get("output_directory")
     assert os.access(output_directory, os.W_OK), "Make sure directory '{path}' exists and is writable".format(path=output_directory)
 
     # per-job directory
@@ -23,82 +45,412 @@ def make_logfile_path(slug, start_time):
     return "{logdir}/{name}-{timestamp}.log".format(logdir=job_log_directory, name=slug, timestamp=timestamp)
 
 
+def format_timestamp(now):
+    """Format a time the way logging formats %(asctime)s."""
+    return "{time},{msecs:03d}".format(
+        time=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+        msecs=int(now * 1000) % 1000)
+
+
+def utf8_boundary(data, position):
+    """Move a cut position back so it doesn't split a UTF-8 character."""
+    limit = max(position - 3, 1)
+    while position > limit and data[position] & 0xC0 == 0x80:
+        position -= 1
+    return position
+
+
+def index_path(log_path):
+    """Return the path of the sidecar index for a log, which is the same
+    whether or not the log has been compressed."""
+    if log_path.endswith(".gz"):
+        log_path = log_path[:-len(".gz")]
+    return log_path + ".idx"
+
+
+def format_lines(lines, level, prefix, now):
+    """Format log lines as "<time>\t<INFO or ERROR>\t<prefix><line>"."""
+    header = "{time}\t{level}\t{prefix}".format(
+        time=format_timestamp(now), level=level, prefix=prefix)
+    return "".join(header + line + "\n" for line in lines).encode("utf-8")
+
+
+class LogIndex(object):
+    """Sparse index of a logfile, with one "<unix time>\t<byte offset>" line
+    for every INDEX_INTERVAL seconds or INDEX_LINES lines of output.
+
+    Each entry is the start of a batch of lines logged at that time, so
+    readers can seek to a time without parsing the whole log.
+    """
+
+    def __init__(self, log_path):
+        self.file = open(index_path(log_path), "ab", buffering=0)
+        self.last_time = None
+        self.lines_since = 0
+
+    def add(self, now, offset, line_count):
+        if self.last_time is None or now - self.last_time >= INDEX_INTERVAL or self.lines_since >= INDEX_LINES:
+            # Milliseconds, truncated like the timestamps in the log.
+            self.file.write("{time}.{msecs:03d}\t{offset}\n".format(
+                time=int(now), msecs=int(now * 1000) % 1000, offset=offset).encode("ascii"))
+            self.last_time = now
+            self.lines_since = 0
+        self.lines_since += line_count
+
+    def close(self):
+        self.file.close()
+
+
+def write_indexed(logfile, index, lines, level, prefix):
+    """Append a batch of lines to a logfile opened for unbuffered appending,
+    and index it."""
+    now = time.time()
+    batch = format_lines(lines, level, prefix, now)
+    logfile.write(batch)
+    # We're appending, so the position is now the end of our batch.
+    index.add(now, logfile.tell() - len(batch), len(lines))
+
+
+class OutputTail(object):
+    """The last lines of output from a job run, shared between its
+    commands.  Memory use is bounded by the number and length of lines."""
+
+    def __init__(self, max_lines):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+
+    def add(self, lines, level, prefix):
+        with self.lock:
+            for line in lines[-self.lines.maxlen:]:
+                if len(line) > TAIL_LINE_LENGTH:
+                    line = line[:TAIL_LINE_LENGTH] + " [...]"
+                self.lines.append("{level}\t{prefix}{line}".format(level=level, prefix=prefix, line=line))
+
+    def get(self):
+        with self.lock:
+            return list(self.lines)
+
+
+class OutputBudget(object):
+    """Bytes of output a job run may still log, shared between its
+    commands."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.remaining = max_bytes
+        self.lock = threading.Lock()
+
+    def take(self, count):
+        """Use up to count bytes of the budget, and return how many we got."""
+        with self.lock:
+            granted = min(count, self.remaining)
+            self.remaining -= granted
+            return granted
+
+
 class OutputStreamer(object):
+    """Copy a process's stdout and stderr into its logfile.
+
+    Both pipes are read in large chunks by a single thread, which splits the
+    chunks into lines and writes each batch of lines with one timestamp.
+    Lines are formatted as "<time>\t<INFO or ERROR>\t<line>".
+
+    Memory use is bounded: lines longer than max_line_length are split or
+    truncated, and once the optional budget runs out further output is
+    discarded and on_limit is called.  Likewise, on_idle is called if nothing
+    is read for idle_timeout seconds.
+    """
 
-    def __init__(self, process, slug, cmdline, start_time):
+    def __init__(self, process, slug, cmdline, start_time, step=None,
+                 max_line_length=DEFAULT_MAX_LINE_LENGTH, long_lines="split", budget=None, on_limit=None, tail=None,
+                 resources=None, idle_timeout=0, on_idle=None):
         self.out_stream = process.stdout
         self.err_stream = process.stderr
         self.pid = process.pid
         self.slug = slug
         self.cmdline = cmdline
+        # Description of the effective resource limits, for the header.
+        self.resources = resources
+        # Steps of a job can run at the same time, so their output lines are
+        # labelled with the step name.
+        self.step = step
+        if step is not None:
+            self.prefix = "[{step}] ".format(step=step)
+        else:
+            self.prefix = ""
         self.filename = make_logfile_path(slug, start_time)
-        self.logger = None
-        self.threads = {}
-        self.log_handlers = []
+        self.logfile = None
+        self.index = None
+        self.mirror = sys.stdout.isatty()
+        self.thread = None
+        # Pipe for telling the reader thread to stop early.
+        self.wake_read = None
+        self.wake_write = None
+        # Bytes read from stdout and stderr.
+        self.stream_bytes = {False: 0, True: 0}
+
+        self.max_line_length = max_line_length
+        self.long_lines = long_lines
+        self.budget = budget
+        self.on_limit = on_limit
+        self.limit_reached = False
+        # Seconds without output before on_idle is called, or 0 for no limit.
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.idle_reached = False
+        self.last_output = None
+        # Recent output for failmail, if wanted.
+        self.tail = tail
+        # Incomplete last line read from each stream.
+        self.partial = {False: b"", True: b""}
+        # Whether we're dropping the rest of a truncated line.
+        self.discarding = {False: False, True: False}
 
     def start(self):
-        self.init_logger()
+        # Unbuffered, so that each batch is a single append.  Concurrent steps
+        # share the logfile, and must not split each other's lines.
+        self.logfile = open(self.filename, "ab", buffering=0)
+        self.index = LogIndex(self.filename)
 
         self.log_header()
 
-        self.start_reading(self.out_stream, "stdout")
-        self.start_reading(self.err_stream, "stderr", is_error_stream=True)
+        self.wake_read, self.wake_write = os.pipe()
+        self.last_output = time.monotonic()
+        self.thread = threading.Thread(target=self.read_streams)
+        self.thread.daemon = True
+        self.thread.start()
 
     def log_header(self):
         # TODO: maybe expose the header as a configurable template.
-        self.logger.info("===========")
-        self.logger.info("{cmdline} ({pid})".format(cmdline=self.cmdline, pid=self.pid))
-        self.logger.info("-----------")
-
-    def start_reading(self, stream, stream_name, is_error_stream=False):
-        thread = threading.Thread(
-            target=self.read_lines,
-            args=(stream, ),
-            kwargs={"is_error_stream": is_error_stream}
-        )
-        thread.daemon = True
-        thread.start()
-        self.threads[stream_name] = thread
-
-    def read_lines(self, stream, is_error_stream=False):
-        while True:
-            line = stream.readline().decode("utf-8", "replace")
-            if line == "":
-                break
-            line = line.rstrip("\n")
-            # FIXME: formatters do formatting
-            if is_error_stream:
-                self.logger.error(line)
+        lines = ["==========="]
+        if self.step is not None:
+            lines.append("step {step}".format(step=self.step))
+        lines.append("{cmdline} ({pid})".format(cmdline=self.cmdline, pid=self.pid))
+        if self.resources is not None:
+            lines.append(self.resources)
+        lines.append("-----------")
+        self.write_lines(lines, "INFO")
+
+    def read_streams(self):
+        """Read both pipes until they are closed, or until woken by stop()."""
+        selector = selectors.DefaultSelector()
+        selector.register(self.out_stream, selectors.EVENT_READ, False)
+        selector.register(self.err_stream, selectors.EVENT_READ, True)
+        selector.register(self.wake_read, selectors.EVENT_READ, None)
+
+        woken = False
+        while len(selector.get_map()) > 1 and not woken:
+            events = selector.select(self.idle_wait())
+            if not events and self.idle_wait() == 0:
+                self.reach_idle_timeout()
+            for key, _ in events:
+                is_error_stream = key.data
+                if is_error_stream is None:
+                    woken = True
+                    continue
+                data = os.read(key.fd, CHUNK_SIZE)
+                if data:
+                    self.feed(data, is_error_stream)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    self.finish(is_error_stream)
+
+        # Pipes still held open by leftover processes.
+        for key in list(selector.get_map().values()):
+            if key.data is not None:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                self.finish(key.data)
+
+        selector.close()
+
+    def feed(self, data, is_error_stream):
+        """Log a chunk of output from one of the pipes."""
+        self.stream_bytes[is_error_stream] += len(data)
+        self.last_output = time.monotonic()
+
+        if self.budget is not None:
+            if self.limit_reached:
+                return
+            granted = self.budget.take(len(data))
+            if granted < len(data):
+                data = data[:granted]
+                self.reach_limit()
+
+        if self.discarding[is_error_stream]:
+            end = data.find(b"\n")
+            if end == -1:
+                return
+            self.discarding[is_error_stream] = False
+            data = data[end + 1:]
+
+        data = self.partial[is_error_stream] + data
+        end = data.rfind(b"\n")
+        if end != -1:
+            self.write_chunk(data[:end], is_error_stream)
+            data = data[end + 1:]
+
+        # Don't let an endless line eat our memory.
+        while len(data) > self.max_line_length:
+            cut = utf8_boundary(data, self.max_line_length)
+            if self.long_lines == "truncate":
+                self.write_piece(data[:cut] + TRUNCATE_MARKER, is_error_stream)
+                self.discarding[is_error_stream] = True
+                data = b""
             else:
-                self.logger.info(line)
+                self.write_piece(data[:cut] + SPLIT_MARKER, is_error_stream)
+                data = data[cut:]
+
+        self.partial[is_error_stream] = data
+
+    def finish(self, is_error_stream):
+        """Log whatever is left once a pipe is closed."""
+        if self.partial[is_error_stream]:
+            self.write_chunk(self.partial[is_error_stream], is_error_stream)
+            self.partial[is_error_stream] = b""
+
+    def reach_limit(self):
+        self.limit_reached = True
+        self.write_lines(["[output limit of {limit} bytes reached, discarding further output]".format(
+            limit=self.budget.max_bytes)], "ERROR")
+        if self.on_limit is not None:
+            self.on_limit()
+
+    def idle_wait(self):
+        """Return the seconds left before the process counts as idle, or None
+        if we're not watching for that."""
+        if not self.idle_timeout or self.idle_reached:
+            return None
+        return max(self.last_output + self.idle_timeout - time.monotonic(), 0)
 
-    def init_logger(self):
-        if self.logger is not None:
-            return
+    def reach_idle_timeout(self):
+        self.idle_reached = True
+        self.write_lines(["[no output for {idle} seconds]".format(idle=self.idle_timeout)], "ERROR")
+        if self.on_idle is not None:
+            self.on_idle()
 
-        self.logger = logging.getLogger(self.slug)
-        self.logger.setLevel(logging.INFO)
+    def write_chunk(self, data, is_error_stream):
+        if len(data) > self.max_line_length:
+            data = b"\n".join(self.limit_lines(data.split(b"\n")))
+        # Only split on newlines, so multibyte characters are never cut.
+        lines = data.decode("utf-8", "replace").split("\n")
+        self.write_output(lines, is_error_stream)
 
-        log_file_handler = logging.FileHandler(self.filename)
-        formatter = logging.Formatter("%(asctime)s\t%(levelname)s\t%(message)s")
-        log_file_handler.setFormatter(formatter)
+    def write_piece(self, data, is_error_stream):
+        """Write a single line which has already been limited."""
+        self.write_output([data.decode("utf-8", "replace")], is_error_stream)
 
-        self.log_handlers.append(log_file_handler)
-        self.logger.addHandler(log_file_handler)
+    def write_output(self, lines, is_error_stream):
+        level = "ERROR" if is_error_stream else "INFO"
+        if self.tail is not None:
+            self.tail.add(lines, level, self.prefix)
+        self.write_lines(lines, level)
 
-        if sys.stdout.isatty():
+    def limit_lines(self, lines):
+        """Split or truncate any lines which are too long."""
+        limited = []
+        for line in lines:
+            while len(line) > self.max_line_length:
+                cut = utf8_boundary(line, self.max_line_length)
+                if self.long_lines == "truncate":
+                    limited.append(line[:cut] + TRUNCATE_MARKER)
+                    line = None
+                    break
+                limited.append(line[:cut] + SPLIT_MARKER)
+                line = line[cut:]
+            if line is not None:
+                limited.append(line)
+        return limited
+
+    def write_lines(self, lines, level):
+        write_indexed(self.logfile, self.index, lines, level, self.prefix)
+
+        if self.mirror:
             # Mirror to the console if run interactively.
-            console_handler = logging.StreamHandler(sys.stdout)
-            self.log_handlers.append(console_handler)
-            self.logger.addHandler(console_handler)
+            sys.stdout.write("".join(self.prefix + line + "\n" for line in lines))
+            sys.stdout.flush()
+
+    @property
+    def bytes_read(self):
+        return sum(self.stream_bytes.values())
+
+    def drain(self, timeout):
+        """Wait for the pipes to be closed.  Returns False if they're still
+        open after timeout seconds, which means the command left processes
+        behind which still hold them."""
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def stop(self):
+        """Finish logging, without waiting for pipes which are still open."""
+        if self.thread is not None:
+            if self.thread.is_alive():
+                os.write(self.wake_write, b"\0")
+            self.thread.join()
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+        self.write_lines(["----------- end command output"], "INFO")
+        self.logfile.close()
+        self.index.close()
+
+
+class RawOutput(object):
+    """Let a process write straight into its logfile.
+
+    The logfile is passed to the child as its stdout and stderr, so output
+    never goes through our process and isn't timestamped, split or limited.
+    Only the header and footer lines are written by us.  The header is
+    written before the process exists, so its pid goes in the footer.
+    """
+
+    def __init__(self, slug, cmdline, start_time, step=None, resources=None):
+        self.slug = slug
+        self.cmdline = cmdline
+        self.resources = resources
+        self.step = step
+        self.filename = make_logfile_path(slug, start_time)
+        self.logfile = None
+        self.index = None
+        self.pid = None
+        self.start_size = 0
+        self.header_size = 0
+        # Limits are not enforced in raw mode.
+        self.limit_reached = False
+        self.bytes_read = 0
+
+    def start(self):
+        # Appending, so that concurrent steps don't overwrite each other.
+        self.logfile = open(self.filename, "ab", buffering=0)
+        self.index = LogIndex(self.filename)
+        self.start_size = os.fstat(self.logfile.fileno()).st_size
+
+        lines = ["==========="]
+        if self.step is not None:
+            lines.append("step {step}".format(step=self.step))
+        lines.append(self.cmdline)
+        if self.resources is not None:
+            lines.append(self.resources)
+        lines.append("-----------")
+        write_indexed(self.logfile, self.index, lines, "INFO", "")
+        self.header_size = self.logfile.tell() - self.start_size
+
+    def fileno(self):
+        return self.logfile.fileno()
+
+    def attach(self, process):
+        self.pid = process.pid
+
+    def drain(self, timeout):
+        # Nothing to read.
+        return True
 
     def stop(self):
-        for thread in self.threads.values():
-            thread.join()
-        self.logger.info("----------- end command output")
-
-        # FIXME: sorry, I don't know what else to do.  If we keep adding file
-        # handlers, we're in hot soup.
-        for handler in self.log_handlers:
-            self.logger.removeHandler(handler)
-        self.log_handlers = []
+        # Approximate when steps share the logfile, since their output is
+        # counted too.
+        self.bytes_read = max(os.fstat(self.logfile.fileno()).st_size - self.start_size - self.header_size, 0)
+        write_indexed(self.logfile, self.index, ["----------- end command output ({pid})".format(pid=self.pid)], "INFO", "")
+        self.logfile.close()
+        self.index.close()
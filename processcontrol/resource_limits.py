@@ -0,0 +1,143 @@
+'''
+Resource limits and scheduling priority for job commands.
+
+The settings come from the global `resources` section, and a job can override
+any of its keys in its own `resources`.  They are applied by running the
+command under `prlimit`, `nice`, `ionice` and `taskset` from util-linux and
+coreutils, each of which sets one thing and execs the next.  Setting them
+ourselves between fork and exec isn't safe while the runner has other
+threads.
+
+Unprivileged users can't raise hard limits or lower the nice level, so the
+values actually applied may be stricter than those configured.  These
+effective values are written to the header of the command's output.
+'''
+import os
+import resource
+
+from . import config
+
+
+# Resource limit settings, the limits they set, and the matching prlimit
+# option.  Both the soft and hard limits are set.
+RLIMITS = {
+    # Bytes of virtual memory.
+    "address_space": (resource.RLIMIT_AS, "--as"),
+    # Bytes of resident memory.  Not enforced by Linux since 2.6, use
+    # address_space instead.
+    "rss": (resource.RLIMIT_RSS, "--rss"),
+    "cpu_seconds": (resource.RLIMIT_CPU, "--cpu"),
+    "open_files": (resource.RLIMIT_NOFILE, "--nofile"),
+}
+
+IONICE_CLASSES = {
+    "realtime": "1",
+    "best-effort": "2",
+    "idle": "3",
+}
+
+SETTINGS = tuple(RLIMITS) + ("nice", "ionice_class", "ionice_level", "cpu_affinity")
+
+
+def settings_for_job(job_config=None):
+    """Merge the global resource settings with a job's overrides."""
+    settings = {}
+    global_config = config.get_global_config()
+    if global_config.has("resources"):
+        settings.update(global_config.get("resources"))
+    if job_config is not None and job_config.has("resources"):
+        settings.update(job_config.get("resources"))
+    return settings
+
+
+def validate_settings(settings):
+    for key in settings:
+        assert key in SETTINGS, "Invalid resources setting '{key}'".format(key=key)
+    for key in RLIMITS:
+        if key in settings:
+            assert isinstance(settings[key], int) and settings[key] > 0, \
+                "resources '{key}' must be a positive whole number".format(key=key)
+    if "nice" in settings:
+        assert -20 <= settings["nice"] <= 19, "resources 'nice' must be between -20 and 19"
+    if "ionice_class" in settings:
+        assert settings["ionice_class"] in IONICE_CLASSES, \
+            "resources 'ionice_class' must be 'realtime', 'best-effort' or 'idle'"
+    if "ionice_level" in settings:
+        assert settings.get("ionice_class") in ("realtime", "best-effort"), \
+            "resources 'ionice_level' needs an 'ionice_class' of 'realtime' or 'best-effort'"
+        assert 0 <= settings["ionice_level"] <= 7, "resources 'ionice_level' must be between 0 and 7"
+    if "cpu_affinity" in settings:
+        assert settings["cpu_affinity"] and all(isinstance(cpu, int) and cpu >= 0 for cpu in settings["cpu_affinity"]), \
+            "resources 'cpu_affinity' must be a list of CPU numbers"
+
+
+class Limits(object):
+    """The effective resources settings for one run, worked out in the parent
+    so that the child only has to make system calls."""
+
+    def __init__(self, settings):
+        self.rlimits = {}
+        for key, (limit, _) in RLIMITS.items():
+            if key in settings:
+                value = settings[key]
+                _, hard = resource.getrlimit(limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                self.rlimits[key] = value
+
+        self.nice = None
+        # nice(1) only adjusts the level, so remember where we start from.
+        self.current_nice = os.getpriority(os.PRIO_PROCESS, 0)
+        if "nice" in settings:
+            if os.geteuid() == 0:
+                self.nice = settings["nice"]
+            else:
+                self.nice = max(settings["nice"], self.current_nice)
+
+        self.cpu_affinity = None
+        if "cpu_affinity" in settings:
+            self.cpu_affinity = sorted(set(settings["cpu_affinity"]) & os.sched_getaffinity(0))
+            assert self.cpu_affinity, "None of the CPUs in resources 'cpu_affinity' ({cpus}) are available".format(
+                cpus=", ".join(str(cpu) for cpu in settings["cpu_affinity"]))
+
+        self.ionice_class = settings.get("ionice_class")
+        self.ionice_level = settings.get("ionice_level")
+
+    def wrap(self, command):
+        """Return the command line to run, prefixed with the wrappers which
+        apply the settings."""
+        wrapper = []
+        if self.rlimits:
+            wrapper.append("prlimit")
+            for key, value in self.rlimits.items():
+                wrapper.append("{option}={value}:{value}".format(option=RLIMITS[key][1], value=value))
+            wrapper.append("--")
+        if self.nice is not None:
+            wrapper += ["nice", "-n", str(self.nice - self.current_nice), "--"]
+        if self.ionice_class is not None:
+            wrapper += ["ionice", "-c", IONICE_CLASSES[self.ionice_class]]
+            if self.ionice_level is not None:
+                wrapper += ["-n", str(self.ionice_level)]
+            wrapper.append("--")
+        if self.cpu_affinity is not None:
+            # taskset stops reading options at the CPU list, and takes no
+            # "--".
+            wrapper += ["taskset", "-c", ",".join(str(cpu) for cpu in self.cpu_affinity)]
+        return wrapper + command
+
+    def describe(self):
+        """Summarize the effective settings for the output header, or return
+        None if there are none."""
+        parts = ["{key}={value}".format(key=key, value=value) for key, value in self.rlimits.items()]
+        if self.nice is not None:
+            parts.append("nice={nice}".format(nice=self.nice))
+        if self.ionice_class is not None:
+            ionice = self.ionice_class
+            if self.ionice_level is not None:
+                ionice += ":{level}".format(level=self.ionice_level)
+            parts.append("ionice={ionice}".format(ionice=ionice))
+        if self.cpu_affinity is not None:
+            parts.append("cpu_affinity={cpus}".format(cpus=",".join(str(cpu) for cpu in self.cpu_affinity)))
+        if not parts:
+            return None
+        return "resources: " + " ".join(parts)
@@ -0,0 +1,54 @@
+'''
+Statistics on how long a job usually takes, for adaptive timeouts and slow
+run warnings.
+
+Job state keeps the durations of the job's recent successful runs, updated as
+each run is recorded, so nothing here has to read through run history.
+'''
+import math
+
+
+# Successful runs remembered per job.
+DURATION_WINDOW = 50
+
+# Successful runs needed before we trust the statistics.
+DEFAULT_MIN_RUNS = 5
+
+
+def run_duration(job_run):
+    """Return how long a run spent running, leaving out any wait for the lock
+    or concurrency slots, or None if it wasn't recorded.  Older history only
+    has the overall duration."""
+    if "run_duration" in job_run:
+        return job_run["run_duration"]
+    return job_run.get("duration")
+
+
+def add_duration(durations, duration):
+    """Remember a successful run's duration, forgetting the oldest once the
+    window is full."""
+    durations.append(duration)
+    del durations[:-DURATION_WINDOW]
+
+
+def percentile(durations, p):
+    """Return the nearest-rank p-th percentile of the durations."""
+    ordered = sorted(durations)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def adaptive_timeout(durations, floor, factor, min_runs=DEFAULT_MIN_RUNS):
+    """Return the timeout in seconds, factor times the 95th percentile of
+    recent durations but at least the floor.  Falls back to the floor until
+    there have been min_runs successful runs."""
+    if len(durations) < min_runs:
+        return floor
+    return max(floor, factor * percentile(durations, 95))
+
+
+def usual_duration(durations, min_runs=DEFAULT_MIN_RUNS):
+    """Return the median recent duration, or None without enough runs."""
+    if len(durations) < min_runs:
+        return None
+    return percentile(durations, 50)
@@ -1,26 +1,66 @@
 import datetime
 import os
 import pwd
+import queue
 import shlex
+import signal
 import subprocess
 import threading
+import time
 
+from . import concurrency
 from . import config
 from . import job_state
 from . import lock
+from . import log_retention
 from . import mailer
+from . import metrics
 from . import output_streamer
+from . import resource_limits
+from . import run_stats
 
 
 class JobRunner(object):
 
     def __init__(self, job):
-        self.global_config = config.GlobalConfiguration()
+        self.global_config = config.get_global_config()
         self.job = job
         self.mailer = mailer.Mailer(self.job)
         self.logfile = None
-        self.process = None
+        # Running subprocesses keyed by pid.  Steps of a job may run several
+        # at once, so guard with process_lock.  It's reentrant because
+        # terminate() runs from a signal handler on the main thread, which
+        # may already hold it.
+        self.processes = {}
+        self.process_lock = threading.RLock()
         self.start_time = None
+        self.start_clock = None
+        # When the run got past waiting for the lock and concurrency slots.
+        self.run_start_clock = None
+        # Statistics for each command run, see run_command.
+        self.command_stats = []
+        self.output_bytes = 0
+        # Shared output limit for all commands of a run, if configured.
+        self.output_budget = None
+        self.output_limited = False
+        # Whether a command was killed for going quiet.
+        self.stalled = False
+        # Last lines of output, for failmail.
+        self.output_tail = None
+        self.lock_contended = False
+        # Seconds before the run times out, or 0 for never.
+        self.timeout_seconds = 0
+        # Resource limits and priority for the commands of a run.
+        self.limits = resource_limits.Limits({})
+        # Seconds spent waiting for the previous run to release the lock.
+        self.lock_wait = None
+        # Seconds spent waiting for concurrency pools, if any apply.
+        self.pool_wait = None
+        # Outcome and duration of each step, for jobs made of steps.
+        self.step_stats = {}
+        self.aborting_steps = False
+        # Timers sending SIGKILL to process groups which were asked to stop.
+        self.escalations = []
 
         self.killer_was_me = False
         self.failure_reason = None
@@ -35,20 +75,45 @@ class JobRunner(object):
         assert passwd_entry.pw_uid == os.getuid(), "You must run jobs as user '{user}'".format(user=service_user)
 
         self.start_time = datetime.datetime.utcnow()
+        self.start_clock = time.monotonic()
+        self.run_start_clock = None
+        self.command_stats = []
+        self.output_bytes = 0
+        self.output_budget = None
+        if self.job.output_max_bytes > 0:
+            self.output_budget = output_streamer.OutputBudget(self.job.output_max_bytes)
+        self.output_limited = False
+        self.stalled = False
+        self.output_tail = None
+        if self.job.failmail_tail_lines > 0:
+            self.output_tail = output_streamer.OutputTail(self.job.failmail_tail_lines)
+        self.lock_contended = False
+        self.limits = resource_limits.Limits(self.job.resources)
+        self.lock_wait = None
+        self.pool_wait = None
+        self.step_stats = {}
+        self.aborting_steps = False
+        self.escalations = []
+
+        job_history = job_state.load_state(self.job.slug)
 
         # Spawn timeout monitor thread.
-        if self.job.timeout > 0:
-            # Convert minutes to seconds.
-            timeout_seconds = self.job.timeout * 60
-            timer = threading.Timer(timeout_seconds, self.fail_timeout)
+        self.timeout_seconds = self.effective_timeout(job_history)
+        timer = None
+        if self.timeout_seconds > 0:
+            timer = threading.Timer(self.timeout_seconds, self.fail_timeout)
             timer.start()
 
-        job_history = job_state.load_state(self.job.slug)
         job_history.record_started(self.start_time)
 
+        slots = None
         try:
-            lock.begin(slug=self.job.slug)
+            self.acquire_lock()
+            slots = self.job_slots()
+            self.acquire_slots(slots)
+            self.run_start_clock = time.monotonic()
 
+            steps = None
             if 'slow_start' in kwargs and kwargs['slow_start']:
                 if self.job.slow_start_command is False:
                     raise JobFailure("This job has no slow_start_command configured")
@@ -56,30 +121,206 @@ class JobRunner(object):
                 verb = "Slow starting"
             else:
                 commands = self.job.commands
+                steps = self.job.steps
                 verb = "Running"
             config.log.info("{verb} job {name} ({slug})".format(verb=verb, name=self.job.name, slug=self.job.slug))
-            for command_line in commands:
-                return_code = self.run_command(command_line)
-                if return_code != 0:
-                    self.fail_exitcode(return_code)
-            job_history.record_success()
+            if steps is not None:
+                self.run_steps(steps)
+            else:
+                for command_line in commands:
+                    return_code = self.run_command(command_line)
+                    if return_code != 0:
+                        self.fail_exitcode(return_code)
+            details = self.run_details()
+            self.check_slow_run(job_history, details)
+            job_history.record_success(details)
             config.log.info("Successfully completed {slug}.".format(slug=self.job.slug))
+        except concurrency.PoolBusy as ex:
+            config.log.warning("{error} Skipping this job run.".format(error=ex))
+            job_history.record_skipped(self.run_details())
         except (JobFailure, lock.LockError) as ex:
+            if isinstance(ex, lock.LockError) and ex.code == lock.LockError.LOCK_EXISTS:
+                self.lock_contended = True
             if isinstance(ex, lock.LockError) and ex.code == lock.LockError.LOCK_EXISTS and self.job.allow_overtime:
                 config.log.info("Previous job is still running, but that's OK.")
-                job_history.record_skipped()
+                job_history.record_skipped(self.run_details())
             else:
                 config.log.error(str(ex))
-                job_history.record_failure()
+                details = self.run_details()
+                job_history.record_failure(details)
                 if job_history.consecutive_failures >= self.job.failure_threshold_for_mail:
-                    self.mailer.fail_mail(str(ex), logfile=self.logfile)
+                    tail = self.output_tail.get() if self.output_tail is not None else None
+                    self.mailer.fail_mail(str(ex), logfile=self.logfile, details=details, tail=tail)
         finally:
-            if self.job.timeout > 0:
+            if timer is not None:
                 # This becomes relevant when running multiple commands.
                 timer.cancel()
+            self.finish_kills()
+            if slots is not None:
+                slots.release()
             lock.end()
+            self.export_metrics(job_history)
+            self.tidy_logs()
+
+    def effective_timeout(self, job_history):
+        """Return the run's timeout in seconds."""
+        # Convert minutes to seconds.
+        floor = self.job.timeout * 60
+        if self.job.adaptive_timeout is None:
+            return floor
+        return run_stats.adaptive_timeout(
+            job_history.recent_durations,
+            floor,
+            self.job.adaptive_timeout["factor"],
+            self.job.adaptive_timeout["min_runs"]
+        )
+
+    def check_slow_run(self, job_history, details):
+        """Flag a successful run which took much longer than usual."""
+        if not self.job.slow_run_factor:
+            return
+        usual = run_stats.usual_duration(job_history.recent_durations)
+        duration = run_stats.run_duration(details)
+        if usual is not None and duration > self.job.slow_run_factor * usual:
+            details["slow"] = True
+            config.log.warning("{name} took {duration:.1f} seconds, more than {factor} times its usual {usual:.1f} seconds".format(
+                name=self.job.name, duration=duration, factor=self.job.slow_run_factor, usual=usual))
+
+    def acquire_lock(self):
+        """Take the job lock, waiting for the previous run if configured."""
+        if self.job.lock_wait["max_wait"] <= 0:
+            lock.begin(slug=self.job.slug)
+            return
+
+        start = time.monotonic()
+        try:
+            lock.begin(
+                slug=self.job.slug,
+                max_wait=self.job.lock_wait["max_wait"],
+                strategy=self.job.lock_wait["strategy"],
+                max_queue=self.job.lock_wait["max_queue"],
+                abort=lambda: self.killer_was_me
+            )
+        except lock.LockError:
+            if self.killer_was_me:
+                # Timed out while waiting.
+                raise JobFailure(self.failure_reason)
+            raise
+        finally:
+            self.lock_wait = time.monotonic() - start
+
+        if self.lock_wait >= 1:
+            config.log.info("Waited {wait:.1f} seconds for the previous run to finish.".format(wait=self.lock_wait))
+
+    def job_slots(self):
+        """Return the concurrency pool slots the job will need."""
+        try:
+            return concurrency.Slots(self.job)
+        except (AssertionError, KeyError, TypeError, ValueError) as ex:
+            raise JobFailure("Invalid concurrency configuration: {error}".format(error=ex))
+
+    def acquire_slots(self, slots):
+        """Wait for our turn in any concurrency pools which apply to the job."""
+        if not slots.pools:
+            return
+
+        try:
+            slots.acquire(abort=lambda: self.killer_was_me)
+        except concurrency.PoolBusy:
+            if self.killer_was_me:
+                # Timed out while waiting.
+                raise JobFailure(self.failure_reason)
+            raise
+        finally:
+            self.pool_wait = slots.wait_time
+
+        if self.pool_wait >= 1:
+            config.log.info("Waited {wait:.1f} seconds for a concurrency slot.".format(wait=self.pool_wait))
+
+    def run_steps(self, steps):
+        """Run a job made of steps, starting each step as soon as the steps it
+        depends on have succeeded.  At most `parallelism` steps run at once.
+
+        With the fail_fast failure mode, the first failing step kills all
+        other running steps.  With wait_all, independent steps keep going
+        and only the dependents of failed steps are skipped.
+        """
+        results = queue.Queue()
+        steps_by_name = {step.name: step for step in steps}
+        pending = [step.name for step in steps]
+        running = {}
+        succeeded = set()
+        failures = []
+        fail_fast = self.job.failure_mode == "fail_fast"
+
+        while pending or running:
+            for name in list(pending):
+                if failures and fail_fast:
+                    break
+                depends_on = steps_by_name[name].depends_on
+                if any(dependency not in succeeded and dependency not in pending and dependency not in running
+                       for dependency in depends_on):
+                    # A dependency failed or was skipped.
+                    pending.remove(name)
+                    self.step_stats[name] = {"status": "skipped"}
+                    continue
+                if not all(dependency in succeeded for dependency in depends_on):
+                    continue
+                if self.job.parallelism and len(running) >= self.job.parallelism:
+                    break
+
+                pending.remove(name)
+                thread = threading.Thread(target=self.run_step, args=(steps_by_name[name], results))
+                thread.daemon = True
+                thread.start()
+                running[name] = thread
+
+            if not running:
+                # Whatever is left can never start.
+                for name in pending:
+                    self.step_stats[name] = {"status": "skipped"}
+                break
+
+            name, error = results.get()
+            running.pop(name).join()
+            if error is None:
+                succeeded.add(name)
+            elif self.step_stats[name]["status"] == "failed":
+                failures.append("{step}: {error}".format(step=name, error=error))
+                if fail_fast and running:
+                    config.log.warning("Step {step} failed, stopping other steps.".format(step=name))
+                    self.aborting_steps = True
+                    self.kill_processes()
+
+        if failures:
+            raise JobFailure("; ".join(failures))
+
+    def run_step(self, step, results):
+        """Run a step's commands in sequence, and report the outcome to the
+        results queue."""
+        step_start = time.monotonic()
+        error = None
+        try:
+            for command_line in step.commands:
+                return_code = self.run_command(command_line, step=step.name)
+                if return_code != 0:
+                    self.fail_exitcode(return_code)
+        except Exception as ex:
+            error = str(ex) or repr(ex)
 
-    def run_command(self, command_string):
+        if error is None:
+            status = "completed"
+        elif self.aborting_steps and not self.killer_was_me:
+            status = "aborted"
+        else:
+            status = "failed"
+        self.step_stats[step.name] = {
+            "status": status,
+            "duration": round(time.monotonic() - step_start, 3),
+        }
+        results.put((step.name, error))
+
+    def run_command(self, command_string, step=None):
         """Fork a command, record its outputs to a logfile and return the
         integer exit code."""
         # TODO: Log commandline into the output log as well.
@@ -87,24 +328,185 @@ class JobRunner(object):
 
         command = shlex.split(command_string)
 
-        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.job.environment)
-        streamer = output_streamer.OutputStreamer(self.process, self.job.slug, command_string, self.start_time)
-        self.logfile = streamer.filename
-        config.log.info("Logging to {path}".format(path=self.logfile))
-        streamer.start()
+        if self.job.output_mode == "raw":
+            streamer = output_streamer.RawOutput(
+                self.job.slug, command_string, self.start_time, step=step, resources=self.limits.describe())
+            self.logfile = streamer.filename
+            config.log.info("Logging to {path}".format(path=self.logfile))
+            streamer.start()
+            try:
+                process = self.spawn(command, stdout=streamer.fileno(), stderr=streamer.fileno())
+            except BaseException:
+                streamer.stop()
+                raise
+            streamer.attach(process)
+        else:
+            process = self.spawn(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if self.job.output_limit_action == "kill":
+                on_limit = self.fail_output_limit
+            else:
+                on_limit = None
+            streamer = output_streamer.OutputStreamer(
+                process,
+                self.job.slug,
+                command_string,
+                self.start_time,
+                step=step,
+                max_line_length=self.job.output_max_line_length,
+                long_lines=self.job.output_long_lines,
+                budget=self.output_budget,
+                on_limit=on_limit,
+                tail=self.output_tail,
+                resources=self.limits.describe(),
+                idle_timeout=self.job.idle_timeout,
+                on_idle=self.fail_idle
+            )
+            self.logfile = streamer.filename
+            config.log.info("Logging to {path}".format(path=self.logfile))
+            streamer.start()
+        command_start = time.monotonic()
 
         # should be safe from deadlocks because our OutputStreamer
-        # has been consuming stderr and stdout
-        self.process.wait()
+        # has been consuming stderr and stdout, or the process is writing
+        # straight to the logfile
+        usage = self.wait_process(process)
+        duration = time.monotonic() - command_start
 
+        if not streamer.drain(self.job.kill_grace):
+            # Something the command started is still holding its output
+            # pipes.
+            config.log.warning("Output of {cmd} is still open after it exited, killing leftover processes.".format(cmd=command_string))
+            signal_group(process.pid, signal.SIGKILL)
+            streamer.drain(self.job.kill_grace)
+        # Stops reading even if the pipes are still open.
         streamer.stop()
 
-        return_code = self.process.returncode
-
-        self.process = None
+        return_code = process.returncode
+        stats = command_stats(command_string, return_code, duration, usage)
+        if step is not None:
+            stats["step"] = step
+        with self.process_lock:
+            del self.processes[process.pid]
+            self.output_bytes += streamer.bytes_read
+            if streamer.limit_reached:
+                self.output_limited = True
+            self.command_stats.append(stats)
 
         return return_code
 
+    def spawn(self, command, stdout, stderr):
+        """Start a command and track it in self.processes.
+
+        Each command leads its own session, so that everything it starts can
+        be signalled as a process group."""
+        process = subprocess.Popen(
+            self.limits.wrap(command),
+            stdout=stdout,
+            stderr=stderr,
+            env=self.job.environment,
+            start_new_session=True
+        )
+        with self.process_lock:
+            self.processes[process.pid] = process
+            if self.killer_was_me or self.aborting_steps:
+                # We were told to stop while starting up.
+                signal_group(process.pid, signal.SIGKILL)
+        return process
+
+    def wait_process(self, process):
+        """Wait for a process to exit, and return its resource usage.
+
+        We reap the child with wait4 rather than diffing RUSAGE_CHILDREN, so
+        the figures belong to this command alone."""
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # Already reaped by Popen, for example when the timeout killed it.
+            process.wait()
+            return None
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return usage
+
+    def kill_processes(self):
+        """Ask each running command and everything it started to stop, and
+        kill them if they're still around after the grace period."""
+        with self.process_lock:
+            groups = [process.pid for process in self.processes.values() if process.returncode is None]
+        for group in groups:
+            signal_group(group, signal.SIGTERM)
+
+        if groups:
+            escalate = threading.Timer(self.job.kill_grace, self.kill_groups, args=(groups,))
+            escalate.daemon = True
+            escalate.start()
+            self.escalations.append((escalate, groups))
+
+    def finish_kills(self):
+        """Make sure nothing we asked to stop outlives the run."""
+        for escalate, groups in self.escalations:
+            if any(signal_group(group, 0) for group in groups):
+                escalate.join()
+            else:
+                escalate.cancel()
+
+    def kill_groups(self, groups):
+        for group in groups:
+            if signal_group(group, signal.SIGKILL):
+                config.log.warning("Process group {pid} outlived the {grace} second grace period, killed it.".format(
+                    pid=group, grace=self.job.kill_grace))
+
+    def export_metrics(self, job_history):
+        """Update the metrics textfile with the run we just recorded."""
+        job_run = job_history.history[-1]
+        if job_run["status"] not in job_state.TERMINAL_STATUSES:
+            return
+
+        try:
+            metrics.record_run(
+                self.job.slug,
+                job_run,
+                job_history.consecutive_failures,
+                output_bytes=self.output_bytes,
+                lock_contention=self.lock_contended
+            )
+        except (OSError, ValueError) as ex:
+            config.log.warning("Could not export metrics for {slug}: {error}".format(slug=self.job.slug, error=ex))
+
+    def tidy_logs(self):
+        """Compress and prune old logs, now that the lock is released."""
+        try:
+            log_retention.tidy_job_logs(self.job.slug, self.job.log_retention)
+        except OSError as ex:
+            config.log.warning("Could not tidy logs for {slug}: {error}".format(slug=self.job.slug, error=ex))
+
+    def run_details(self):
+        """Statistics about the current run, to be stored in job history."""
+        details = {
+            "duration": round(time.monotonic() - self.start_clock, 3),
+        }
+        if self.run_start_clock is not None:
+            # Without waits, for adaptive timeouts and slow run warnings.
+            details["run_duration"] = round(time.monotonic() - self.run_start_clock, 3)
+        if self.job.adaptive_timeout is not None and self.timeout_seconds:
+            details["timeout"] = round(self.timeout_seconds, 3)
+        if self.lock_wait is not None:
+            details["lock_wait"] = round(self.lock_wait, 3)
+        if self.pool_wait is not None:
+            details["pool_wait"] = round(self.pool_wait, 3)
+        if self.output_limited:
+            details["output_limited"] = True
+        if self.stalled:
+            details["stalled"] = True
+        if self.step_stats:
+            details["steps"] = self.step_stats
+        if self.command_stats:
+            details["commands"] = self.command_stats
+            last_command = self.command_stats[-1]
+            for key in ("exit_code", "signal"):
+                if key in last_command:
+                    details[key] = last_command[key]
+        return details
+
     def fail_exitcode(self, return_code):
         # Check if this is an expected non-zero return code, i.e. we sent the
         # process a kill signal.
@@ -120,21 +522,47 @@ class JobRunner(object):
         # Send a message to self using cheap IPC.
         # FIXME: or is this not safe?
         self.killer_was_me = True
-        self.failure_reason = "{name} timed out after {timeout} minutes".format(
-            name=self.job.name, timeout=self.job.timeout)
+        if self.job.adaptive_timeout is not None:
+            self.failure_reason = "{name} timed out after {timeout:.1f} seconds (adaptive timeout)".format(
+                name=self.job.name, timeout=self.timeout_seconds)
+        else:
+            self.failure_reason = "{name} timed out after {timeout} minutes".format(
+                name=self.job.name, timeout=self.job.timeout)
+        if not self.processes:
+            return
 
         config.log.warning("Killing subprocess due to timeout")
-        self.process.kill()
+        self.kill_processes()
         # Note that we're on a separate thread, so instead of raising an
-        # exception, we rely on process.kill() to trigger fail_exitcode(-9) in
-        # the parent thread.
+        # exception, we rely on the signal to trigger fail_exitcode in the
+        # parent thread.
+
+    def fail_output_limit(self):
+        # Called from the output streamer thread, like fail_timeout.
+        self.killer_was_me = True
+        self.failure_reason = "{name} exceeded the output limit of {limit} bytes".format(
+            name=self.job.name, limit=self.job.output_max_bytes)
+        config.log.warning("Killing subprocess due to too much output")
+        self.kill_processes()
+
+    def fail_idle(self):
+        # Called from the output streamer thread, like fail_timeout.
+        self.killer_was_me = True
+        self.stalled = True
+        self.failure_reason = "{name} stalled, with no output for {idle} seconds".format(
+            name=self.job.name, idle=self.job.idle_timeout)
+        config.log.warning("Killing subprocess due to lack of output")
+        self.kill_processes()
 
-    def terminate(self):
+    def terminate(self, signum=signal.SIGTERM):
         # Essentially the same as fail_timeout, but for SIGTERM handling instead.
+        signal_name = signal.Signals(signum).name
         self.killer_was_me = True
-        self.failure_reason = "{name} was terminated by SIGTERM".format(name=self.job.name)
-        config.log.warning("Killing subprocess due to SIGTERM")
-        self.process.kill()
+        self.failure_reason = "{name} was terminated by {signal}".format(name=self.job.name, signal=signal_name)
+        if not self.processes:
+            return
+        config.log.warning("Killing subprocess due to {signal}".format(signal=signal_name))
+        self.kill_processes()
 
     def status(self):
         """Check for any running instances of this job, in this process or another.
@@ -144,21 +572,49 @@ class JobRunner(object):
         Do not use this function to gate the workflow, explicitly assert the
         lock instead."""
 
-        # FIXME: DRY--find a good line to cut at to split out lock.read_pid.
-        lock_path = lock.path_for_job(self.job.slug)
-        if os.path.exists(lock_path):
-            with open(lock_path, "r") as f:
-                pid = int(f.read().strip())
-                try:
-                    os.kill(pid, 0)
-                except OSError:
-                    status = "dead"
-                else:
-                    status = "running"
-                # TODO: encapsulate
-                return {"status": status, "pid": pid}
-
-        return None
+        held_by = lock.holder(self.job.slug)
+        if held_by is None:
+            return None
+
+        pid, running = held_by
+        # TODO: encapsulate
+        return {"status": "running" if running else "dead", "pid": pid}
+
+
+def signal_group(pgid, signum):
+    """Signal a process group, returning False if it's already gone."""
+    try:
+        os.killpg(pgid, signum)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def command_stats(command_string, return_code, duration, usage):
+    stats = {
+        "command": command_string,
+        "duration": round(duration, 3),
+    }
+    if return_code < 0:
+        try:
+            stats["signal"] = signal.Signals(-return_code).name
+        except ValueError:
+            stats["signal"] = -return_code
+    else:
+        stats["exit_code"] = return_code
+
+    if usage is not None:
+        stats["rusage"] = {
+            "user_cpu": round(usage.ru_utime, 3),
+            "system_cpu": round(usage.ru_stime, 3),
+            # Kilobytes on Linux.
+            "max_rss": usage.ru_maxrss,
+            "block_in": usage.ru_inblock,
+            "block_out": usage.ru_oublock,
+            "voluntary_switches": usage.ru_nvcsw,
+            "involuntary_switches": usage.ru_nivcsw,
+        }
+    return stats
 
 
 class JobFailure(RuntimeError):
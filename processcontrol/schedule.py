@@ -0,0 +1,156 @@
+'''
+Vixie cron schedule expressions.
+
+Only the five-term form is supported, without "@" aliases.  Each field is
+compiled into a bitset of matching values, so matching and searching for the
+next fire time are cheap.
+'''
+import datetime
+
+
+MONTH_NAMES = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+DAY_NAMES = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+# Field name, lowest and highest value, and names for values, in expression
+# order.  Day of week 7 is another way to write Sunday.
+FIELDS = (
+    ("minute", 0, 59, None),
+    ("hour", 0, 23, None),
+    ("day of month", 1, 31, None),
+    ("month", 1, 12, MONTH_NAMES),
+    ("day of week", 0, 7, DAY_NAMES),
+)
+
+
+class CronSchedule(object):
+    """A parsed cron expression.
+
+    Raises ValueError if the expression is invalid.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        terms = expression.split()
+        if len(terms) != 5:
+            raise ValueError("Schedule '{expr}' must contain 5 values separated by whitespace".format(expr=expression))
+
+        fields = [parse_field(term, *field) for term, field in zip(terms, FIELDS)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = fields
+
+        if self.weekdays & (1 << 7):
+            self.weekdays = (self.weekdays & ~(1 << 7)) | 1
+
+        # As in cron(8), when both day fields are restricted a day matching
+        # either one will do.
+        self.days_restricted = not terms[2].startswith("*")
+        self.weekdays_restricted = not terms[4].startswith("*")
+
+    def matches(self, when):
+        """Test whether the schedule fires at the minute of this datetime."""
+        return has_bit(self.minutes, when.minute) \
+            and has_bit(self.hours, when.hour) \
+            and has_bit(self.months, when.month) \
+            and self.day_matches(when)
+
+    def day_matches(self, when):
+        day_match = has_bit(self.days, when.day)
+        # Python counts weekdays from Monday, cron from Sunday.
+        weekday_match = has_bit(self.weekdays, (when.weekday() + 1) % 7)
+        if self.days_restricted and self.weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def next_fire(self, after):
+        """Return the first minute after the given datetime when the schedule
+        fires, or None if it never does (for example on February 30).
+        """
+        when = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # Any satisfiable schedule fires within eight years, the longest gap
+        # between two leap days.
+        last_year = when.year + 8
+
+        while when.year <= last_year:
+            if not has_bit(self.months, when.month):
+                # Skip to the first day of next month.
+                when = (when.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+                continue
+
+            if not self.day_matches(when):
+                when = when.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+
+            hour = next_bit(self.hours, when.hour)
+            if hour is None:
+                when = when.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            if hour != when.hour:
+                when = when.replace(hour=hour, minute=0)
+
+            minute = next_bit(self.minutes, when.minute)
+            if minute is None:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+
+            return when.replace(minute=minute)
+
+        return None
+
+    def fires_between(self, start, end):
+        """Generate each time the schedule fires, from start up to but not
+        including end."""
+        when = self.next_fire(start - datetime.timedelta(minutes=1))
+        while when is not None and when < end:
+            yield when
+            when = self.next_fire(when)
+
+
+def has_bit(bits, value):
+    return bits >> value & 1 == 1
+
+
+def next_bit(bits, start):
+    """Return the lowest value at or above start in a bitset, or None."""
+    remaining = bits >> start << start
+    if remaining == 0:
+        return None
+    return (remaining & -remaining).bit_length() - 1
+
+
+def parse_field(term, name, low, high, names):
+    """Compile one term of a cron expression into a bitset of matching
+    values."""
+    values = 0
+    for part in term.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = parse_number(step_text, name, 1, high - low + 1, None)
+            if part != "*" and "-" not in part:
+                raise ValueError("Step in {name} field '{term}' needs a range".format(name=name, term=term))
+
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            start = parse_number(start_text, name, low, high, names)
+            end = parse_number(end_text, name, low, high, names)
+            if start > end:
+                raise ValueError("Backwards range in {name} field '{term}'".format(name=name, term=term))
+        else:
+            start = end = parse_number(part, name, low, high, names)
+
+        for value in range(start, end + 1, step):
+            values |= 1 << value
+    return values
+
+
+def parse_number(text, name, low, high, names):
+    if names is not None and text.lower() in names:
+        return names.index(text.lower()) + (1 if names is MONTH_NAMES else 0)
+
+    if not text.isdigit():
+        raise ValueError("Invalid {name} '{text}'".format(name=name, text=text))
+    value = int(text)
+    if value < low or value > high:
+        raise ValueError("{name} '{text}' is out of range {low}-{high}".format(name=name.capitalize(), text=text, low=low, high=high))
+    return value
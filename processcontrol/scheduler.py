@@ -0,0 +1,209 @@
+'''
+Long-running scheduler which replaces the per-job crontab entries.
+
+The job catalog is kept in memory and refreshed once a minute, so only job
+files which changed are parsed again.  Each due job is run by a forked child
+of the scheduler, which already has everything imported and configured.
+Runs go through JobRunner as usual, so locks, state and logs behave exactly
+as when run-job is started by cron.
+'''
+import datetime
+import heapq
+import logging
+import os
+import signal
+import sys
+import time
+
+from . import catalog
+from . import config
+from . import mail_spool
+from . import runner
+from . import schedule
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.catalog = None
+        # Parsed schedules keyed by job name, along with the job file stamp
+        # they were parsed from and the next time they fire.
+        self.schedules = {}
+        # Heap of (next fire time, job name).  Entries which no longer match
+        # self.schedules are stale and skipped.
+        self.queue = []
+        # Running children, pid -> job name.
+        self.children = {}
+        # Pid of the child flushing the failmail spool, if any.
+        self.flusher = None
+        self.running = False
+
+    def refresh(self, now):
+        """Pick up changes to the global config and job files.  New or changed
+        schedules are queued from the minute of `now` onwards."""
+        global_config = config.get_global_config()
+        if self.catalog is None or self.catalog.global_config is not global_config:
+            # Only replace the current catalog once the new one is loaded.
+            jobs_catalog = catalog.JobCatalog()
+            jobs_catalog.refresh()
+            self.catalog = jobs_catalog
+            self.schedules = {}
+        else:
+            self.catalog.refresh()
+
+        schedules = {}
+        for slug in self.catalog.slugs():
+            entry = self.catalog.get(slug)
+            if entry.error is not None or not entry.job_config.has("schedule"):
+                continue
+            if entry.job_config.has("disabled") and entry.job_config.get("disabled") is True:
+                continue
+
+            cached = self.schedules.get(slug)
+            if cached is not None and cached[0] == entry.stamp:
+                schedules[slug] = cached
+                continue
+
+            job_schedule = schedule.CronSchedule(entry.job_config.get("schedule"))
+            next_fire = job_schedule.next_fire(now - datetime.timedelta(minutes=1))
+            schedules[slug] = (entry.stamp, job_schedule, next_fire)
+            if next_fire is not None:
+                heapq.heappush(self.queue, (next_fire, slug))
+        self.schedules = schedules
+
+    def due_jobs(self, when):
+        """Return the names of jobs scheduled for the minute of `when`, and
+        queue their next run.
+
+        Only jobs at the head of the queue are examined, so this doesn't
+        depend on the number of jobs."""
+        minute = when.replace(second=0, microsecond=0)
+        due = []
+        while self.queue and self.queue[0][0] <= minute:
+            fire_time, slug = heapq.heappop(self.queue)
+            scheduled = self.schedules.get(slug)
+            if scheduled is None or scheduled[2] != fire_time:
+                # Stale entry for a changed or removed job.
+                continue
+
+            if fire_time == minute:
+                due.append(slug)
+            else:
+                config.log.warning("Scheduler missed the {time} run of {slug}".format(time=fire_time, slug=slug))
+
+            next_fire = scheduled[1].next_fire(minute)
+            self.schedules[slug] = (scheduled[0], scheduled[1], next_fire)
+            if next_fire is not None:
+                heapq.heappush(self.queue, (next_fire, slug))
+
+        return sorted(due)
+
+    def run_forever(self):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        config.log.info("Scheduler started.")
+
+        last_minute = None
+        while self.running:
+            # Like cron, schedules are in local time.
+            minute = datetime.datetime.now().replace(second=0, microsecond=0)
+            if minute != last_minute:
+                try:
+                    self.refresh(minute)
+                except (Exception, SystemExit) as ex:
+                    # Keep running the jobs we already know about.
+                    config.log.error("Scheduler couldn't refresh jobs, keeping the previous schedules: {error}".format(error=ex))
+                for slug in self.due_jobs(minute):
+                    self.launch(slug)
+                self.flush_mail()
+                last_minute = minute
+
+            self.reap()
+
+            # Poll often enough to reap children and catch the next minute.
+            time.sleep(1)
+
+        self.shutdown()
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def launch(self, slug):
+        """Run a job in a forked child."""
+        config.log.info("Scheduler starting {slug}".format(slug=slug))
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = slug
+            return
+
+        # In the child.
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            job = self.catalog.job(slug)
+            job_runner = runner.JobRunner(job)
+            signal.signal(signal.SIGTERM, lambda signum, frame: job_runner.terminate(signum))
+            job_runner.run()
+        except BaseException as ex:
+            config.log.error("Scheduled run of {slug} crashed: {error}".format(slug=slug, error=ex))
+            exit_code = 1
+        finally:
+            exit_child(exit_code)
+
+    def flush_mail(self):
+        """Send spooled failmail from a forked child, so a slow mail server
+        never holds up the schedule."""
+        if mail_spool.spool_settings() is None or self.flusher in self.children:
+            return
+
+        pid = os.fork()
+        if pid != 0:
+            self.flusher = pid
+            self.children[pid] = "failmail spool"
+            return
+
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            mail_spool.flush()
+        except BaseException as ex:
+            config.log.error("Flushing the failmail spool crashed: {error}".format(error=ex))
+            exit_code = 1
+        finally:
+            exit_child(exit_code)
+
+    def reap(self, block=False):
+        """Collect exited children."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.children = {}
+                return
+            if pid == 0:
+                return
+            slug = self.children.pop(pid, None)
+            if slug is not None and status != 0:
+                config.log.warning("Scheduled run of {slug} exited with status {code}".format(
+                    slug=slug, code=os.waitstatus_to_exitcode(status)))
+
+    def shutdown(self):
+        """Ask running jobs to stop, and wait for them."""
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        self.reap(block=True)
+        config.log.info("Scheduler stopped.")
+
+
+def exit_child(exit_code):
+    """End a forked child, without running the parent's cleanup but with
+    our own output written out."""
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
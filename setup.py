@@ -12,6 +12,7 @@ distutils.core.setup(
     scripts=[
         'bin/check-jobs-icinga',
         'bin/cron-generate',
+        'bin/migrate-job-state',
         'bin/run-job',
     ],
 )
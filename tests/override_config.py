@@ -29,11 +29,13 @@ def start(config_path=DEFAULT_TEST_CONFIG, job_subdir=None, extra={}):
     # TODO: assert unpatched
     patcher = mock.patch('processcontrol.config.GlobalConfiguration', wraps=OverrideConfiguration)
     patcher.start()
+    config.reset_global_config()
 
 
 def stop():
     global patcher  # noqa: F824
     patcher.stop()
+    config.reset_global_config()
 
 
 class OverrideConfiguration(config.GlobalConfiguration):
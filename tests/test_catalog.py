@@ -0,0 +1,123 @@
+import json
+import mock
+import os
+import yaml
+
+from processcontrol import catalog
+from processcontrol import config
+
+from . import override_config
+
+
+def setup_module():
+    override_config.start()
+
+
+def teardown_module():
+    override_config.stop()
+
+
+def make_catalog(tmp_path):
+    return catalog.JobCatalog(path=str(tmp_path / catalog.CATALOG_FILENAME))
+
+
+def test_catalog_lists_jobs(tmp_path):
+    jobs_catalog = make_catalog(tmp_path)
+    jobs_catalog.refresh()
+
+    slugs = jobs_catalog.slugs()
+    assert "successful" in slugs
+    assert "missing_fields" in slugs
+
+    assert jobs_catalog.job("successful").name == "True job"
+    assert jobs_catalog.get("missing_fields").error is not None
+
+
+def test_catalog_tags(tmp_path):
+    jobs_catalog = make_catalog(tmp_path)
+    jobs_catalog.refresh()
+
+    assert jobs_catalog.with_tag("database") == ["tagged"]
+    assert jobs_catalog.with_tag("nonexistent") == []
+
+
+def test_catalog_reuses_parsed_jobs(tmp_path):
+    make_catalog(tmp_path).refresh()
+    assert os.path.exists(str(tmp_path / catalog.CATALOG_FILENAME))
+
+    with mock.patch("yaml.safe_load", wraps=yaml.safe_load) as parse:
+        jobs_catalog = make_catalog(tmp_path)
+        jobs_catalog.refresh()
+        parse.assert_not_called()
+        assert jobs_catalog.job("successful").name == "True job"
+
+
+def test_catalog_reparses_changed_job(tmp_path):
+    job_dir = tmp_path / "jobs"
+    job_dir.mkdir()
+    job_path = job_dir / "changing.yaml"
+    job_path.write_text("name: Before\ncommand: /bin/true\n")
+
+    global_config = config.get_global_config()
+    with mock.patch.dict(global_config.values, {"job_directory": str(job_dir)}):
+        make_catalog(tmp_path).refresh()
+
+        job_path.write_text("name: After, and longer\ncommand: /bin/true\n")
+
+        jobs_catalog = make_catalog(tmp_path)
+        jobs_catalog.refresh()
+        assert jobs_catalog.job("changing").name == "After, and longer"
+
+
+def test_catalog_revalidates_after_upgrade(tmp_path):
+    make_catalog(tmp_path).refresh()
+
+    # As if the validation code had changed since the catalog was written.
+    with mock.patch("processcontrol.catalog._validator_hash", "newer"):
+        with mock.patch("yaml.safe_load", wraps=yaml.safe_load) as parse:
+            make_catalog(tmp_path).refresh()
+            parse.assert_called()
+
+
+def test_catalog_is_plain_json(tmp_path):
+    make_catalog(tmp_path).refresh()
+
+    with open(str(tmp_path / catalog.CATALOG_FILENAME)) as f:
+        storage = json.load(f)
+    names = [stored["values"]["name"] for stored in storage["entries"] if stored["values"]]
+    assert "True job" in names
+
+
+def test_catalog_revalidates_stored_values(tmp_path):
+    make_catalog(tmp_path).refresh()
+
+    # Someone with access to the run directory slips a newline into a
+    # schedule, which would add a line to the crontab.
+    path = str(tmp_path / catalog.CATALOG_FILENAME)
+    with open(path) as f:
+        storage = json.load(f)
+    for stored in storage["entries"]:
+        if stored["values"] and stored["values"]["name"] == "True job":
+            stored["values"]["schedule"] = "* * * * *\n* * * * * root /bin/sh"
+    with open(path, "w") as f:
+        json.dump(storage, f)
+
+    with mock.patch("yaml.safe_load", wraps=yaml.safe_load) as parse:
+        jobs_catalog = make_catalog(tmp_path)
+        jobs_catalog.refresh()
+        parse.assert_called()
+    assert not jobs_catalog.job("successful").config.has("schedule")
+
+
+def test_catalog_parses_unstorable_jobs_again(tmp_path):
+    job_dir = tmp_path / "jobs"
+    job_dir.mkdir()
+    (job_dir / "dated.yaml").write_text("name: Dated\ncommand: /bin/true\ndescription: 2020-01-01\n")
+
+    global_config = config.get_global_config()
+    with mock.patch.dict(global_config.values, {"job_directory": str(job_dir)}):
+        make_catalog(tmp_path).refresh()
+
+        jobs_catalog = make_catalog(tmp_path)
+        jobs_catalog.refresh()
+        assert jobs_catalog.job("dated").name == "Dated"
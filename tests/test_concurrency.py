@@ -0,0 +1,147 @@
+import mock
+import os
+import pytest
+import threading
+import time
+
+from processcontrol import concurrency
+from processcontrol import config
+from processcontrol import job_spec
+from processcontrol import job_state
+from processcontrol import runner
+
+from . import override_config
+
+
+def setup_module():
+    override_config.start()
+
+
+def teardown_module():
+    override_config.stop()
+
+
+def concurrency_config(tmp_path, settings):
+    return mock.patch.dict(config.get_global_config().values, {
+        "concurrency": settings,
+        "run_directory": str(tmp_path),
+    })
+
+
+def test_pool_limit(tmp_path):
+    with concurrency_config(tmp_path, {"max_concurrent_jobs": 2, "policy": "skip"}):
+        job = job_spec.load("successful")
+        first = concurrency.Slots(job)
+        first.acquire()
+        second = concurrency.Slots(job)
+        second.acquire()
+        with pytest.raises(concurrency.PoolBusy):
+            concurrency.Slots(job).acquire()
+
+        first.release()
+        third = concurrency.Slots(job)
+        third.acquire()
+        second.release()
+        third.release()
+
+
+@pytest.mark.timeout(5)
+def test_pool_queue_times_out(tmp_path):
+    with concurrency_config(tmp_path, {"max_concurrent_jobs": 1, "max_wait": 0.6}):
+        job = job_spec.load("successful")
+        held = concurrency.Slots(job)
+        held.acquire()
+        waiting = concurrency.Slots(job)
+        with pytest.raises(concurrency.PoolBusy):
+            waiting.acquire()
+        assert waiting.wait_time >= 0.6
+        held.release()
+
+
+def test_numeric_tag_pool(tmp_path):
+    with concurrency_config(tmp_path, {"tags": {5: {"limit": 1}}}):
+        pools = concurrency.pools_for_job(mock.Mock(tags=[5]))
+        assert [pool.name for pool in pools] == ["tag-5"]
+
+
+def test_pools_for_job(tmp_path):
+    settings = {
+        "max_concurrent_jobs": 4,
+        "tags": {
+            "queue": {"limit": 1, "policy": "skip"},
+            "database": {"limit": 2, "max_wait": 30},
+        },
+    }
+    with concurrency_config(tmp_path, settings):
+        pools = concurrency.pools_for_job(job_spec.load("tagged"))
+        assert [pool.name for pool in pools] == ["tag-database", "tag-queue", "global"]
+        assert pools[0].max_wait == 30
+        assert pools[1].policy == "skip"
+
+        assert [pool.name for pool in concurrency.pools_for_job(job_spec.load("successful"))] == ["global"]
+
+
+@pytest.mark.timeout(5)
+def test_waiting_job_holds_no_slots(tmp_path):
+    settings = {
+        "max_concurrent_jobs": 1,
+        "tags": {
+            "database": {"limit": 1, "max_wait": 1},
+        },
+    }
+    with concurrency_config(tmp_path, settings):
+        held = concurrency.Pool("tag-database", 1).try_acquire()
+        slots = concurrency.Slots(job_spec.load("tagged"))
+        errors = []
+
+        def wait_for_slots():
+            try:
+                slots.acquire()
+            except concurrency.PoolBusy as ex:
+                errors.append(ex)
+
+        waiter = threading.Thread(target=wait_for_slots)
+        waiter.start()
+
+        # The global slot stays free for untagged jobs while the tagged job
+        # waits.
+        while waiter.is_alive():
+            free = concurrency.Pool("global", 1).try_acquire()
+            assert free is not None
+            os.close(free)
+            time.sleep(0.1)
+        waiter.join()
+        os.close(held)
+        assert len(errors) == 1
+        assert slots.fds == []
+
+
+def test_runner_skips_when_pool_full(tmp_path):
+    settings = {
+        "tags": {
+            "database": {"limit": 1, "policy": "skip"},
+        },
+    }
+    with concurrency_config(tmp_path, settings):
+        held = concurrency.Pool("tag-database", 1).try_acquire()
+        try:
+            runner.JobRunner(job_spec.load("tagged")).run()
+        finally:
+            os.close(held)
+
+        skipped = job_state.load_state("tagged").history[-1]
+        assert skipped["status"] == "skipped"
+        assert "pool_wait" in skipped
+
+        runner.JobRunner(job_spec.load("tagged")).run()
+        assert job_state.load_state("tagged").history[-1]["status"] == "completed"
+
+
+@pytest.mark.timeout(10)
+@mock.patch("smtplib.SMTP")
+def test_runner_fails_with_bad_pool_config(MockSmtp, tmp_path):
+    with concurrency_config(tmp_path, {"max_concurrent_jobs": 1, "policy": "sometimes"}):
+        runner.JobRunner(job_spec.load("successful")).run()
+
+        failed = job_state.load_state("successful").history[-1]
+        assert failed["status"] == "failed"
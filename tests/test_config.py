@@ -54,3 +54,98 @@ def test_defaults():
     configuration = load_config("schedule_good.yaml", global_configuration)
     assert configuration.get("from_address") == "they@live.com"
     assert configuration.get("to_address") == "roddy@pipermail.net"
+
+
+def test_defaults_not_shared():
+    first = config.Configuration()
+    first.values["leak"] = True
+    second = config.Configuration()
+    assert not second.has("leak")
+
+
+def write_global_config(path, user):
+    with open(path, "w") as f:
+        f.write(
+            "cron_template: x\n"
+            "job_directory: {dir}\n"
+            "output_crontab: console\n"
+            "output_directory: {dir}\n"
+            "runner_path: /usr/bin/run-job\n"
+            "user: {user}\n".format(dir=data_dir, user=user))
+
+
+def test_global_config_cached(tmp_path, monkeypatch):
+    path = str(tmp_path / "process-control.yaml")
+    write_global_config(path, "alice")
+    monkeypatch.setattr(config, "CONFIG_PATH", path)
+    config.reset_global_config()
+
+    try:
+        first = config.get_global_config()
+        assert first.get("user") == "alice"
+        assert config.get_global_config() is first
+
+        # Rewriting the file invalidates the cache.
+        write_global_config(path, "bobby")
+        os.utime(path, ns=(0, 0))
+        second = config.get_global_config()
+        assert second is not first
+        assert second.get("user") == "bobby"
+    finally:
+        config.reset_global_config()
+
+
+def test_output_limits_must_be_positive(tmp_path):
+    for setting in ("output_max_line_length: 0", "output_max_line_length: -1", "output_max_bytes: 0", "failmail:\n    tail_lines: -1"):
+        path = tmp_path / "limits.yaml"
+        path.write_text("name: Limited\ncommand: /bin/true\n" + setting + "\n")
+        with pytest.raises(AssertionError):
+            config.JobConfiguration(config.Configuration(), config_path=str(path))
+
+
+def test_lock_wait_types(tmp_path):
+    for setting in ("lock_wait: 30", "lock_wait:\n    max_wait: soon", "lock_wait:\n    max_queue: '2'"):
+        path = tmp_path / "lock_wait.yaml"
+        path.write_text("name: Waiting\ncommand: /bin/true\n" + setting + "\n")
+        with pytest.raises(AssertionError):
+            config.JobConfiguration(config.Configuration(), config_path=str(path))
+
+
+def test_kill_grace_must_be_seconds(tmp_path):
+    for setting in ("kill_grace: soon", "kill_grace: -1"):
+        path = tmp_path / "grace.yaml"
+        path.write_text("name: Graceful\ncommand: /bin/true\n" + setting + "\n")
+        with pytest.raises(AssertionError):
+            config.JobConfiguration(config.Configuration(), config_path=str(path))
+
+
+def test_idle_timeout_must_be_seconds(tmp_path):
+    for setting in ("idle_timeout: never", "idle_timeout: -5"):
+        path = tmp_path / "idle.yaml"
+        path.write_text("name: Idle\ncommand: /bin/true\n" + setting + "\n")
+        with pytest.raises(AssertionError):
+            config.JobConfiguration(config.Configuration(), config_path=str(path))
+
+
+def test_run_stats_settings_types(tmp_path):
+    for setting in ("adaptive_timeout: true", "adaptive_timeout:\n    factor: '3'", "adaptive_timeout:\n    min_runs: 2.5", "slow_run_factor: '3'"):
+        path = tmp_path / "adaptive.yaml"
+        path.write_text("name: Adaptive\ncommand: /bin/true\n" + setting + "\n")
+        with pytest.raises(AssertionError):
+            config.JobConfiguration(config.Configuration(), config_path=str(path))
+
+
+def test_tag_slash():
+    with pytest.raises(AssertionError):
+        load_config("tag_slash.yaml")
+
+
+def test_steps_cycle():
+    with pytest.raises(AssertionError) as error:
+        load_config("steps_cycle.yaml")
+    assert "cycle" in str(error.value)
+
+
+def test_steps_good():
+    configuration = load_config("steps.yaml")
+    assert configuration.step_dependencies("last") == ["first", "second"]
@@ -1,5 +1,7 @@
+import mock
 import os
 import os.path
+import pytest
 
 from processcontrol import crontab
 from processcontrol import config
@@ -45,3 +47,48 @@ def test_crontab():
 """
 
     assert expected == tab
+
+
+def test_crontab_unchanged_not_rewritten():
+    configuration = config.get_global_config()
+    output_file = configuration.get("output_crontab")
+    if os.path.exists(output_file):
+        os.unlink(output_file)
+
+    assert crontab.make_cron()
+    inode = os.stat(output_file).st_ino
+
+    assert not crontab.make_cron()
+    assert os.stat(output_file).st_ino == inode
+
+
+def test_crontab_diff(capsys):
+    configuration = config.get_global_config()
+    output_file = configuration.get("output_crontab")
+
+    crontab.make_cron()
+    with open(output_file, "a") as f:
+        f.write("# Stale entry\n")
+    capsys.readouterr()
+
+    assert crontab.make_cron(show_diff=True)
+    diff = capsys.readouterr().out
+    assert "-# Stale entry" in diff
+
+    # Diff mode doesn't touch the crontab.
+    with open(output_file, "r") as f:
+        assert f.read().endswith("# Stale entry\n")
+
+
+def test_crontab_rejects_invalid_schedule(tmp_path):
+    job_dir = tmp_path / "jobs"
+    job_dir.mkdir()
+    (job_dir / "good.yaml").write_text("name: Good\ncommand: /bin/true\nschedule: '*/5 * * * *'\n")
+    (job_dir / "bad.yaml").write_text("name: Bad\ncommand: /bin/true\nschedule: '61 * * * *'\n")
+
+    global_config = config.get_global_config()
+    with mock.patch.dict(global_config.values, {"job_directory": str(job_dir)}):
+        with pytest.raises(AssertionError) as error:
+            crontab.render_cron()
+
+    assert "bad: Job config invalid: Minute '61' is out of range 0-59" in str(error.value)
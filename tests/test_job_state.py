@@ -0,0 +1,183 @@
+import datetime
+import mock
+import os
+import threading
+
+from processcontrol import config
+from processcontrol import job_state
+from processcontrol import run_stats
+
+from . import override_config
+
+
+def setup_module():
+    override_config.start()
+
+
+def teardown_module():
+    override_config.stop()
+
+
+def state_config(tmp_path, **settings):
+    settings["state_directory"] = str(tmp_path)
+    return mock.patch.dict(config.get_global_config().values, settings)
+
+
+def run_history(state, statuses):
+    for status in statuses:
+        state.record_started(datetime.datetime.utcnow())
+        if status == "completed":
+            state.record_success()
+        elif status == "failed":
+            state.record_failure()
+        else:
+            state.record_skipped()
+
+
+def test_yaml_state(tmp_path):
+    with state_config(tmp_path, state_retention=4):
+        state = job_state.load_state("yamljob")
+        run_history(state, ["completed", "failed", "failed"])
+
+        reloaded = job_state.load_state("yamljob")
+        assert reloaded.last_completion_status == "failure"
+        assert reloaded.consecutive_failures == 2
+        assert len(reloaded.history) == 4
+
+
+def test_sqlite_state(tmp_path):
+    with state_config(tmp_path, state_backend="sqlite"):
+        state = job_state.load_state("dbjob")
+        assert isinstance(state.backend, job_state.SqliteStateBackend)
+        run_history(state, ["failed", "completed", "failed", "skipped", "failed"])
+
+        reloaded = job_state.load_state("dbjob")
+        assert reloaded.last_completion_status == "failure"
+        assert reloaded.consecutive_failures == 2
+        assert reloaded.history[-1]["status"] == "failed"
+
+        other = job_state.load_state("otherjob")
+        run_history(other, ["completed"])
+
+        failures = state.backend.runs(status="failed")
+        assert [run["slug"] for run in failures] == ["dbjob"] * 3
+        assert len(state.backend.runs(status="completed")) == 2
+
+
+def test_sqlite_retention(tmp_path):
+    with state_config(tmp_path, state_backend="sqlite", state_retention=3):
+        state = job_state.load_state("prunedjob")
+        run_history(state, ["completed"] * 5)
+
+        assert len(state.backend.runs(slug="prunedjob")) == 3
+
+    with state_config(tmp_path, state_backend="sqlite", state_retention=0):
+        state = job_state.load_state("keptjob")
+        run_history(state, ["completed"] * 25)
+
+        assert len(state.backend.runs(slug="keptjob")) == 50
+
+
+def test_import_yaml_statefiles(tmp_path):
+    with state_config(tmp_path):
+        state = job_state.load_state("legacyjob")
+        run_history(state, ["completed", "failed"])
+
+    with state_config(tmp_path, state_backend="sqlite"):
+        assert job_state.import_yaml_statefiles() == ["legacyjob"]
+        # Importing again leaves existing state alone.
+        assert job_state.import_yaml_statefiles() == []
+
+        imported = job_state.load_state("legacyjob")
+        assert imported.last_completion_status == "failure"
+        assert imported.consecutive_failures == 1
+        assert [run["status"] for run in imported.history] == ["started", "completed", "started", "failed"]
+
+
+def test_journal_state(tmp_path):
+    with state_config(tmp_path, state_backend="journal"):
+        state = job_state.load_state("journaljob")
+        run_history(state, ["completed", "failed", "skipped", "failed"])
+
+        with open(job_state.journal_path("journaljob"), "r") as f:
+            assert len(f.readlines()) == 8
+
+        reloaded = job_state.load_state("journaljob")
+        assert reloaded.last_completion_status == "failure"
+        assert reloaded.consecutive_failures == 2
+        assert reloaded.history[-1]["status"] == "failed"
+
+
+def test_journal_compaction(tmp_path):
+    with state_config(tmp_path, state_backend="journal", state_journal_max_bytes=200, state_retention=5):
+        state = job_state.load_state("compactedjob")
+        run_history(state, ["failed"] * 10)
+
+        with open(job_state.journal_path("compactedjob"), "r") as f:
+            assert len(f.readlines()) < 20
+
+        reloaded = job_state.load_state("compactedjob")
+        assert reloaded.last_completion_status == "failure"
+        assert reloaded.consecutive_failures == 10
+        assert len(reloaded.history) == 5
+
+
+def test_journal_load_during_compaction(tmp_path):
+    with state_config(tmp_path, state_backend="journal", state_retention=50):
+        state = job_state.load_state("busyjob")
+        run_history(state, ["failed"] * 3)
+
+        # Pause compaction between writing the snapshot and emptying the
+        # journal.
+        replaced = threading.Event()
+        resume = threading.Event()
+        real_replace = os.replace
+
+        def slow_replace(source, destination):
+            real_replace(source, destination)
+            replaced.set()
+            resume.wait(5)
+
+        with mock.patch("os.replace", slow_replace):
+            compactor = threading.Thread(target=state.backend.compact, args=("busyjob",))
+            compactor.start()
+            assert replaced.wait(5)
+
+            loaded = []
+            loader = threading.Thread(target=lambda: loaded.append(job_state.load_state("busyjob")))
+            loader.start()
+            loader.join(0.2)
+            # Waiting for compaction to finish.
+            assert not loaded
+
+            resume.set()
+            compactor.join()
+            loader.join()
+
+        assert loaded[0].consecutive_failures == 3
+        assert len(loaded[0].history) == 6
+
+
+def test_recent_durations(tmp_path):
+    for backend in ("yaml", "sqlite", "journal"):
+        with state_config(tmp_path, state_backend=backend, state_retention=3):
+            state = job_state.load_state("timedjob")
+            for duration in range(1, run_stats.DURATION_WINDOW + 11):
+                state.record_success({"duration": duration})
+            state.record_failure({"duration": 1000})
+
+            # Kept beyond the history, and only for successful runs.
+            reloaded = job_state.load_state("timedjob")
+            assert reloaded.recent_durations == list(range(11, run_stats.DURATION_WINDOW + 11))
+            assert reloaded.last_run()["status"] == "failed"
+
+
+def test_adaptive_timeout():
+    durations = [10] * 18 + [20, 30]
+    assert run_stats.percentile(durations, 95) == 20
+    assert run_stats.usual_duration(durations) == 10
+    assert run_stats.adaptive_timeout(durations, floor=0, factor=3) == 60
+    assert run_stats.adaptive_timeout(durations, floor=120, factor=3) == 120
+    # Not enough history yet.
+    assert run_stats.adaptive_timeout(durations[:4], floor=120, factor=3) == 120
+    assert run_stats.usual_duration(durations[:4]) is None
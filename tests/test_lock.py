@@ -1,12 +1,23 @@
+import fcntl
 import logging
+import mock
+import multiprocessing
 import os.path
+import signal
+import time
 
 from processcontrol import config
 from processcontrol import lock
 
+from . import override_config
+
 
 def setup_module():
-    config.setup_logging()
+    override_config.start()
+
+
+def teardown_module():
+    override_config.stop()
 
 
 def tearDown():
@@ -96,3 +107,247 @@ def test_double_unlock():
 
     # Should silently have nothing to do.
     lock.end()
+
+
+def flock_backend():
+    return mock.patch.dict(config.get_global_config().values, {"lock_backend": "flock"})
+
+
+def test_flock_live_lock():
+    with flock_backend():
+        lock.begin(slug="flock-live")
+        path = lock.lockfile
+        assert lock.holder("flock-live") == (os.getpid(), True)
+
+        try:
+            lock.begin(slug="flock-live")
+            assert False, "Should have been locked"
+        except lock.LockError as e:
+            assert e.code == lock.LockError.LOCK_EXISTS
+            assert "({pid})".format(pid=os.getpid()) in str(e)
+
+        lock.end()
+        assert not os.path.exists(path)
+        assert lock.holder("flock-live") is None
+
+
+def test_flock_wait_file():
+    with flock_backend():
+        lock.begin(slug="flock-wait-file")
+        wait_file = lock.wait_path("flock-wait-file")
+        assert lock.is_held(wait_file)
+
+        lock.end()
+        assert not os.path.exists(wait_file)
+
+
+def lock_without_pid(slug, locked, seconds):
+    """Take the lock like begin_flock(), but stall before writing our pid."""
+    fd = os.open(lock.path_for_job(slug), os.O_RDWR | os.O_CREAT, 0o664)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    locked.set()
+    time.sleep(0.02)
+    lock.publish_wait_file(lock.wait_path(slug))
+    time.sleep(seconds)
+
+
+def test_flock_holder_before_pid_written():
+    with flock_backend():
+        context = multiprocessing.get_context("fork")
+        locked = context.Event()
+        taker = context.Process(target=lock_without_pid, args=("flock-no-pid", locked, 1))
+        taker.start()
+        locked.wait()
+
+        # Locked, even though there's no pid yet.
+        assert lock.holder("flock-no-pid") == (None, True)
+        taker.join()
+        os.unlink(lock.path_for_job("flock-no-pid"))
+
+
+def test_flock_holder_leaves_lockfile_alone():
+    with flock_backend():
+        holder = start_holder("flock-probe", 0.5)
+        path = lock.path_for_job("flock-probe")
+        locked_paths = []
+        flock = fcntl.flock
+
+        def record_flock(fd, operation):
+            locked_paths.append(os.readlink("/proc/self/fd/{fd}".format(fd=fd)))
+            return flock(fd, operation)
+
+        with mock.patch("fcntl.flock", side_effect=record_flock):
+            assert lock.holder("flock-probe") == (holder.pid, True)
+        holder.join()
+
+        # Probing the lockfile would make it look locked to a run which
+        # doesn't wait.
+        assert locked_paths
+        assert path not in locked_paths
+
+
+def hold_lock_forever(slug):
+    lock.begin(slug=slug)
+    time.sleep(60)
+
+
+def test_flock_released_when_holder_dies():
+    with flock_backend():
+        context = multiprocessing.get_context("fork")
+        holder = context.Process(target=hold_lock_forever, args=("flock-dead",))
+        holder.start()
+        while lock.holder("flock-dead") is None:
+            time.sleep(0.01)
+        assert lock.holder("flock-dead") == (holder.pid, True)
+
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+
+        # The lockfile is left behind, but nobody holds it.
+        assert lock.holder("flock-dead") == (holder.pid, False)
+        lock.begin(slug="flock-dead")
+        assert lock.holder("flock-dead") == (os.getpid(), True)
+        lock.end()
+
+
+def increment_under_lock(slug, counter_path, rounds):
+    """Increment a counter non-atomically, each time holding the lock."""
+    done = 0
+    while done < rounds:
+        try:
+            lock.begin(slug=slug)
+        except lock.LockError:
+            continue
+        with open(counter_path, "r") as f:
+            count = int(f.read())
+        with open(counter_path, "w") as f:
+            f.write(str(count + 1))
+        lock.end()
+        done += 1
+
+
+def test_flock_concurrent_processes(tmpdir):
+    counter_path = str(tmpdir.join("counter"))
+    with open(counter_path, "w") as f:
+        f.write("0")
+
+    with flock_backend():
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=increment_under_lock, args=("flock-many", counter_path, 20))
+            for _ in range(8)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+    # No increments were lost, so no two processes held the lock at once.
+    with open(counter_path, "r") as f:
+        assert int(f.read()) == 160
+
+
+def hold_lock_for(slug, seconds):
+    lock.begin(slug=slug)
+    time.sleep(seconds)
+    lock.end()
+
+
+def start_holder(slug, seconds):
+    """Hold the lock from another process, returning once it is held."""
+    holder = multiprocessing.get_context("fork").Process(target=hold_lock_for, args=(slug, seconds))
+    holder.start()
+    while lock.holder(slug) is None:
+        time.sleep(0.01)
+    return holder
+
+
+def wait_and_record(slug, log_path, strategy):
+    lock.begin(slug=slug, max_wait=10, strategy=strategy, max_queue=5)
+    with open(log_path, "a") as f:
+        f.write("{pid}\n".format(pid=os.getpid()))
+    lock.end()
+
+
+def check_fifo(tmpdir, strategy):
+    slug = "fifo-" + strategy
+    log_path = str(tmpdir.join("order"))
+    holder = start_holder(slug, 1)
+
+    context = multiprocessing.get_context("fork")
+    waiters = []
+    for _ in range(4):
+        waiter = context.Process(target=wait_and_record, args=(slug, log_path, strategy))
+        waiter.start()
+        waiters.append(waiter)
+        # Let it take its ticket before the next one arrives.
+        time.sleep(0.1)
+
+    for process in [holder] + waiters:
+        process.join()
+    with open(log_path) as f:
+        assert [int(line) for line in f] == [waiter.pid for waiter in waiters]
+
+
+def test_wait_poll_fifo(tmpdir):
+    check_fifo(tmpdir, "poll")
+
+
+def test_wait_notify_fifo(tmpdir):
+    with flock_backend():
+        check_fifo(tmpdir, "notify")
+
+
+def test_wait_for_lock():
+    with flock_backend():
+        holder = start_holder("wait-notify", 0.5)
+        waited = lock.begin(slug="wait-notify", max_wait=5, strategy="notify")
+        holder.join()
+        assert 0.2 < waited < 2
+        assert lock.holder("wait-notify") == (os.getpid(), True)
+        lock.end()
+
+
+def test_wait_leaves_lockfile_alone():
+    with flock_backend():
+        holder = start_holder("wait-elsewhere", 0.5)
+        with mock.patch("processcontrol.lock.wait_for_unlock", side_effect=lambda path, timeout: time.sleep(0.05)) as wait:
+            lock.begin(slug="wait-elsewhere", max_wait=5, strategy="notify")
+        holder.join()
+        lock.end()
+
+        # Waiting on the lockfile would make it look locked to runs which
+        # don't wait.
+        assert wait.call_args_list
+        for call in wait.call_args_list:
+            assert call[0][0] == lock.wait_path("wait-elsewhere")
+
+
+def test_wait_gives_up():
+    holder = start_holder("wait-timeout", 2)
+    start = time.monotonic()
+    try:
+        lock.begin(slug="wait-timeout", max_wait=0.5)
+        assert False, "Should have given up"
+    except lock.LockError as e:
+        assert e.code == lock.LockError.LOCK_EXISTS
+    assert time.monotonic() - start < 1.5
+    holder.join()
+
+
+def test_wait_queue_depth(tmpdir):
+    holder = start_holder("wait-depth", 1)
+    waiter = multiprocessing.get_context("fork").Process(
+        target=wait_and_record, args=("wait-depth", str(tmpdir.join("order")), "poll"))
+    waiter.start()
+    time.sleep(0.2)
+
+    try:
+        lock.begin(slug="wait-depth", max_wait=5, max_queue=1)
+        assert False, "Should not queue behind another waiter"
+    except lock.LockError as e:
+        assert "already waiting" in str(e)
+
+    holder.join()
+    waiter.join()
@@ -0,0 +1,99 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from processcontrol import job_spec
+from processcontrol import log_reader
+from processcontrol import log_retention
+from processcontrol import output_streamer
+from processcontrol import runner
+
+from . import override_config
+
+
+output_directory = None
+
+# 2024-01-01 00:00:00 UTC, which starts the logs written below.
+START = 1704067200
+
+
+def setup_function():
+    global output_directory
+    output_directory = tempfile.mkdtemp()
+    override_config.start(extra={"output_directory": output_directory})
+
+
+def teardown_function():
+    override_config.stop()
+    shutil.rmtree(output_directory)
+
+
+def write_log(slug, start, count, compress=False):
+    """Write a log with one line per minute from `start`, indexing every
+    other line.  Returns the lines."""
+    log_directory = log_retention.job_log_directory(slug)
+    os.makedirs(log_directory, exist_ok=True)
+    path = "{dir}/{slug}-{stamp}.log".format(
+        dir=log_directory, slug=slug, stamp=time.strftime("%Y%m%d-%H%M%S", time.gmtime(start)))
+
+    lines = []
+    index = []
+    offset = 0
+    for minute in range(count):
+        now = start + minute * 60
+        line = output_streamer.format_lines(["line {n}".format(n=minute)], "INFO", "", now)
+        if minute % 2 == 0:
+            index.append("{time:.3f}\t{offset}\n".format(time=now, offset=offset))
+        lines.append(line)
+        offset += len(line)
+
+    if compress:
+        with gzip.open(path + ".gz", "wb") as f:
+            f.write(b"".join(lines))
+        path += ".gz"
+    else:
+        with open(path, "wb") as f:
+            f.write(b"".join(lines))
+    os.utime(path, (start + count * 60, start + count * 60))
+    with open(output_streamer.index_path(path), "w") as f:
+        f.write("".join(index))
+    return lines
+
+
+def test_seek_offset():
+    entries = [(10.0, 0), (20.0, 100), (30.0, 200)]
+    assert log_reader.seek_offset(entries, 5) == 0
+    assert log_reader.seek_offset(entries, 25) == 100
+    assert log_reader.seek_offset(entries, 30) == 100
+    assert log_reader.seek_offset(entries, 99) == 200
+
+
+def test_time_range_across_logs():
+    old_lines = write_log("ranged", START, 10, compress=True)
+    new_lines = write_log("ranged", START + 3600, 10)
+
+    lines = list(log_reader.read_lines("ranged", since=START + 5 * 60, until=START + 3600 + 2 * 60))
+
+    assert lines == old_lines[5:] + new_lines[:3]
+
+
+def test_tail():
+    old_lines = write_log("tailed", START, 10, compress=True)
+    new_lines = write_log("tailed", START + 3600, 3)
+
+    assert list(log_reader.read_lines("tailed", tail=2)) == new_lines[1:]
+    assert list(log_reader.read_lines("tailed", tail=5)) == old_lines[8:] + new_lines
+    assert list(log_reader.read_lines("tailed", since=START, until=START + 5 * 60, tail=2)) == old_lines[4:6]
+
+
+def test_streamer_writes_index():
+    runner.JobRunner(job_spec.load("which_out")).run()
+
+    path = log_retention.list_logs("which_out")[0]
+    entries = log_reader.read_index(path)
+    assert entries[0][1] == 0
+
+    lines = list(log_reader.read_lines("which_out", since=entries[0][0]))
+    assert lines[-1].endswith(b"----------- end command output\n")
@@ -0,0 +1,82 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from processcontrol import catalog
+from processcontrol import log_retention
+
+from . import override_config
+
+
+output_directory = None
+
+
+def setup_function():
+    global output_directory
+    output_directory = tempfile.mkdtemp()
+    override_config.start(extra={
+        "output_directory": output_directory,
+        "log_retention": {"compress": True},
+    })
+
+
+def teardown_function():
+    override_config.stop()
+    shutil.rmtree(output_directory)
+
+
+def make_logs(slug, count, size=100, age=0):
+    """Write count logs, the newest last, and return their paths."""
+    log_directory = log_retention.job_log_directory(slug)
+    os.makedirs(log_directory, exist_ok=True)
+    paths = []
+    for index in range(count):
+        path = "{dir}/{slug}-20240101-{index:06d}.log".format(dir=log_directory, slug=slug, index=index)
+        with open(path, "w") as f:
+            f.write("x" * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        paths.append(path)
+    return paths
+
+
+def test_compress_all_but_newest():
+    paths = make_logs("successful", 3)
+
+    removed, compressed = log_retention.tidy_job_logs("successful", log_retention.policy_for_job())
+
+    assert (removed, compressed) == (0, 2)
+    assert os.path.exists(paths[2])
+    assert not os.path.exists(paths[0])
+    with gzip.open(paths[0] + ".gz", "rt") as f:
+        assert f.read() == "x" * 100
+
+
+def test_prune_by_count_age_and_size():
+    policy = dict(log_retention.policy_for_job(), compress=False)
+
+    paths = make_logs("by_count", 5)
+    log_retention.tidy_job_logs("by_count", dict(policy, max_count=2))
+    assert [os.path.exists(path) for path in paths] == [False, False, False, True, True]
+
+    paths = make_logs("by_age", 3, age=3 * 86400)
+    log_retention.tidy_job_logs("by_age", dict(policy, max_age_days=2))
+    # The newest log always survives.
+    assert [os.path.exists(path) for path in paths] == [False, False, True]
+
+    paths = make_logs("by_size", 4)
+    log_retention.tidy_job_logs("by_size", dict(policy, max_bytes=250))
+    assert [os.path.exists(path) for path in paths] == [False, False, True, True]
+
+
+def test_prune_all():
+    make_logs("successful", 3)
+    # A job which has since been removed.
+    make_logs("retired", 2)
+
+    totals = log_retention.prune_all(catalog.JobCatalog())
+
+    assert totals["successful"] == (0, 2)
+    assert totals["retired"] == (0, 1)
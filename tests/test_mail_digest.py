@@ -0,0 +1,92 @@
+import email
+import mock
+import shutil
+import tempfile
+import time
+
+from processcontrol import job_spec
+from processcontrol import mail_digest
+from processcontrol import mail_spool
+from processcontrol import mailer
+
+from . import override_config
+
+
+spool_directory = None
+
+
+def setup_function():
+    global spool_directory
+    spool_directory = tempfile.mkdtemp()
+    override_config.start(extra={
+        "failmail_spool": {"directory": spool_directory, "digest_window": 600, "repeat_interval": 3600},
+    })
+
+
+def teardown_function():
+    override_config.stop()
+    shutil.rmtree(spool_directory)
+
+
+def record(slug, reason, when):
+    return {
+        "kind": "failure",
+        "from": "from@localhost",
+        "to": "to@localhost",
+        "job": slug,
+        "name": slug.capitalize(),
+        "reason": reason,
+        "logfile": "/tmp/{slug}.log".format(slug=slug),
+        "time": when,
+    }
+
+
+def test_build_groups_and_counts():
+    records = [
+        record("dbjob", "Lock held by 123", 1000),
+        record("dbjob", "Lock held by 456", 1100),
+        record("queuejob", "Queue full", 1050),
+    ]
+
+    messages, state = mail_digest.build(records, {}, 2000, 3600)
+
+    assert len(messages) == 1
+    message = email.message_from_string(messages[0][2])
+    assert message["Subject"].endswith("run-job: 3 failure(s) of dbjob, queuejob")
+    body = message.get_payload()
+    assert "Dbjob (dbjob): Lock held by 456" in body
+    assert "2 failure(s)" in body
+    assert sorted(state) == ["dbjob\tLock held by #", "queuejob\tQueue full"]
+
+
+def test_build_rate_limits_repeats():
+    state = {"dbjob\tLock held by #": 1500}
+    records = [
+        record("dbjob", "Lock held by 789", 2000),
+        record("queuejob", "Queue full", 2000),
+    ]
+
+    messages, state = mail_digest.build(records, state, 2100, 3600)
+    body = email.message_from_string(messages[0][2]).get_payload()
+    assert "Dbjob" not in body
+    assert "reasons already reported: dbjob (1)" in body
+    assert state["dbjob\tLock held by #"] == 1500
+
+    # Nothing new to say.
+    messages, _ = mail_digest.build([record("dbjob", "Lock held by 1", 2200)], state, 2300, 3600)
+    assert messages == []
+
+
+@mock.patch("smtplib.SMTP")
+def test_digest_waits_for_window(MockSmtp):
+    for slug in ("return_code", "timeout"):
+        mailer.Mailer(job_spec.load(slug)).fail_mail("Database is down")
+
+    mail_spool.flush()
+    MockSmtp().sendmail.assert_not_called()
+    assert len(mail_spool.pending(spool_directory)) == 2
+
+    with mock.patch("time.time", return_value=time.time() + 601):
+        assert mail_spool.flush() == 1
+    MockSmtp().sendmail.assert_called_once()
+    assert mail_spool.pending(spool_directory) == []
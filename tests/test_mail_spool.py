@@ -0,0 +1,92 @@
+import json
+import mock
+import os
+import shutil
+import smtplib
+import tempfile
+
+from processcontrol import job_spec
+from processcontrol import mail_spool
+from processcontrol import mailer
+
+from . import override_config
+
+
+spool_directory = None
+
+
+def setup_function():
+    global spool_directory
+    spool_directory = tempfile.mkdtemp()
+    override_config.start(extra={
+        "failmail_spool": {"directory": spool_directory, "retry_interval": 60, "max_attempts": 2},
+    })
+
+
+def teardown_function():
+    override_config.stop()
+    shutil.rmtree(spool_directory)
+
+
+@mock.patch("smtplib.SMTP")
+def test_fail_mail_is_spooled(MockSmtp):
+    job = job_spec.load("return_code")
+    mailer.Mailer(job).fail_mail("Oops", logfile="/tmp/oops.log")
+
+    MockSmtp.assert_not_called()
+    paths = mail_spool.pending(spool_directory)
+    assert len(paths) == 1
+    with open(paths[0]) as f:
+        entry = json.load(f)
+    assert "Subject: Fail Mail" in entry["message"]
+    assert entry["to"] == "fr-tech@wikimedia.org"
+
+
+@mock.patch("smtplib.SMTP")
+def test_flush_reuses_connection(MockSmtp):
+    for _ in range(3):
+        mail_spool.spool("from@localhost", "to@localhost", "Subject: test\n\nbody")
+
+    assert mail_spool.flush() == 3
+
+    MockSmtp.assert_called_once()
+    assert MockSmtp().sendmail.call_count == 3
+    assert mail_spool.pending(spool_directory) == []
+
+
+@mock.patch("smtplib.SMTP")
+def test_flush_backs_off(MockSmtp):
+    MockSmtp.side_effect = ConnectionRefusedError("No server")
+    mail_spool.spool("from@localhost", "to@localhost", "Subject: first\n\nbody")
+    mail_spool.spool("from@localhost", "to@localhost", "Subject: second\n\nbody")
+
+    first = mail_spool.pending(spool_directory)[0]
+    assert mail_spool.flush() == 0
+    # Gave up on the connection after the first message.
+    assert MockSmtp.call_count == 1
+    with open(mail_spool.pending(spool_directory)[0]) as f:
+        entry = json.load(f)
+    assert entry["attempts"] == 1
+    assert "No server" in entry["last_error"]
+
+    # Only the second message is due.
+    mail_spool.flush()
+    assert MockSmtp.call_count == 2
+
+    with mock.patch("time.time", return_value=entry["next_attempt"] + 1):
+        mail_spool.flush()
+    # The second attempt was the last one allowed.
+    assert os.listdir(os.path.join(spool_directory, "failed")) == [os.path.basename(first)]
+    assert len(mail_spool.pending(spool_directory)) == 1
+
+
+@mock.patch("smtplib.SMTP")
+def test_refused_message_keeps_connection(MockSmtp):
+    MockSmtp().sendmail.side_effect = [smtplib.SMTPRecipientsRefused({}), {}]
+    MockSmtp.reset_mock()
+    mail_spool.spool("from@localhost", "nobody", "Subject: refused\n\nbody")
+    mail_spool.spool("from@localhost", "to@localhost", "Subject: sent\n\nbody")
+
+    assert mail_spool.flush() == 1
+    MockSmtp.assert_called_once()
+    assert len(mail_spool.pending(spool_directory)) == 1
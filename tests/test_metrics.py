@@ -0,0 +1,74 @@
+import mock
+import threading
+import time
+
+from processcontrol import config
+from processcontrol import job_spec
+from processcontrol import metrics
+from processcontrol import runner
+
+from . import override_config
+
+
+def setup_module():
+    override_config.start()
+
+
+def teardown_module():
+    override_config.stop()
+
+
+def test_record_run(tmp_path):
+    with mock.patch.dict(config.get_global_config().values, {"metrics_directory": str(tmp_path)}):
+        metrics.record_run("metered", {"status": "completed", "duration": 1.5}, 0, output_bytes=10)
+        metrics.record_run("metered", {"status": "failed", "duration": 2}, 1, output_bytes=5, lock_contention=True)
+
+        samples = metrics.read_samples(metrics.metrics_path("metered"))
+
+    assert samples[("process_control_job_runs_total", "completed")] == 1
+    assert samples[("process_control_job_runs_total", "failed")] == 1
+    assert samples[("process_control_job_output_bytes_total", None)] == 15
+    assert samples[("process_control_job_last_output_bytes", None)] == 5
+    assert samples[("process_control_job_last_duration_seconds", None)] == 2
+    assert samples[("process_control_job_consecutive_failures", None)] == 1
+    assert samples[("process_control_job_lock_contention_total", None)] == 1
+    assert ("process_control_job_last_success_timestamp_seconds", None) in samples
+
+
+def test_runner_exports_metrics(tmp_path):
+    with mock.patch.dict(config.get_global_config().values, {"metrics_directory": str(tmp_path)}):
+        job = job_spec.load("which_out")
+        runner.JobRunner(job).run()
+
+        with open(metrics.metrics_path("which_out"), "r") as f:
+            text = f.read()
+
+    assert 'process_control_job_runs_total{job="which_out",status="completed"} 1\n' in text
+    assert "# TYPE process_control_job_runs_total counter\n" in text
+    samples = metrics.read_samples(str(tmp_path / "process_control_which_out.prom"))
+    assert samples[("process_control_job_output_bytes_total", None)] > 0
+
+
+def test_concurrent_runs_keep_counts(tmp_path):
+    read_samples = metrics.read_samples
+
+    def slow_read(path):
+        samples = read_samples(path)
+        # Give the other runs every chance to read the same counters.
+        time.sleep(0.05)
+        return samples
+
+    with mock.patch.dict(config.get_global_config().values, {"metrics_directory": str(tmp_path)}):
+        with mock.patch("processcontrol.metrics.read_samples", side_effect=slow_read):
+            threads = [
+                threading.Thread(target=metrics.record_run, args=("metered", {"status": "completed"}, 0))
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        samples = metrics.read_samples(metrics.metrics_path("metered"))
+
+    assert samples[("process_control_job_runs_total", "completed")] == 4
@@ -0,0 +1,121 @@
+import datetime
+import mock
+import pytest
+
+from processcontrol import output_streamer
+from processcontrol import job_spec
+from processcontrol import job_state
+from processcontrol import runner
+
+from . import override_config
+
+
+def setup_module():
+    override_config.start()
+
+
+def teardown_module():
+    override_config.stop()
+
+
+def make_streamer(**kwargs):
+    process = mock.Mock(pid=1234)
+    streamer = output_streamer.OutputStreamer(process, "streamer_test", "test", datetime.datetime.utcnow(), **kwargs)
+    streamer.mirror = False
+    streamer.written = []
+    streamer.write_lines = lambda lines, level: streamer.written.extend((level, line) for line in lines)
+    return streamer
+
+
+def test_lines_across_chunks():
+    streamer = make_streamer()
+    streamer.feed(b"first\nsec", False)
+    streamer.feed(b"ond\nthird", False)
+    streamer.feed(b"oops\n", True)
+    streamer.finish(False)
+
+    assert streamer.written == [
+        ("INFO", "first"),
+        ("INFO", "second"),
+        ("ERROR", "oops"),
+        ("INFO", "third"),
+    ]
+    assert streamer.bytes_read == 23
+
+
+def test_long_line_split():
+    streamer = make_streamer(max_line_length=4)
+    streamer.feed(b"abcdefghij", False)
+    # Memory stays bounded while the line is still coming.
+    assert len(streamer.partial[False]) <= 4
+    streamer.feed(b"k\nxy\n", False)
+
+    assert streamer.written == [
+        ("INFO", "abcd [line split]"),
+        ("INFO", "efgh [line split]"),
+        ("INFO", "ijk"),
+        ("INFO", "xy"),
+    ]
+
+
+def test_long_line_truncate():
+    streamer = make_streamer(max_line_length=4, long_lines="truncate")
+    streamer.feed(b"abcdefghij", False)
+    streamer.feed(b"klmnop", False)
+    streamer.feed(b"qrs\nxy\nlonglonglong\nz", False)
+    streamer.finish(False)
+
+    assert streamer.written == [
+        ("INFO", "abcd [line truncated]"),
+        ("INFO", "xy"),
+        ("INFO", "long [line truncated]"),
+        ("INFO", "z"),
+    ]
+
+
+def test_split_keeps_characters_whole():
+    streamer = make_streamer(max_line_length=4)
+    streamer.feed("aaaébb\n".encode("utf-8"), False)
+
+    assert streamer.written == [
+        ("INFO", "aaa [line split]"),
+        ("INFO", "ébb"),
+    ]
+
+
+def test_output_budget():
+    on_limit = mock.Mock()
+    streamer = make_streamer(budget=output_streamer.OutputBudget(8), on_limit=on_limit)
+    streamer.feed(b"1234\n", False)
+    streamer.feed(b"5678\n", False)
+    streamer.feed(b"more\n", False)
+    streamer.finish(False)
+
+    assert streamer.written == [
+        ("INFO", "1234"),
+        ("ERROR", "[output limit of 8 bytes reached, discarding further output]"),
+        ("INFO", "567"),
+    ]
+    on_limit.assert_called_once_with()
+    assert streamer.limit_reached
+
+
+def test_output_tail():
+    tail = output_streamer.OutputTail(2)
+    streamer = make_streamer(tail=tail, max_line_length=2000)
+    streamer.feed(b"one\ntwo\n", False)
+    streamer.feed(b"x" * 1500 + b"\n", True)
+
+    assert tail.get() == ["INFO\ttwo", "ERROR\t" + "x" * 1000 + " [...]"]
+
+
+@pytest.mark.timeout(5)
+@mock.patch("smtplib.SMTP")
+def test_output_limit_kills_job(MockSmtp, caplog):
+    job = job_spec.load("chatty")
+    runner.JobRunner(job).run()
+
+    assert "Chatty job exceeded the output limit of 10000 bytes" in caplog.text
+    failed = job_state.load_state("chatty").history[-1]
+    assert failed["status"] == "failed"
+    assert failed["output_limited"]
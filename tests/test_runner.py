@@ -1,11 +1,19 @@
+import email
 import glob
 import logging
 import mock
+import multiprocessing
 import os
 import pytest
+import signal
+import subprocess
+import time
 
 from processcontrol import runner
 from processcontrol import job_spec
+from processcontrol import job_state
+from processcontrol import lock
+from processcontrol import resource_limits
 
 from . import override_config
 
@@ -66,22 +74,93 @@ def test_timeout(MockSmtp, caplog):
     MockSmtp().sendmail.assert_called_once()
 
 
+@mock.patch("smtplib.SMTP")
+def test_run_details(MockSmtp):
+    run_job("successful")
+
+    completed = job_state.load_state("successful").history[-1]
+    assert completed["status"] == "completed"
+    assert completed["duration"] >= 0
+    assert completed["exit_code"] == 0
+    command = completed["commands"][0]
+    assert command["command"] == "/bin/true"
+    assert command["rusage"]["max_rss"] > 0
+
+    run_job("timeout")
+
+    failed = job_state.load_state("timeout").history[-1]
+    assert failed["status"] == "failed"
+    assert failed["signal"] == "SIGTERM"
+
+
+def is_running(pid):
+    """Test whether a process exists and isn't a zombie."""
+    try:
+        with open("/proc/{pid}/stat".format(pid=pid), "r") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state != "Z"
+
+
+def output_pids(slug):
+    return [int(line.split("\t")[-1]) for line in get_output_lines(slug) if line.split("\t")[-1].isdigit()]
+
+
+@pytest.mark.timeout(10)
+@mock.patch("smtplib.SMTP")
+def test_timeout_kills_process_group(MockSmtp, caplog):
+    run_job("grandchildren")
+
+    failed = job_state.load_state("grandchildren").history[-1]
+    assert failed["status"] == "failed"
+    # The shell ignored SIGTERM, so it took SIGKILL.
+    assert failed["signal"] == "SIGKILL"
+
+    pids = output_pids("grandchildren")
+    assert len(pids) == 2
+    for pid in pids:
+        assert not is_running(pid)
+
+
+@pytest.mark.timeout(10)
+def test_leftover_process_killed(caplog):
+    run_job("leftover")
+
+    completed = job_state.load_state("leftover").history[-1]
+    assert completed["status"] == "completed"
+    assert "INFO\t----------- end command output" in get_output_lines("leftover")
+
+    pids = output_pids("leftover")
+    assert len(pids) == 1
+    assert not is_running(pids[0])
+    assert any("killing leftover processes" in message for message in caplog.messages)
+
+
 @mock.patch("smtplib.SMTP")
 def test_stderr(MockSmtp, caplog):
     """Test that stderr is being routed to the log."""
     run_job("errors")
 
     # FIXME: Use an included script, 'cos even posix output may change some day.
-    assert ("errors", logging.ERROR, "grep: Invalid regular expression") in \
-        caplog.record_tuples
     # TODO: Should we go out of our way to log the non-zero return code as well?
-
     lines = get_output_lines("errors")
     assert "ERROR\tgrep: Invalid regular expression" in lines
 
     MockSmtp().sendmail.assert_called_once()
 
 
+@mock.patch("smtplib.SMTP")
+def test_failmail_tail(MockSmtp):
+    run_job("errors")
+
+    message = email.message_from_string(MockSmtp().sendmail.call_args[0][2])
+    body = message.get_payload(decode=True).decode("utf-8")
+    assert body.startswith("Exit code 2 after ")
+    assert "Last lines of output:\n    ERROR\tgrep: Invalid regular expression" in body
+    assert "See the logs for more information: /tmp/errors/errors-" in body
+
+
 def test_store_output():
     run_job("which_out")
 
@@ -91,6 +170,20 @@ def test_store_output():
         or "INFO\t/usr/bin/bash" in lines
 
 
+def test_raw_output():
+    run_job("raw_out")
+
+    lines = get_output_lines("raw_out")
+    # The header is still written, but output is copied as-is.
+    assert "INFO\t/bin/sh -c \"echo to stdout; echo to stderr >&2\"" in lines
+    assert "to stdout" in lines
+    assert "to stderr" in lines
+    assert lines[-2].startswith("INFO\t----------- end command output (")
+
+    completed = job_state.load_state("raw_out").history[-1]
+    assert completed["status"] == "completed"
+
+
 def test_slow_start():
     run_job("alt_command_job")
 
@@ -119,8 +212,160 @@ def test_environment():
     assert "INFO\tMYENV=pre-existing" in lines
 
 
+@pytest.mark.timeout(5)
+def test_terminate_while_holding_process_lock():
+    job_runner = runner.JobRunner(job_spec.load("successful"))
+    job_runner.escalations = []
+    process = subprocess.Popen(["sleep", "10"], start_new_session=True)
+    with job_runner.process_lock:
+        job_runner.processes[process.pid] = process
+        # As if SIGTERM arrived while the main thread was in spawn().
+        job_runner.terminate(signal.SIGTERM)
+    assert process.wait() == -signal.SIGTERM
+    job_runner.finish_kills()
+
+
 def test_symlink():
     '''Prevent running any job config outside the job_directory.'''
 
     with pytest.raises(AssertionError):
         run_job("symlink")
+
+
+@pytest.mark.timeout(5)
+def test_parallel_steps():
+    run_job("steps")
+
+    lines = get_output_lines("steps")
+    assert "INFO\t[last] all done" in lines
+    assert lines.index("INFO\t[last] all done") > lines.index("INFO\t[first] ----------- end command output")
+
+    completed = job_state.load_state("steps").history[-1]
+    assert completed["status"] == "completed"
+    assert set(completed["steps"]) == {"first", "second", "last"}
+    # The two sleeps overlapped.
+    assert completed["duration"] < 0.9
+
+
+@mock.patch("smtplib.SMTP")
+def test_failing_step_wait_all(MockSmtp, caplog):
+    run_job("steps_failing")
+
+    lines = get_output_lines("steps_failing")
+    assert "INFO\t[independent] still ran" in lines
+    assert "INFO\t[after_broken] should not run" not in lines
+
+    failed = job_state.load_state("steps_failing").history[-1]
+    assert failed["status"] == "failed"
+    assert failed["steps"]["broken"]["status"] == "failed"
+    assert failed["steps"]["independent"]["status"] == "completed"
+    assert failed["steps"]["after_broken"]["status"] == "skipped"
+
+    MockSmtp().sendmail.assert_called_once()
+
+
+@pytest.mark.timeout(5)
+@mock.patch("smtplib.SMTP")
+def test_failing_step_fail_fast(MockSmtp):
+    run_job("steps_fail_fast")
+
+    failed = job_state.load_state("steps_fail_fast").history[-1]
+    assert failed["status"] == "failed"
+    assert failed["steps"]["broken"]["status"] == "failed"
+    assert failed["steps"]["slow"]["status"] == "aborted"
+
+
+def hold_lock_briefly(slug):
+    lock.begin(slug=slug)
+    time.sleep(0.5)
+    lock.end()
+
+
+def test_lock_wait():
+    holder = multiprocessing.get_context("fork").Process(target=hold_lock_briefly, args=("lock_wait",))
+    holder.start()
+    while lock.holder("lock_wait") is None:
+        time.sleep(0.01)
+
+    run_job("lock_wait")
+    holder.join()
+
+    state = job_state.load_state("lock_wait")
+    completed = state.history[-1]
+    assert completed["status"] == "completed"
+    assert completed["lock_wait"] > 0.2
+    # Waiting doesn't count towards how long the job usually takes.
+    assert completed["duration"] > 0.2
+    assert completed["run_duration"] < 0.2
+    assert state.recent_durations[-1] == completed["run_duration"]
+
+
+@pytest.mark.timeout(5)
+@mock.patch("smtplib.SMTP")
+def test_idle_timeout(MockSmtp, caplog):
+    run_job("stalling")
+
+    assert ("root", logging.ERROR, "Stalling job stalled, with no output for 0.5 seconds") in caplog.record_tuples
+    assert "ERROR\t[no output for 0.5 seconds]" in get_output_lines("stalling")
+    failed = job_state.load_state("stalling").history[-1]
+    assert failed["status"] == "failed"
+    assert failed["stalled"] is True
+    MockSmtp().sendmail.assert_called_once()
+
+    # Regular output keeps the job alive, however long it takes.
+    run_job("ticking")
+
+    completed = job_state.load_state("ticking").history[-1]
+    assert completed["status"] == "completed"
+    assert "stalled" not in completed
+
+
+def seed_durations(slug, duration, count):
+    """Start the job's history over with a few successful runs."""
+    if os.path.exists(job_state.statefile_path(slug)):
+        os.unlink(job_state.statefile_path(slug))
+    state = job_state.load_state(slug)
+    for _ in range(count):
+        state.record_success({"duration": duration})
+
+
+@pytest.mark.timeout(5)
+@mock.patch("smtplib.SMTP")
+def test_adaptive_timeout(MockSmtp, caplog):
+    seed_durations("adaptive", 0.1, 5)
+    run_job("adaptive")
+
+    assert ("root", logging.ERROR, "Adaptive timeout job timed out after 0.3 seconds (adaptive timeout)") in \
+        caplog.record_tuples
+    failed = job_state.load_state("adaptive").history[-1]
+    assert failed["status"] == "failed"
+    assert failed["timeout"] == pytest.approx(0.3)
+
+
+def test_slow_run(caplog):
+    seed_durations("slow", 0.05, 5)
+    run_job("slow")
+
+    completed = job_state.load_state("slow").history[-1]
+    assert completed["status"] == "completed"
+    assert completed["slow"] is True
+    assert any("more than 2 times its usual 0.1 seconds" in message for message in caplog.messages)
+
+
+def test_resource_limits():
+    run_job("limited")
+
+    lines = get_output_lines("limited")
+    assert "INFO\tresources: cpu_seconds=60 open_files=64 nice=5 ionice=idle cpu_affinity=0" in lines
+    output = lines[lines.index("INFO\t-----------") + 1:]
+    assert output[:4] == ["INFO\t64", "INFO\t60", "INFO\t5", "INFO\tidle"]
+    assert output[4].split() == ["INFO", "Cpus_allowed_list:", "0"]
+
+
+def test_resource_settings_invalid():
+    with pytest.raises(AssertionError):
+        resource_limits.validate_settings({"max_memory": 1000})
+    with pytest.raises(AssertionError):
+        resource_limits.validate_settings({"ionice_class": "idle", "ionice_level": 3})
+    with pytest.raises(AssertionError):
+        resource_limits.validate_settings({"nice": 40})
@@ -0,0 +1,165 @@
+import datetime
+import mock
+import os
+import pytest
+import sys
+
+from processcontrol import config
+from processcontrol import job_state
+from processcontrol import schedule
+from processcontrol import scheduler
+
+from . import override_config
+
+
+def setup_module():
+    override_config.start(job_subdir="scheduled")
+
+
+def teardown_module():
+    override_config.stop()
+
+
+def test_schedule_matches():
+    every_five = schedule.CronSchedule("*/5 * * * *")
+    assert every_five.matches(datetime.datetime(2017, 4, 1, 12, 35))
+    assert not every_five.matches(datetime.datetime(2017, 4, 1, 12, 36))
+
+    # 2017-04-01 was a Saturday.
+    weekend = schedule.CronSchedule("30 2 * * sat,sun")
+    assert weekend.matches(datetime.datetime(2017, 4, 1, 2, 30))
+    assert not weekend.matches(datetime.datetime(2017, 4, 3, 2, 30))
+
+    # Restricting both day fields matches either.
+    either = schedule.CronSchedule("0 0 13 * 5")
+    assert either.matches(datetime.datetime(2017, 4, 13, 0, 0))
+    assert either.matches(datetime.datetime(2017, 4, 7, 0, 0))
+    assert not either.matches(datetime.datetime(2017, 4, 8, 0, 0))
+
+
+@pytest.mark.parametrize("expression", [
+    "60 * * * *",
+    "* * 0 * *",
+    "*/0 * * * *",
+    "5/2 * * * *",
+    "10-5 * * * *",
+    "* * * foo *",
+])
+def test_schedule_invalid(expression):
+    with pytest.raises(ValueError):
+        schedule.CronSchedule(expression)
+
+
+def test_next_fire():
+    every_five = schedule.CronSchedule("*/5 * * * *")
+    assert every_five.next_fire(datetime.datetime(2017, 4, 1, 12, 35, 10)) == datetime.datetime(2017, 4, 1, 12, 40)
+
+    new_year = schedule.CronSchedule("0 0 1 jan *")
+    assert new_year.next_fire(datetime.datetime(2017, 4, 1, 12, 35)) == datetime.datetime(2018, 1, 1, 0, 0)
+
+    leap_day = schedule.CronSchedule("30 6 29 2 *")
+    assert leap_day.next_fire(datetime.datetime(2017, 4, 1)) == datetime.datetime(2020, 2, 29, 6, 30)
+
+    # Mondays at 9:00 and 17:00.  2017-04-01 was a Saturday.
+    office = schedule.CronSchedule("0 9,17 * * mon")
+    assert office.next_fire(datetime.datetime(2017, 4, 1)) == datetime.datetime(2017, 4, 3, 9, 0)
+    assert office.next_fire(datetime.datetime(2017, 4, 3, 9, 0)) == datetime.datetime(2017, 4, 3, 17, 0)
+
+    never = schedule.CronSchedule("0 0 30 2 *")
+    assert never.next_fire(datetime.datetime(2017, 4, 1)) is None
+
+
+def test_fires_between():
+    hourly = schedule.CronSchedule("15 * * * *")
+    start = datetime.datetime(2017, 4, 1, 23, 15)
+    end = datetime.datetime(2017, 4, 2, 2, 15)
+    assert list(hourly.fires_between(start, end)) == [
+        datetime.datetime(2017, 4, 1, 23, 15),
+        datetime.datetime(2017, 4, 2, 0, 15),
+        datetime.datetime(2017, 4, 2, 1, 15),
+    ]
+
+
+def test_next_fire_matches():
+    # Cross-check the search against brute force matching.
+    expression = schedule.CronSchedule("*/7 1-3 */2 * 1-5")
+    when = datetime.datetime(2017, 4, 1)
+    for _ in range(50):
+        fire = expression.next_fire(when)
+        assert expression.matches(fire)
+        probe = when.replace(second=0) + datetime.timedelta(minutes=1)
+        while probe < fire:
+            assert not expression.matches(probe)
+            probe += datetime.timedelta(minutes=1)
+        when = fire
+
+
+def test_due_jobs():
+    job_scheduler = scheduler.Scheduler()
+    job_scheduler.refresh(datetime.datetime(2017, 4, 1, 12, 9))
+
+    assert job_scheduler.due_jobs(datetime.datetime(2017, 4, 1, 12, 10)) == ["schedule_2", "schedule_good"]
+    assert job_scheduler.due_jobs(datetime.datetime(2017, 4, 1, 12, 11)) == []
+    assert job_scheduler.due_jobs(datetime.datetime(2017, 4, 1, 12, 15)) == ["schedule_good"]
+
+
+@pytest.mark.timeout(10)
+def test_launch():
+    job_scheduler = scheduler.Scheduler()
+    job_scheduler.refresh(datetime.datetime.now())
+
+    before = len(job_state.load_state("schedule_good").history)
+    job_scheduler.launch("schedule_good")
+    assert len(job_scheduler.children) == 1
+    job_scheduler.reap(block=True)
+    assert job_scheduler.children == {}
+
+    history = job_state.load_state("schedule_good").history
+    assert len(history) == min(before + 2, job_state.DEFAULT_RETENTION)
+    assert history[-1]["status"] == "completed"
+
+
+def test_exit_child_flushes_output(tmp_path):
+    path = tmp_path / "child.out"
+    pid = os.fork()
+    if pid == 0:
+        sys.stdout = open(str(path), "w")
+        print("written before exit")
+        scheduler.exit_child(3)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 3
+    assert path.read_text() == "written before exit\n"
+
+
+def test_refresh_survives_broken_job_files(tmp_path):
+    job_dir = tmp_path / "jobs"
+    job_dir.mkdir()
+    (job_dir / "good.yaml").write_text("name: Good\ncommand: /bin/true\nschedule: '*/5 * * * *'\n")
+    (job_dir / "unparseable.yaml").write_text("name: [Broken\n")
+    (job_dir / "not_a_mapping.yaml").write_text("- name\n- command\n")
+    (job_dir / "bad_type.yaml").write_text("name: Bad\ncommand: /bin/true\nlock_wait: 5\n")
+
+    global_config = config.get_global_config()
+    with mock.patch.dict(global_config.values, {"job_directory": str(job_dir)}):
+        job_scheduler = scheduler.Scheduler()
+        job_scheduler.refresh(datetime.datetime(2017, 4, 1, 12, 9))
+
+        for slug in ("unparseable", "not_a_mapping", "bad_type"):
+            assert job_scheduler.catalog.get(slug).error is not None
+        assert job_scheduler.due_jobs(datetime.datetime(2017, 4, 1, 12, 10)) == ["good"]
+
+
+def test_run_forever_keeps_schedules_when_refresh_fails():
+    job_scheduler = scheduler.Scheduler()
+    job_scheduler.schedules = {"kept": None}
+
+    def stop_after_refresh(seconds):
+        job_scheduler.running = False
+
+    with mock.patch.object(job_scheduler, "refresh", side_effect=SystemExit(1)), \
+            mock.patch("time.sleep", side_effect=stop_after_refresh), \
+            mock.patch("signal.signal"):
+        job_scheduler.run_forever()
+
+    assert job_scheduler.schedules == {"kept": None}
@@ -7,11 +7,14 @@ _run-job_complete()
 	if [[ ${COMP_CWORD} == 1 ]]
 	then
 		possibilities=`run-job -l`
-		possibilities+=" --job --list-jobs --status --slow-start"
+		possibilities+=" --job --list-jobs --status --slow-start --daemon --logs --flush-mail --prune-logs"
 	elif [[ ${prev_word} == "-j" || ${prev_word} == "--job" ]]
 	then
 		possibilities=`run-job -l`
 		possibilities+=" --slow-start"
+	elif [[ ${prev_word} == "--logs" ]]
+	then
+		possibilities=`run-job -l`
 	elif [[
 		${prev_word} == "-l" ||
 		${prev_word} == "--list-jobs" ||
@@ -19,7 +22,7 @@ _run-job_complete()
 		${prev_word} == "--status"
 	]]
 	then
-		possibilities="--only-running"
+		possibilities="--only-running --tag"
 	else
 		possibilities=""
 	fi
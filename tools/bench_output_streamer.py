@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Compare the OutputStreamer against the previous design, which read each
+# pipe on its own thread with readline() and wrote every line through
+# logging, and against raw output mode.
+#
+#     python3 tools/bench_output_streamer.py [line_count]
+
+import datetime
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from processcontrol import config  # noqa: E402
+from processcontrol import output_streamer  # noqa: E402
+
+
+CHILD = "import sys\nfor i in range({count}):\n    sys.stdout.write('line %d of benchmark output\\n' % i)\n"
+
+
+class BenchConfiguration(config.Configuration):
+    def __init__(self, output_directory):
+        config.Configuration.__init__(self, {"output_directory": output_directory})
+
+
+def spawn(count):
+    return subprocess.Popen(
+        [sys.executable, "-c", CHILD.format(count=count)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+
+def run_streamer(count, output_directory):
+    process = spawn(count)
+    streamer = output_streamer.OutputStreamer(process, "bench", "bench", datetime.datetime.utcnow())
+    streamer.start()
+    process.wait()
+    streamer.stop()
+
+
+def run_raw(count, output_directory):
+    raw_output = output_streamer.RawOutput("bench-raw", "bench", datetime.datetime.utcnow())
+    raw_output.start()
+    process = subprocess.Popen(
+        [sys.executable, "-c", CHILD.format(count=count)],
+        stdout=raw_output.fileno(),
+        stderr=raw_output.fileno())
+    raw_output.attach(process)
+    process.wait()
+    raw_output.stop()
+
+
+def run_logging_threads(count, output_directory):
+    """The previous implementation, for reference."""
+    process = spawn(count)
+    logger = logging.getLogger("bench-logging")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(output_directory, "bench-logging.log"))
+    handler.setFormatter(logging.Formatter("%(asctime)s\t%(levelname)s\t%(message)s"))
+    logger.addHandler(handler)
+
+    def read_lines(stream, is_error_stream):
+        while True:
+            line = stream.readline().decode("utf-8", "replace")
+            if line == "":
+                break
+            line = line.rstrip("\n")
+            if is_error_stream:
+                logger.error(line)
+            else:
+                logger.info(line)
+
+    threads = [
+        threading.Thread(target=read_lines, args=(process.stdout, False)),
+        threading.Thread(target=read_lines, args=(process.stderr, True)),
+    ]
+    for thread in threads:
+        thread.start()
+    process.wait()
+    for thread in threads:
+        thread.join()
+    logger.removeHandler(handler)
+    handler.close()
+
+
+def measure(function, count, output_directory):
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    function(count, output_directory)
+    return time.monotonic() - wall_start, time.process_time() - cpu_start
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        config._global_config = BenchConfiguration(output_directory)
+        config._global_config_stamp = config.global_config_stamp()
+
+        for name, function in (("logging threads", run_logging_threads), ("streamer", run_streamer), ("raw", run_raw)):
+            wall, cpu = measure(function, count, output_directory)
+            print("{name:>16}: {wall:6.2f}s wall, {cpu:6.2f}s runner CPU for {count} lines".format(
+                name=name, wall=wall, cpu=cpu, count=count))